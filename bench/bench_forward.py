@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+'''
+Benchmark of Natter forward methods over loopback.
+
+Local echo, discard and source servers are started, and each forward method
+is placed between the clients and the servers. For each concurrency level
+the following are measured:
+
+    tcp_upload      client -> forwarder -> discard server, bytes per second
+    tcp_download    source server -> forwarder -> client, bytes per second
+    tcp_latency     small echo requests, requests per second and p50/p99
+    tcp_connect     connect + one echo request + close, connections per second
+    udp_echo        UDP echo ping-pong, packets per second and p50/p99
+
+Each forwarder runs in its own process, so it does not share the GIL or
+thread limits with the clients. Clients are Python threads, so absolute
+numbers are limited by the client side as well; compare methods against
+each other and against "direct" (no forwarder) on the same box. Kernel methods (iptables, nftables) only
+show up if their rules apply to locally generated traffic.
+
+Results are written as JSON, e.g.:
+
+    python3 bench/bench_forward.py -m socket,socket-select -c 1,16 -o result.json
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import natter
+
+
+METHODS = {
+    "socket": natter.ForwardSocket,
+    "socket-select": natter.ForwardSocketSelect,
+    "socket-splice": natter.ForwardSocketSplice,
+    "socket-mp": natter.ForwardSocketMP,
+    "asyncio": natter.ForwardAsyncio,
+    "socat": natter.ForwardSocat,
+    "gost": natter.ForwardGost,
+    "iptables": natter.ForwardIptables,
+    "nftables": natter.ForwardNftables,
+}
+
+TESTS = ["tcp_upload", "tcp_download", "tcp_latency", "tcp_connect", "udp_echo"]
+
+CHUNK = 65536
+MESSAGE = b"x" * 64
+
+
+class Servers(object):
+    # echo, discard and source servers on loopback, one thread per connection
+    def __init__(self):
+        self.socks = []
+        self.tcp_echo = self._tcp_server(self._echo)
+        self.tcp_discard = self._tcp_server(self._discard)
+        self.tcp_source = self._tcp_server(self._source)
+        self.udp_echo = self._udp_server()
+
+    def _tcp_server(self, handler):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(socket.SOMAXCONN)
+        self.socks.append(sock)
+        natter.start_daemon_thread(self._accept, args=(sock, handler))
+        return sock.getsockname()
+
+    def _accept(self, sock, handler):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except (OSError, socket.error):
+                return
+            natter.start_daemon_thread(self._handle, args=(conn, handler))
+
+    def _handle(self, conn, handler):
+        try:
+            handler(conn)
+        except (OSError, socket.error):
+            pass
+        finally:
+            conn.close()
+
+    def _echo(self, conn):
+        buff = bytearray(CHUNK)
+        while True:
+            n = conn.recv_into(buff)
+            if not n:
+                return
+            conn.sendall(memoryview(buff)[:n])
+
+    def _discard(self, conn):
+        buff = bytearray(CHUNK)
+        while conn.recv_into(buff):
+            pass
+
+    def _source(self, conn):
+        data = b"\0" * CHUNK
+        while True:
+            conn.sendall(data)
+
+    def _udp_server(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        self.socks.append(sock)
+        natter.start_daemon_thread(self._udp_echo, args=(sock,))
+        return sock.getsockname()
+
+    def _udp_echo(self, sock):
+        buff = bytearray(CHUNK)
+        while True:
+            try:
+                n, addr = sock.recvfrom_into(buff)
+                sock.sendto(memoryview(buff)[:n], addr)
+            except (OSError, socket.error):
+                return
+
+    def close(self):
+        for sock in self.socks:
+            sock.close()
+
+
+def free_port(udp=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM if udp else socket.SOCK_STREAM)
+    try:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def latency_summary(samples):
+    return {
+        "p50_ms": round(percentile(samples, 50) * 1000, 3) if samples else None,
+        "p99_ms": round(percentile(samples, 99) * 1000, 3) if samples else None,
+    }
+
+
+def run_workers(concurrency, target):
+    # run `target(index, results)` in threads, return the results of the
+    # workers that finished, the errors of the others and elapsed seconds
+    results = [None] * concurrency
+    errors = []
+
+    def run(i):
+        try:
+            target(i, results)
+        except Exception as ex:
+            errors.append("%s: %s" % (type(ex).__name__, ex))
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(concurrency)]
+    ts = time.time()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return [r for r in results if r is not None], errors, time.time() - ts
+
+
+def summary(ret, errors):
+    if errors:
+        ret["errors"] = len(errors)
+        ret["error"] = errors[0]
+    return ret
+
+
+def connect(addr, timeout=5):
+    sock = socket.create_connection(addr, timeout=timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def test_tcp_upload(addr, concurrency, duration):
+    data = b"\0" * CHUNK
+    deadline = time.time() + duration
+
+    def worker(i, results):
+        sent = 0
+        sock = connect(addr)
+        try:
+            while time.time() < deadline:
+                sock.sendall(data)
+                sent += len(data)
+            # wait until the discard server has read everything
+            sock.shutdown(socket.SHUT_WR)
+            sock.settimeout(30)
+            sock.recv(1)
+        finally:
+            sock.close()
+        results[i] = sent
+
+    results, errors, elapsed = run_workers(concurrency, worker)
+    return summary({"bytes": sum(results), "bytes_per_sec": round(sum(results) / elapsed)}, errors)
+
+
+def test_tcp_download(addr, concurrency, duration):
+    deadline = time.time() + duration
+
+    def worker(i, results):
+        received = 0
+        buff = bytearray(CHUNK)
+        sock = connect(addr)
+        try:
+            while time.time() < deadline:
+                n = sock.recv_into(buff)
+                if not n:
+                    raise OSError("connection closed by forwarder")
+                received += n
+        finally:
+            sock.close()
+        results[i] = received
+
+    results, errors, elapsed = run_workers(concurrency, worker)
+    return summary({"bytes": sum(results), "bytes_per_sec": round(sum(results) / elapsed)}, errors)
+
+
+def echo_once(sock, buff):
+    sock.sendall(MESSAGE)
+    received = 0
+    while received < len(MESSAGE):
+        n = sock.recv_into(memoryview(buff)[received:])
+        if not n:
+            raise OSError("connection closed by forwarder")
+        received += n
+
+
+def test_tcp_latency(addr, concurrency, duration):
+    deadline = time.time() + duration
+
+    def worker(i, results):
+        samples = []
+        buff = bytearray(len(MESSAGE))
+        sock = connect(addr)
+        try:
+            while time.time() < deadline:
+                ts = time.perf_counter()
+                echo_once(sock, buff)
+                samples.append(time.perf_counter() - ts)
+        finally:
+            sock.close()
+        results[i] = samples
+
+    results, errors, elapsed = run_workers(concurrency, worker)
+    samples = [s for r in results for s in r]
+    ret = {"requests": len(samples), "requests_per_sec": round(len(samples) / elapsed)}
+    ret.update(latency_summary(samples))
+    return summary(ret, errors)
+
+
+def test_tcp_connect(addr, concurrency, duration):
+    deadline = time.time() + duration
+
+    def worker(i, results):
+        samples = []
+        buff = bytearray(len(MESSAGE))
+        while time.time() < deadline:
+            ts = time.perf_counter()
+            sock = connect(addr)
+            try:
+                echo_once(sock, buff)
+            finally:
+                sock.close()
+            samples.append(time.perf_counter() - ts)
+        results[i] = samples
+
+    results, errors, elapsed = run_workers(concurrency, worker)
+    samples = [s for r in results for s in r]
+    ret = {"connections": len(samples), "connections_per_sec": round(len(samples) / elapsed)}
+    ret.update(latency_summary(samples))
+    return summary(ret, errors)
+
+
+def test_udp_echo(addr, concurrency, duration):
+    deadline = time.time() + duration
+
+    def worker(i, results):
+        samples = []
+        lost = 0
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(1)
+        sock.connect(addr)
+        try:
+            while time.time() < deadline:
+                ts = time.perf_counter()
+                sock.send(MESSAGE)
+                try:
+                    sock.recv(CHUNK)
+                except socket.timeout:
+                    lost += 1
+                    continue
+                samples.append(time.perf_counter() - ts)
+        finally:
+            sock.close()
+        results[i] = (samples, lost)
+
+    results, errors, elapsed = run_workers(concurrency, worker)
+    samples = [s for r in results for s in r[0]]
+    ret = {
+        "packets": len(samples) * 2,
+        "packets_per_sec": round(len(samples) * 2 / elapsed),
+        "lost": sum(r[1] for r in results),
+    }
+    ret.update(latency_summary(samples))
+    return summary(ret, errors)
+
+
+class ForwarderError(Exception):
+    pass
+
+
+def forwarder_main(name, addr, target, udp, conn):
+    # child process: start the forwarder, report, and run until told to stop
+    try:
+        forwarder = METHODS[name]()
+        forwarder.start_forward(addr[0], addr[1], target[0], target[1], udp=udp)
+    except Exception as ex:
+        conn.send("%s: %s" % (type(ex).__name__, ex))
+        return
+    conn.send(None)
+    try:
+        conn.recv()
+    except EOFError:
+        pass
+    forwarder.stop_forward()
+
+
+class ForwarderProcess(object):
+    # one forward method running in a separate process
+    def __init__(self, name, addr, target, udp):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(
+            target=forwarder_main, args=(name, addr, target, udp, child_conn)
+        )
+        # not a daemon: socket-mp starts its own worker processes, stop()
+        # terminates and joins the forwarder either way
+        self.proc.start()
+        child_conn.close()
+
+    def wait_started(self, timeout=15):
+        if not self.conn.poll(timeout):
+            raise ForwarderError("forwarder did not start within %d seconds" % timeout)
+        error = self.conn.recv()
+        if error:
+            raise ForwarderError(error)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, socket.error):
+            pass
+        self.proc.join(10)
+        if self.proc.is_alive():
+            self.proc.terminate()
+            self.proc.join()
+        self.conn.close()
+
+
+def bench_method(name, servers, tests, concurrency_list, duration):
+    result = {"method": name, "available": True, "tests": {}}
+    if name != "direct":
+        # constructors only check that the method can run on this system
+        try:
+            METHODS[name]()
+        except Exception as ex:
+            result["available"] = False
+            result["error"] = "%s: %s" % (type(ex).__name__, ex)
+            natter.Logger.info("%-14s unavailable: %s" % (name, result["error"]))
+            return result
+    targets = {
+        "tcp_upload": servers.tcp_discard,
+        "tcp_download": servers.tcp_source,
+        "tcp_latency": servers.tcp_echo,
+        "tcp_connect": servers.tcp_echo,
+        "udp_echo": servers.udp_echo,
+    }
+    for test in tests:
+        udp = test.startswith("udp")
+        target = targets[test]
+        runs = []
+        for concurrency in concurrency_list:
+            run = {"concurrency": concurrency}
+            forwarder = None
+            try:
+                if name == "direct":
+                    addr = target
+                else:
+                    addr = ("127.0.0.1", free_port(udp))
+                    forwarder = ForwarderProcess(name, addr, target, udp)
+                    forwarder.wait_started()
+                    # give forwarders that start helper processes a moment
+                    time.sleep(0.2)
+                run.update(globals()["test_" + test](addr, concurrency, duration))
+            except ForwarderError as ex:
+                run["error"] = str(ex)
+            except Exception as ex:
+                run["error"] = "%s: %s" % (type(ex).__name__, ex)
+            finally:
+                if forwarder:
+                    forwarder.stop()
+            natter.Logger.info("%-14s %-13s c=%-4d %s" % (
+                name, test, concurrency,
+                ", ".join("%s=%s" % (k, v) for k, v in run.items() if k != "concurrency")
+            ))
+            runs.append(run)
+        result["tests"][test] = runs
+    return result
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Benchmark Natter forward methods over loopback.")
+    argp.add_argument(
+        "-m", metavar="<methods>", default="direct," + ",".join(METHODS),
+        help="comma-separated forward methods, 'direct' means no forwarder (default: all)"
+    )
+    argp.add_argument(
+        "-t", metavar="<tests>", default=",".join(TESTS),
+        help="comma-separated tests (default: %s)" % ",".join(TESTS)
+    )
+    argp.add_argument(
+        "-c", metavar="<levels>", default="1,8,64",
+        help="comma-separated concurrency levels (default: 1,8,64)"
+    )
+    argp.add_argument(
+        "-d", metavar="<seconds>", type=float, default=2,
+        help="duration of each run in seconds (default: 2)"
+    )
+    argp.add_argument(
+        "-o", metavar="<path>", default="-",
+        help="write JSON results to this file, '-' for stdout (default)"
+    )
+    argp.add_argument(
+        "-v", action="store_true", help="verbose mode, printing debug messages"
+    )
+    args = argp.parse_args()
+
+    methods = [m for m in args.m.split(",") if m]
+    tests = [t for t in args.t.split(",") if t]
+    concurrency_list = [int(c) for c in args.c.split(",") if c]
+    for m in methods:
+        if m != "direct" and m not in METHODS:
+            argp.error("unknown method: %s" % m)
+    for t in tests:
+        if t not in TESTS:
+            argp.error("unknown test: %s" % t)
+
+    if args.v:
+        natter.Logger.set_level(natter.Logger.DEBUG)
+
+    servers = Servers()
+    report = {
+        "natter_version": natter.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "duration": args.d,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": [bench_method(m, servers, tests, concurrency_list, args.d) for m in methods],
+    }
+    servers.close()
+
+    output = json.dumps(report, indent=2)
+    if args.o == "-":
+        print(output)
+    else:
+        with open(args.o, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+'''
+End-to-end DNS update benchmark against the local CloudFlare stand-in.
+
+An updater (NatterCloudFlare) is pointed at bench/fake_cloudflare.py and fed
+synthetic Natter output through the same reader that follows a real Natter
+process. For each mapping change the following are measured:
+
+    time_to_commit  from writing the Natter log line to the fake API holding
+                    both the A and the SRV record with the new values
+    api_calls       requests the updater sent for the change, retries included
+
+The first change starts from an empty zone, so it includes record lookups
+and creation. Every later change moves the port, and every --ip-every
+changes the IP as well.
+
+    python3 bench/bench_update.py -n 20 --latency 0.05 --rate-limited 0.1 -o result.json
+'''
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import threading
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from fake_cloudflare import FakeCloudFlare
+
+
+SRV_NAME = "_minecraft._tcp.bench.example.com"
+A_NAME = "natter-server.bench.example.com"
+
+
+def load_updater():
+    # import with the built-in defaults rather than a config.yaml that
+    # happens to be in the current directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            import natter_cloudflare
+        finally:
+            os.chdir(cwd)
+    return natter_cloudflare
+
+
+class ReplayProcess(object):
+    # stands in for the Natter subprocess, the updater reads .stdout
+    def __init__(self):
+        r, w = os.pipe()
+        self.stdout = os.fdopen(r, "r")
+        self.writer = os.fdopen(w, "w")
+
+    def write_mapping(self, ip, port):
+        timestr = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.writer.write(
+            "%s [I] \n"
+            "%s [I] tcp://192.168.1.10:25565 <--socket--> tcp://192.168.1.10:40000"
+            " <--Natter--> tcp://%s:%d\n"
+            "%s [I] \n" % (timestr, timestr, ip, port, timestr)
+        )
+        self.writer.flush()
+
+    def poll(self):
+        return 0 if self.writer.closed else None
+
+    def terminate(self):
+        if not self.writer.closed:
+            self.writer.close()
+
+    kill = terminate
+
+    def wait(self, timeout=None):
+        return 0
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def committed(ip, port):
+    def predicate(fake):
+        a = fake.find("A", A_NAME)
+        srv = fake.find("SRV", SRV_NAME)
+        return bool(a and srv and a["content"] == ip and srv["data"].get("port") == port)
+    return predicate
+
+
+def run(args, fake):
+    cf = load_updater()
+    cf.CF_API_TOKEN = "bench"
+    cf.CF_ZONE_ID = fake.zone_id
+    cf.CF_API_BASE = fake.url
+    cf.CF_STATE_FILE = None
+    cf.CF_VERIFY_SAMPLE = 0
+    cf.CF_BATCH_UPDATE = not args.no_batch
+    cf.CF_RETRY_INTERVAL = args.retry_interval
+    cf.NATTER_EVENTS = False
+    cf.SERVICES = [{"srv": SRV_NAME, "port": 25565}]
+
+    updater = cf.NatterCloudFlare()
+    service = updater.services[0]
+    service.natter_process = ReplayProcess()
+    updater.start_update_worker()
+    reader = threading.Thread(target=updater.monitor_natter_output, args=(service,), daemon=True)
+    reader.start()
+
+    changes = []
+    calls_before = fake.stats()["total_calls"]
+    for i in range(args.n):
+        ip = "203.0.113.%d" % (i // args.ip_every % 254 + 1)
+        port = 30000 + i
+        ts = time.monotonic()
+        service.natter_process.write_mapping(ip, port)
+        commit_at = fake.wait_for(committed(ip, port), args.timeout)
+        # let retries and trailing requests of this change finish
+        time.sleep(args.i)
+        calls_after = fake.stats()["total_calls"]
+        change = {
+            "ip": ip,
+            "port": port,
+            "time_to_commit_ms": ms(commit_at - ts) if commit_at else None,
+            "api_calls": calls_after - calls_before,
+        }
+        if not commit_at:
+            change["error"] = "not committed within %s seconds" % args.timeout
+        calls_before = calls_after
+        changes.append(change)
+        sys.stderr.write("change %-3d %s:%-5d time_to_commit_ms=%s api_calls=%d\n" % (
+            i + 1, ip, port, change["time_to_commit_ms"], change["api_calls"]
+        ))
+
+    updater.stop_update_worker()
+    service.natter_process.terminate()
+    reader.join(5)
+    updater.api.close()
+    return changes
+
+
+def summarize(changes):
+    def latency(items):
+        values = [c["time_to_commit_ms"] for c in items if c["time_to_commit_ms"] is not None]
+        return {
+            "p50_ms": percentile(values, 50),
+            "p95_ms": percentile(values, 95),
+            "max_ms": max(values) if values else None,
+        }
+
+    later = changes[1:]
+    return {
+        "changes": len(changes),
+        "committed": sum(1 for c in changes if c["time_to_commit_ms"] is not None),
+        "first_change": {
+            "time_to_commit_ms": changes[0]["time_to_commit_ms"] if changes else None,
+            "api_calls": changes[0]["api_calls"] if changes else None,
+        },
+        "later_changes": dict(latency(later), api_calls_per_change=(
+            round(sum(c["api_calls"] for c in later) / float(len(later)), 2) if later else None
+        )),
+    }
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description="Measure mapping-to-DNS latency and API calls against a local CloudFlare stand-in."
+    )
+    argp.add_argument("-n", metavar="<count>", type=int, default=20,
+                      help="number of mapping changes (default: 20)")
+    argp.add_argument("-i", metavar="<seconds>", type=float, default=0.2,
+                      help="pause after each committed change (default: 0.2)")
+    argp.add_argument("--ip-every", metavar="<count>", type=int, default=5,
+                      help="change the IP every this many changes, otherwise only the port (default: 5)")
+    argp.add_argument("--no-batch", action="store_true",
+                      help="update records one by one instead of using the batch endpoint")
+    argp.add_argument("--latency", metavar="<seconds>", type=float, default=0.05,
+                      help="API latency (default: 0.05)")
+    argp.add_argument("--jitter", metavar="<seconds>", type=float, default=0,
+                      help="random extra API latency, up to this many seconds")
+    argp.add_argument("--rate-limited", metavar="<ratio>", type=float, default=0,
+                      help="share of API requests answered with 429 (0.0 - 1.0)")
+    argp.add_argument("--failures", metavar="<ratio>", type=float, default=0,
+                      help="share of API requests answered with 500 (0.0 - 1.0)")
+    argp.add_argument("--retry-after", metavar="<seconds>", type=float, default=1,
+                      help="Retry-After sent with 429 (default: 1)")
+    argp.add_argument("--retry-interval", metavar="<seconds>", type=float, default=1,
+                      help="cloudflare.retry_interval of the updater (default: 1)")
+    argp.add_argument("--seed", metavar="<seed>", type=int, default=1,
+                      help="seed of injected latency and errors (default: 1)")
+    argp.add_argument("--timeout", metavar="<seconds>", type=float, default=60,
+                      help="give up on a change after this many seconds (default: 60)")
+    argp.add_argument("-o", metavar="<path>", default="-",
+                      help="write JSON results to this file, '-' for stdout (default)")
+    argp.add_argument("-v", action="store_true", help="show the updater log")
+    args = argp.parse_args()
+    if args.n < 1 or args.ip_every < 1:
+        argp.error("-n and --ip-every must be positive")
+
+    fake = FakeCloudFlare(
+        latency=args.latency, jitter=args.jitter, rate_limited=args.rate_limited,
+        failures=args.failures, retry_after=args.retry_after, seed=args.seed
+    ).start()
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+    # the updater logs to stdout, keep it apart from the JSON report
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(sys.stderr if args.v else devnull):
+            changes = run(args, fake)
+    fake.stop()
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started_at": started_at,
+        "options": {
+            "batch": not args.no_batch,
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "rate_limited": args.rate_limited,
+            "failures": args.failures,
+            "retry_after": args.retry_after,
+            "ip_every": args.ip_every,
+            "seed": args.seed,
+        },
+        "summary": summarize(changes),
+        "api": fake.stats(),
+        "changes": changes,
+    }
+    output = json.dumps(report, indent=2)
+    if args.o == "-":
+        print(output)
+    else:
+        with open(args.o, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
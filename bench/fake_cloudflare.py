@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+'''
+Local stand-in for the CloudFlare DNS records API.
+
+Implements the part of /zones/<zone_id>/dns_records that the updater uses:
+listing with type/name filters, getting, creating and overwriting single
+records, and the batch endpoint. Records live in memory.
+
+Latency, rate limiting (429 with Retry-After) and server errors can be
+injected, either at random with a fixed seed or scripted with inject().
+Every request is counted, and every write is timestamped so that callers
+can measure when a change became visible.
+
+In-process use:
+
+    fake = FakeCloudFlare(latency=0.05, rate_limited=0.1).start()
+    # point cloudflare.api_base at fake.url, zone_id at fake.zone_id
+    fake.stop()
+
+Standalone, for running the real updater against it:
+
+    python3 bench/fake_cloudflare.py -p 8787 --latency 0.05
+'''
+
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class FakeCloudFlare(object):
+    PATH_RE = re.compile(r"^/client/v4/zones/([^/]+)/dns_records(?:/([^/]+))?/?$")
+
+    def __init__(self, zone_id="fake-zone", host="127.0.0.1", port=0, latency=0,
+                 jitter=0, rate_limited=0, failures=0, retry_after=1, seed=None):
+        self.zone_id = zone_id
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limited = rate_limited    # share of requests answered with 429
+        self.failures = failures            # share of requests answered with 500
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.records = collections.OrderedDict()
+        self.calls = collections.Counter()
+        self.statuses = collections.Counter()
+        self.writes = 0
+        self.last_write_at = None
+        self.injected = collections.deque()
+        self.cond = threading.Condition()
+        self.next_id = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d/client/v4" % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def inject(self, status, count=1):
+        # answer the next `count` requests with `status` (429 or 5xx)
+        with self.cond:
+            self.injected.extend([status] * count)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "calls": dict(self.calls),
+                "statuses": dict((str(k), v) for k, v in self.statuses.items()),
+                "total_calls": sum(self.calls.values()),
+                "writes": self.writes,
+            }
+
+    def find(self, record_type, name):
+        with self.cond:
+            return self._find(record_type, name)
+
+    def wait_for(self, predicate, timeout):
+        # wait until predicate(self) is true, return the time.monotonic() of
+        # the write that made it true, or None on timeout
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not predicate(self):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            return self.last_write_at
+
+    def _find(self, record_type, name):
+        name = name.rstrip(".").lower()
+        for record in self.records.values():
+            if record["type"] == record_type and record["name"] == name:
+                return record
+        return None
+
+    def _new_id(self):
+        # 32 hex characters, like the real API
+        self.next_id += 1
+        return "%032x" % self.next_id
+
+    def _build(self, body, record_id, created_on=None):
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        record = {
+            "id": record_id,
+            "zone_id": self.zone_id,
+            "type": body.get("type"),
+            "name": str(body.get("name", "")).rstrip(".").lower(),
+            "ttl": body.get("ttl", 1),
+            "proxied": body.get("proxied", False),
+            "created_on": created_on or now,
+            "modified_on": now,
+        }
+        if not record["type"] or not record["name"]:
+            raise ValueError("type and name are required")
+        if record["type"] == "SRV":
+            data = dict(body.get("data") or {})
+            record["data"] = data
+            record["content"] = "%s %s %s" % (data.get("weight"), data.get("port"), data.get("target"))
+            record["priority"] = data.get("priority")
+        else:
+            if not body.get("content"):
+                raise ValueError("content is required")
+            record["content"] = body["content"]
+        return record
+
+    def _commit(self, records):
+        for record in records:
+            self.records[record["id"]] = record
+        self.writes += len(records)
+        self.last_write_at = time.monotonic()
+        self.cond.notify_all()
+
+    # Request handling: returns (status, body, headers)
+
+    def handle(self, method, path, query, body):
+        match = self.PATH_RE.match(path)
+        if not match:
+            return 404, self._error(7003, "Could not route to %s" % path), {}
+        zone_id, sub = match.groups()
+        if method == "POST" and sub == "batch":
+            kind = "batch"
+        elif sub:
+            kind = {"GET": "get", "PUT": "put", "DELETE": "delete"}.get(method)
+        else:
+            kind = {"GET": "list", "POST": "create"}.get(method)
+        with self.cond:
+            self.calls[kind or "unknown"] += 1
+            injected = self.injected.popleft() if self.injected else None
+
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        if injected is None:
+            roll = self.random.random()
+            if roll < self.rate_limited:
+                injected = 429
+            elif roll < self.rate_limited + self.failures:
+                injected = 500
+        if injected == 429:
+            return 429, self._error(971, "Please wait and consider throttling your request speed"), {
+                "Retry-After": str(self.retry_after)
+            }
+        if injected:
+            return injected, self._error(10000, "Internal server error"), {}
+
+        if zone_id != self.zone_id:
+            return 404, self._error(7003, "Could not route to /zones/%s" % zone_id), {}
+        if not kind:
+            return 405, self._error(10000, "Method not allowed"), {}
+        try:
+            with self.cond:
+                return getattr(self, "_api_" + kind)(sub, query, body)
+        except ValueError as ex:
+            return 400, self._error(9000, str(ex)), {}
+
+    def _api_list(self, sub, query, body):
+        result = [
+            r for r in self.records.values()
+            if ("type" not in query or r["type"] == query["type"])
+            and ("name" not in query or r["name"] == query["name"].rstrip(".").lower())
+        ]
+        return 200, self._success(result, result_info={
+            "page": 1, "per_page": 100, "count": len(result), "total_count": len(result)
+        }), {}
+
+    def _api_get(self, record_id, query, body):
+        if record_id not in self.records:
+            return 404, self._error(81044, "Record does not exist."), {}
+        return 200, self._success(self.records[record_id]), {}
+
+    def _api_create(self, sub, query, body):
+        existing = self._find(body.get("type"), str(body.get("name", "")))
+        if existing and existing["type"] in ("A", "SRV") and self._same(existing, body):
+            return 400, self._error(81058, "An identical record already exists."), {}
+        record = self._build(body, self._new_id())
+        self._commit([record])
+        return 200, self._success(record), {}
+
+    def _api_put(self, record_id, query, body):
+        if record_id not in self.records:
+            return 404, self._error(81044, "Record does not exist."), {}
+        record = self._build(body, record_id, self.records[record_id]["created_on"])
+        self._commit([record])
+        return 200, self._success(record), {}
+
+    def _api_delete(self, record_id, query, body):
+        if record_id not in self.records:
+            return 404, self._error(81044, "Record does not exist."), {}
+        del self.records[record_id]
+        return 200, self._success({"id": record_id}), {}
+
+    def _api_batch(self, sub, query, body):
+        # all operations succeed or none is applied, like the real endpoint
+        # deletes, patches, puts and posts run in this order
+        for op in ("deletes", "patches", "puts"):
+            for item in body.get(op) or []:
+                if item.get("id") not in self.records:
+                    return 400, self._error(81044, "Record does not exist."), {}
+        staged = collections.OrderedDict(self.records)
+        result = {"deletes": [], "patches": [], "puts": [], "posts": []}
+        for item in body.get("deletes") or []:
+            result["deletes"].append(staged.pop(item["id"]))
+        for item in body.get("patches") or []:
+            merged = dict(staged[item["id"]], **item)
+            result["patches"].append(self._build(merged, item["id"], staged[item["id"]]["created_on"]))
+            staged[item["id"]] = result["patches"][-1]
+        for item in body.get("puts") or []:
+            result["puts"].append(self._build(item, item["id"], staged[item["id"]]["created_on"]))
+            staged[item["id"]] = result["puts"][-1]
+        for item in body.get("posts") or []:
+            result["posts"].append(self._build(item, self._new_id()))
+            staged[result["posts"][-1]["id"]] = result["posts"][-1]
+        self.records = staged
+        self._commit(result["patches"] + result["puts"] + result["posts"])
+        return 200, self._success(result), {}
+
+    @staticmethod
+    def _same(record, body):
+        if record["type"] == "SRV":
+            return record["data"] == (body.get("data") or {})
+        return record["content"] == body.get("content")
+
+    @staticmethod
+    def _success(result, **extra):
+        ret = {"success": True, "errors": [], "messages": [], "result": result}
+        ret.update(extra)
+        return ret
+
+    @staticmethod
+    def _error(code, message):
+        return {"success": False, "errors": [{"code": code, "message": message}],
+                "messages": [], "result": None}
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _serve(self):
+                url = urlsplit(self.path)
+                query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+                length = int(self.headers.get("Content-Length") or 0)
+                body = {}
+                if length:
+                    try:
+                        body = json.loads(self.rfile.read(length).decode())
+                    except ValueError:
+                        body = None
+                if not self.headers.get("Authorization", "").startswith("Bearer "):
+                    status, ret, headers = 403, fake._error(10000, "Authentication error"), {}
+                elif not isinstance(body, dict):
+                    status, ret, headers = 400, fake._error(9207, "Request body is invalid."), {}
+                else:
+                    status, ret, headers = fake.handle(self.command, url.path, query, body)
+                with fake.cond:
+                    fake.statuses[status] += 1
+                data = json.dumps(ret).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _serve
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    argp = argparse.ArgumentParser(description="Local stand-in for the CloudFlare DNS records API.")
+    argp.add_argument("-b", metavar="<address>", default="127.0.0.1", help="bind address (default: 127.0.0.1)")
+    argp.add_argument("-p", metavar="<port>", type=int, default=8787, help="port (default: 8787)")
+    argp.add_argument("-z", metavar="<zone_id>", default="fake-zone", help="zone id (default: fake-zone)")
+    argp.add_argument("--latency", metavar="<seconds>", type=float, default=0,
+                      help="delay added to every request")
+    argp.add_argument("--jitter", metavar="<seconds>", type=float, default=0,
+                      help="random extra delay, up to this many seconds")
+    argp.add_argument("--rate-limited", metavar="<ratio>", type=float, default=0,
+                      help="share of requests answered with 429 (0.0 - 1.0)")
+    argp.add_argument("--failures", metavar="<ratio>", type=float, default=0,
+                      help="share of requests answered with 500 (0.0 - 1.0)")
+    argp.add_argument("--retry-after", metavar="<seconds>", type=float, default=1,
+                      help="Retry-After sent with 429 (default: 1)")
+    args = argp.parse_args()
+
+    fake = FakeCloudFlare(
+        zone_id=args.z, host=args.b, port=args.p, latency=args.latency, jitter=args.jitter,
+        rate_limited=args.rate_limited, failures=args.failures, retry_after=args.retry_after
+    )
+    sys.stderr.write("api_base: %s\nzone_id: %s\n" % (fake.url, fake.zone_id))
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.stderr.write("%s\n" % json.dumps(fake.stats()))
+
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,7 @@ import atexit
 import codecs
 import random
 import signal
+import selectors
 import socket
 import struct
 import argparse
@@ -92,12 +93,267 @@ class Logger(object):
 
 
 class NatterExit(object):
-    atexit.register(lambda : NatterExit._atexit[0]())
-    _atexit = [lambda : None]
+    # Clean-up functions (e.g. removing iptables rules) that run at exit.
+    # Every running forwarder registers its own, and unregisters it once
+    # it has been stopped.
+    atexit.register(lambda : NatterExit.run())
+    _funcs = []
+    _lock = threading.Lock()
 
     @staticmethod
-    def set_atexit(func):
-        NatterExit._atexit[0] = func
+    def register(func, owner=None):
+        # owner: ident of the thread responsible for it, the calling thread
+        # by default
+        with NatterExit._lock:
+            NatterExit._funcs.append((owner or threading.get_ident(), func))
+
+    @staticmethod
+    def unregister(func):
+        with NatterExit._lock:
+            NatterExit._funcs[:] = [item for item in NatterExit._funcs if item[1] != func]
+
+    @staticmethod
+    def run(current_thread=False):
+        # run the registered functions in reverse order, only those
+        # registered by the calling thread if current_thread is set
+        ident = threading.get_ident()
+        with NatterExit._lock:
+            funcs = [f for t, f in NatterExit._funcs if not current_thread or t == ident]
+            NatterExit._funcs[:] = [
+                item for item in NatterExit._funcs if current_thread and item[0] != ident
+            ]
+        for func in reversed(funcs):
+            try:
+                func()
+            except Exception as ex:
+                Logger.error("natter: clean-up failed: %s" % ex)
+
+
+class EventStream(object):
+    # Writes machine-readable events as JSON lines.
+    # target: file descriptor number, "-" for stdout, or "unix:<path>"
+    def __init__(self, target=None):
+        self.lock = threading.Lock()
+        self.fp = None
+        if not target:
+            return
+        if target == "-":
+            self.fp = sys.stdout
+        elif target.startswith("unix:"):
+            if not hasattr(socket, "AF_UNIX"):
+                raise RuntimeError("Unix domain socket is not supported on your platform.")
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(target[5:])
+            self.fp = sock.makefile("w")
+            sock.close()
+        else:
+            self.fp = os.fdopen(os.dup(int(target)), "w")
+
+    def emit(self, event, **fields):
+        if not self.fp:
+            return
+        fields["event"] = event
+        fields["time"] = round(time.time(), 3)
+        line = json.dumps(fields, sort_keys=True) + "\n"
+        with self.lock:
+            try:
+                self.fp.write(line)
+                self.fp.flush()
+            except (OSError, ValueError) as ex:
+                Logger.error("events: cannot write event stream: %s" % ex)
+                self.fp = None
+
+    def close(self):
+        with self.lock:
+            if self.fp and self.fp is not sys.stdout:
+                try:
+                    self.fp.close()
+                except (OSError, ValueError):
+                    pass
+            self.fp = None
+
+
+class Metrics(object):
+    # Counters, gauges and histograms in the Prometheus text format, served
+    # at http://<listen>/metrics by a daemon thread. Without a listen address
+    # nothing is recorded. Instances are shared per listen address, so that
+    # counters survive the restarts of natter_main().
+    TYPES = {
+        "natter_info":                          ("gauge", "Natter version and protocol."),
+        "natter_mapping_info":                  ("gauge", "Current mapping, 1 while it is in use."),
+        "natter_mapping_age_seconds":           ("gauge", "Seconds since the current mapping was established."),
+        "natter_mapping_changes_total":         ("counter", "Mapped address changes detected by rechecks."),
+        "natter_rechecks_total":                ("counter", "Rechecks of the mapped address through STUN."),
+        "natter_retries_total":                 ("counter", "Restarts of Natter, by reason."),
+        "natter_keepalive_rtt_seconds":         ("histogram", "Keep-alive round-trip time."),
+        "natter_keepalive_failures_total":      ("counter", "Failed keep-alives."),
+        "natter_stun_latency_seconds":          ("histogram", "Latency of successful STUN requests, by server."),
+        "natter_stun_failovers_total":          ("counter", "STUN requests that failed over to the next server, by server."),
+        "natter_stun_unavailable_total":        ("counter", "Times no STUN server in the list was available."),
+        "natter_standby_up":                    ("gauge", "1 while a standby mapping is kept."),
+        "natter_standby_promotions_total":      ("counter", "Switches to the standby mapping."),
+        "natter_upnp_renew_failures_total":     ("counter", "Failed UPnP port mapping renewals."),
+        "natter_forward_up":                    ("gauge", "1 while forwarding, by method."),
+        "natter_forward_connections_active":    ("gauge", "Open forwarded connections or UDP sessions."),
+        "natter_forward_connections_total":     ("counter", "Forwarded connections or UDP sessions."),
+        "natter_forward_connection_errors_total": ("counter", "Forwarded connections closed by an error."),
+        "natter_forward_bytes_total":           ("counter", "Forwarded bytes, 'in' is client to target."),
+        "natter_forward_packets_total":         ("counter", "Forwarded reads or datagrams, 'in' is client to target."),
+    }
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    class Labeled(object):
+        # The same metrics with extra labels on every sample, so that services
+        # sharing a listen address can be told apart.
+        def __init__(self, metrics, labels):
+            self.metrics = metrics
+            self.labels = labels
+
+        def inc(self, name, value=1, **labels):
+            self.metrics.inc(name, value, **dict(self.labels, **labels))
+
+        def set(self, name, value, **labels):
+            self.metrics.set(name, value, **dict(self.labels, **labels))
+
+        def observe(self, name, value, **labels):
+            self.metrics.observe(name, value, **dict(self.labels, **labels))
+
+        def collect(self, key, func):
+            def collect_labeled():
+                return [(name, dict(self.labels, **labels), value) for name, labels, value in func()]
+            key = (key,) + Metrics._key(key, self.labels)[1]
+            self.metrics.collect(key, collect_labeled)
+
+    def __init__(self, listen=None):
+        self.lock = threading.Lock()
+        self.values = {}        # (name, labels) -> value
+        self.histograms = {}    # (name, labels) -> [bucket counts..., sum, count]
+        self.collectors = {}    # key -> function returning [(name, labels, value)]
+        self.server = None
+        if listen:
+            self.server = self._serve(listen)
+
+    @staticmethod
+    def open(listen=None):
+        if not listen:
+            return Metrics()
+        with Metrics._instances_lock:
+            if listen not in Metrics._instances:
+                Metrics._instances[listen] = Metrics(listen)
+            return Metrics._instances[listen]
+
+    def _serve(self, listen):
+        import http.server
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                Logger.debug("metrics: %s - %s" % (self.address_string(), format % args))
+
+        server = http.server.HTTPServer(listen, Handler)
+        start_daemon_thread(server.serve_forever)
+        Logger.info("Metrics are served at http://%s/metrics" % addr_to_str(listen))
+        return server
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        if not self.server:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.server:
+            return
+        with self.lock:
+            self.values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        if not self.server:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def collect(self, key, func):
+        # func() is called on every scrape; a later call with the same key
+        # replaces it, e.g. after natter_main() restarts
+        if not self.server:
+            return
+        with self.lock:
+            self.collectors[key] = func
+
+    def labeled(self, **labels):
+        return Metrics.Labeled(self, labels)
+
+    @staticmethod
+    def _format(name, labels, value):
+        if labels:
+            name += "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\")
+                                                   .replace('"', '\\"').replace("\n", "\\n"))
+                                      for k, v in labels)
+        return "%s %s" % (name, repr(float(value)) if isinstance(value, float) else value)
+
+    def render(self):
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.values.items():
+                samples.setdefault(name, []).append((labels, value))
+            for (name, labels), hist in self.histograms.items():
+                samples.setdefault(name, []).append((labels, list(hist)))
+            collectors = list(self.collectors.values())
+        for func in collectors:
+            try:
+                for name, labels, value in func():
+                    samples.setdefault(name, []).append((self._key(name, labels)[1], value))
+            except Exception as ex:
+                Logger.debug("metrics: collector failed: %s" % ex)
+        lines = []
+        for name in sorted(samples):
+            metric_type, doc = self.TYPES.get(name, ("untyped", ""))
+            lines.append("# HELP %s %s" % (name, doc))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for labels, value in sorted(samples[name]):
+                if metric_type != "histogram":
+                    lines.append(self._format(name, labels, value))
+                    continue
+                # bucket counts are cumulative already
+                for bound, count in zip(self.BUCKETS, value):
+                    lines.append(self._format(name + "_bucket", labels + (("le", repr(float(bound))),), count))
+                lines.append(self._format(name + "_bucket", labels + (("le", "+Inf"),), value[-1]))
+                lines.append(self._format(name + "_sum", labels, value[-2]))
+                lines.append(self._format(name + "_count", labels, value[-1]))
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
 
 
 class PortTest(object):
@@ -218,12 +474,140 @@ class PortTest(object):
             sock.close()
 
 
+class StunHealth(object):
+    # Health of STUN servers: EWMA latency, consecutive failures and the time
+    # of the last success, optionally kept in a JSON file across restarts.
+    # Servers are tried in order of score, the expected seconds to an answer.
+    # Failures add a penalty that fades out, so a server that was down gets
+    # another chance later. Instances are shared per file path.
+    ALPHA = 0.3
+    UNKNOWN_LATENCY = 0.5
+    FAILURE_PENALTY = 3
+    PENALTY_HALF_LIFE = 3600
+    MAX_AGE = 30 * 86400
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.path = path
+        self.table = {}
+        self.dirty = False
+        if path:
+            self.load()
+
+    @staticmethod
+    def open(path=None):
+        with StunHealth._instances_lock:
+            if path not in StunHealth._instances:
+                StunHealth._instances[path] = StunHealth(path)
+            return StunHealth._instances[path]
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                servers = json.load(f)["servers"]
+            for key, entry in servers.items():
+                self.table[key] = {
+                    "latency":      float(entry["latency"]) if entry.get("latency") is not None else None,
+                    "failures":     int(entry.get("failures", 0)),
+                    "last_success": float(entry.get("last_success") or 0),
+                    "last_failure": float(entry.get("last_failure") or 0)
+                }
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as ex:
+            Logger.warning("stun: cannot load STUN server health from %s: %s" % (self.path, ex))
+            self.table = {}
+            return
+        Logger.debug("stun: Loaded health of %d STUN servers from %s" % (len(self.table), self.path))
+
+    def save(self):
+        with self.lock:
+            if not self.path or not self.dirty:
+                return
+            now = time.time()
+            servers = dict(
+                (key, {
+                    "latency":      round(entry["latency"], 6) if entry["latency"] is not None else None,
+                    "failures":     entry["failures"],
+                    "last_success": round(entry["last_success"], 3),
+                    "last_failure": round(entry["last_failure"], 3)
+                }) for key, entry in self.table.items()
+                if now - max(entry["last_success"], entry["last_failure"]) < self.MAX_AGE
+            )
+            self.dirty = False
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"servers": servers}, f, indent=2, sort_keys=True)
+                # the data must be on disk before the rename, or a crash can
+                # leave an empty file in place of the old one
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as ex:
+            Logger.warning("stun: cannot save STUN server health to %s: %s" % (self.path, ex))
+
+    def _entry(self, key):
+        entry = self.table.get(key)
+        if entry is None:
+            entry = self.table[key] = {
+                "latency": None, "failures": 0, "last_success": 0.0, "last_failure": 0.0
+            }
+        return entry
+
+    def success(self, key, latency):
+        with self.lock:
+            entry = self._entry(key)
+            if entry["latency"] is None:
+                entry["latency"] = latency
+            else:
+                entry["latency"] += self.ALPHA * (latency - entry["latency"])
+            entry["failures"] = 0
+            entry["last_success"] = time.time()
+            self.dirty = True
+
+    def failure(self, key):
+        with self.lock:
+            entry = self._entry(key)
+            entry["failures"] += 1
+            entry["last_failure"] = time.time()
+            self.dirty = True
+
+    def score(self, key, now=None):
+        now = now or time.time()
+        with self.lock:
+            entry = self.table.get(key)
+            if entry is None:
+                return self.UNKNOWN_LATENCY
+            score = entry["latency"] if entry["latency"] is not None else self.UNKNOWN_LATENCY
+            if entry["failures"]:
+                fade = 0.5 ** ((now - entry["last_failure"]) / self.PENALTY_HALF_LIFE)
+                score += min(entry["failures"], 5) * self.FAILURE_PENALTY * fade
+            return score
+
+
 class StunClient(object):
+    # Servers are tried in the order of their StunHealth score, and every
+    # answer or failure updates it. With race > 1, up to `race` servers are
+    # queried at once from the same source port, one more every `stagger`
+    # seconds or as soon as one fails. The first valid answer wins and the
+    # other requests are abandoned.
     class ServerUnavailable(Exception):
         pass
 
+    class Attempt(object):
+        def __init__(self, server, addr, sock):
+            self.server = server
+            self.addr = addr
+            self.sock = sock
+            self.txid = None
+            self.connected = False
+            self.start = time.time()
+
     def __init__(self, stun_server_list, source_host="0.0.0.0", source_port=0,
-                 interface=None, udp=False):
+                 interface=None, udp=False, metrics=None, race=1, health=None, stop_event=None):
         if not stun_server_list:
             raise ValueError("STUN server list is empty")
         self.stun_server_list = stun_server_list
@@ -231,23 +615,272 @@ class StunClient(object):
         self.source_port = source_port
         self.interface = interface
         self.udp = udp
+        self.metrics = metrics or Metrics()
+        self.health = health or StunHealth()
+        self.race = race
+        self.stagger = 0.2
+        self.timeout = 3
+        self.stop_event = stop_event    # interrupts waits when set
+
+    def get_mapping(self, once=False):
+        # best scored servers first, the sort is stable for equal scores
+        now = time.time()
+        self.stun_server_list.sort(key=lambda srv: self.health.score(self._health_key(srv), now))
+        try:
+            if self.race > 1:
+                return self._get_mapping_race(once)
+            return self._get_mapping_seq(once)
+        finally:
+            self.health.save()
+
+    def _health_key(self, server):
+        return addr_to_uri(server, udp=self.udp)
 
-    def get_mapping(self):
+    def _get_mapping_seq(self, once):
         first = self.stun_server_list[0]
         while True:
             if self.source_port:
                 set_reuse_port(self.source_port)
+            server = addr_to_str(self.stun_server_list[0])
+            ts = time.time()
             try:
-                return self._get_mapping()
+                ret = self._get_mapping()
+                self.metrics.observe("natter_stun_latency_seconds", time.time() - ts, server=server)
+                self.health.success(self._health_key(self.stun_server_list[0]), time.time() - ts)
+                return ret
             except StunClient.ServerUnavailable as ex:
                 Logger.warning("stun: STUN server %s is unavailable: %s" % (
                     addr_to_uri(self.stun_server_list[0], udp = self.udp), ex
                 ))
+                self.metrics.inc("natter_stun_failovers_total", server=server)
+                self.health.failure(self._health_key(self.stun_server_list[0]))
                 self.stun_server_list.append(self.stun_server_list.pop(0))
                 if self.stun_server_list[0] == first:
+                    self.metrics.inc("natter_stun_unavailable_total")
+                    if once:
+                        raise
                     Logger.error("stun: No STUN server is available right now")
                     # force sleep for 10 seconds, then try the next loop
-                    time.sleep(10)
+                    self._sleep(10)
+
+    def _get_mapping_race(self, once):
+        failed = []
+        while True:
+            if self.source_port:
+                set_reuse_port(self.source_port)
+            servers = [srv for srv in self.stun_server_list if srv not in failed]
+            winner, inner_addr, outer_addr, failures = self._race(servers)
+            for server, ex in failures:
+                Logger.warning("stun: STUN server %s is unavailable: %s" % (
+                    addr_to_uri(server, udp = self.udp), ex
+                ))
+                self.metrics.inc("natter_stun_failovers_total", server=addr_to_str(server))
+                self.health.failure(self._health_key(server))
+                self.stun_server_list.remove(server)
+                self.stun_server_list.append(server)
+                failed.append(server)
+            if winner:
+                # the fastest server is asked first next time
+                self.stun_server_list.remove(winner)
+                self.stun_server_list.insert(0, winner)
+                return inner_addr, outer_addr
+            self.metrics.inc("natter_stun_unavailable_total")
+            if once:
+                raise StunClient.ServerUnavailable(failures[-1][1] if failures else "no answer")
+            Logger.error("stun: No STUN server is available right now")
+            # force sleep for 10 seconds, then try the next loop
+            self._sleep(10)
+            failed = []
+
+    def _sleep(self, seconds):
+        if self.stop_event is None:
+            time.sleep(seconds)
+        elif self.stop_event.wait(seconds):
+            raise NatterExitException("Natter is stopped")
+
+    def _race(self, servers):
+        # returns (winner, inner_addr, outer_addr, failures), winner is None
+        # when every server failed
+        sel = selectors.DefaultSelector()
+        queue = list(servers)
+        attempts = []
+        failures = []
+        udp_sock = None
+        next_start = time.time()
+
+        def fail(attempt, ex):
+            attempts.remove(attempt)
+            failures.append((attempt.server, ex))
+            if not self.udp:
+                sel.unregister(attempt.sock)
+                attempt.sock.close()
+
+        try:
+            if self.udp:
+                udp_sock = self._new_socket()
+                udp_sock.setblocking(False)
+                sel.register(udp_sock, selectors.EVENT_READ)
+            while queue or attempts:
+                if self.stop_event is not None and self.stop_event.is_set():
+                    raise NatterExitException("Natter is stopped")
+                now = time.time()
+                # start the next server when it is time, or when nothing is pending
+                can_start = queue and len(attempts) < self.race
+                if can_start and (now >= next_start or not attempts):
+                    server = queue.pop(0)
+                    try:
+                        attempts.append(self._race_start(sel, server, udp_sock))
+                        next_start = now + self.stagger
+                    except (OSError, ValueError, socket.error) as ex:
+                        failures.append((server, ex))
+                    continue
+                deadlines = [a.start + self.timeout for a in attempts]
+                if can_start:
+                    deadlines.append(next_start)
+                if self.stop_event is not None:
+                    deadlines.append(now + 0.2)
+                for key, _ in sel.select(max(0, min(deadlines) - now)):
+                    if self.udp:
+                        ret = self._race_recv_udp(udp_sock, attempts)
+                    else:
+                        ret = self._race_step_tcp(sel, key.data, fail)
+                    if ret:
+                        attempt, outer_addr = ret
+                        if self.udp:
+                            inner_addr = self._local_addr(udp_sock, attempt.addr)
+                        else:
+                            inner_addr = attempt.sock.getsockname()
+                        self.source_host, self.source_port = inner_addr
+                        self.metrics.observe("natter_stun_latency_seconds", time.time() - attempt.start,
+                                             server=addr_to_str(attempt.server))
+                        self.health.success(self._health_key(attempt.server), time.time() - attempt.start)
+                        Logger.debug("stun: Got address %s from %s, source %s (racing %d servers)" % (
+                            addr_to_uri(outer_addr, udp=self.udp),
+                            addr_to_uri(attempt.server, udp=self.udp),
+                            addr_to_uri(inner_addr, udp=self.udp),
+                            len(attempts)
+                        ))
+                        return attempt.server, inner_addr, outer_addr, failures
+                now = time.time()
+                for attempt in list(attempts):
+                    if now >= attempt.start + self.timeout:
+                        fail(attempt, socket.timeout("timed out"))
+                        next_start = now
+            return None, None, None, failures
+        finally:
+            for attempt in attempts:
+                if attempt.sock is not udp_sock:
+                    attempt.sock.close()
+            if udp_sock:
+                udp_sock.close()
+            sel.close()
+
+    def _new_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM if self.udp else socket.SOCK_STREAM)
+        try:
+            socket_set_opt(
+                sock,
+                reuse       = True,
+                bind_addr   = (self.source_host, self.source_port),
+                interface   = self.interface
+            )
+        except Exception:
+            sock.close()
+            raise
+        # all racing requests share the source port
+        self.source_port = sock.getsockname()[1]
+        return sock
+
+    def _race_start(self, sel, server, udp_sock):
+        addr = socket.gethostbyname(server[0]), server[1]
+        if udp_sock:
+            attempt = StunClient.Attempt(server, addr, udp_sock)
+            attempt.txid, request = self._stun_request()
+            udp_sock.sendto(request, addr)
+            return attempt
+        sock = self._new_socket()
+        sock.setblocking(False)
+        err = sock.connect_ex(addr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY,
+                       getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)):
+            sock.close()
+            raise OSError(err, os.strerror(err))
+        attempt = StunClient.Attempt(server, addr, sock)
+        sel.register(sock, selectors.EVENT_WRITE, attempt)
+        return attempt
+
+    def _race_recv_udp(self, sock, attempts):
+        while True:
+            try:
+                buff, addr = sock.recvfrom(1500)
+            except (BlockingIOError, InterruptedError):
+                return None
+            except (OSError, socket.error):
+                # e.g. ICMP errors reported on Windows, the server times out
+                continue
+            for attempt in attempts:
+                if attempt.addr == addr:
+                    try:
+                        return attempt, self._stun_parse(buff, attempt.txid)
+                    except (ValueError, struct.error):
+                        pass
+
+    def _race_step_tcp(self, sel, attempt, fail):
+        try:
+            if not attempt.connected:
+                err = attempt.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    raise OSError(err, os.strerror(err))
+                attempt.connected = True
+                attempt.txid, request = self._stun_request()
+                attempt.sock.send(request)
+                sel.modify(attempt.sock, selectors.EVENT_READ, attempt)
+                return None
+            buff = attempt.sock.recv(1500)
+            return attempt, self._stun_parse(buff, attempt.txid)
+        except (BlockingIOError, InterruptedError):
+            return None
+        except (OSError, ValueError, struct.error, socket.error) as ex:
+            fail(attempt, ex)
+            return None
+
+    def _local_addr(self, sock, remote_addr):
+        # an unconnected UDP socket bound to 0.0.0.0 does not know its local
+        # IP, ask the routing table through a connected probe socket
+        host, port = sock.getsockname()
+        if host != "0.0.0.0":
+            return host, port
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            socket_set_opt(probe, interface=self.interface)
+            probe.connect(remote_addr)
+            return probe.getsockname()[0], port
+        finally:
+            probe.close()
+
+    @staticmethod
+    def _stun_request():
+        txid = struct.pack("!LLL", 0x4e415452, random.getrandbits(32), random.getrandbits(32))
+        return txid, struct.pack("!LL", 0x00010000, 0x2112a442) + txid
+
+    @staticmethod
+    def _stun_parse(buff, txid=None):
+        if txid is not None and buff[8:20] != txid:
+            raise ValueError("Unexpected STUN transaction")
+        ip = port = 0
+        payload = buff[20:]
+        while payload:
+            attr_type, attr_len = struct.unpack("!HH", payload[:4])
+            if attr_type in [1, 32]:
+                _, _, port, ip = struct.unpack("!BBHL", payload[4:4+attr_len])
+                if attr_type == 32:
+                    port ^= 0x2112
+                    ip ^= 0x2112a442
+                break
+            payload = payload[4 + attr_len:]
+        else:
+            raise ValueError("Invalid STUN response")
+        return socket.inet_ntop(socket.AF_INET, struct.pack("!L", ip)), port
 
     def _get_mapping(self):
         # ref: https://www.rfc-editor.org/rfc/rfc5389
@@ -260,30 +893,14 @@ class StunClient(object):
                 reuse       = True,
                 bind_addr   = (self.source_host, self.source_port),
                 interface   = self.interface,
-                timeout     = 3
+                timeout     = self.timeout
             )
-            sock.connect((stun_host, stun_port))
+            socket_connect(sock, (stun_host, stun_port), self.timeout, self.stop_event)
             inner_addr = sock.getsockname()
             self.source_host, self.source_port = inner_addr
-            sock.send(struct.pack(
-                "!LLLLL", 0x00010000, 0x2112a442, 0x4e415452,
-                random.getrandbits(32), random.getrandbits(32)
-            ))
-            buff = sock.recv(1500)
-            ip = port = 0
-            payload = buff[20:]
-            while payload:
-                attr_type, attr_len = struct.unpack("!HH", payload[:4])
-                if attr_type in [1, 32]:
-                    _, _, port, ip = struct.unpack("!BBHL", payload[4:4+attr_len])
-                    if attr_type == 32:
-                        port ^= 0x2112
-                        ip ^= 0x2112a442
-                    break
-                payload = payload[4 + attr_len:]
-            else:
-                raise ValueError("Invalid STUN response")
-            outer_addr = socket.inet_ntop(socket.AF_INET, struct.pack("!L", ip)), port
+            sock.send(self._stun_request()[1])
+            buff = socket_recv(sock, 1500, self.timeout, self.stop_event)
+            outer_addr = self._stun_parse(buff)
             Logger.debug("stun: Got address %s from %s, source %s" % (
                 addr_to_uri(outer_addr, udp=self.udp),
                 addr_to_uri((stun_host, stun_port), udp=self.udp),
@@ -297,7 +914,8 @@ class StunClient(object):
 
 
 class KeepAlive(object):
-    def __init__(self, host, port, source_host, source_port, interface=None, udp=False):
+    def __init__(self, host, port, source_host, source_port, interface=None, udp=False,
+                 stop_event=None):
         self.sock = None
         self.host = host
         self.port = port
@@ -306,6 +924,9 @@ class KeepAlive(object):
         self.interface = interface
         self.udp = udp
         self.reconn = False
+        self.rtt = None     # seconds until the first response of the last keep-alive
+        self.timeout = 3
+        self.stop_event = stop_event    # interrupts waits when set
 
     def __del__(self):
         if self.sock:
@@ -319,10 +940,9 @@ class KeepAlive(object):
                 self.sock,
                 reuse       = True,
                 bind_addr   = (self.source_host, self.source_port),
-                interface   = self.interface,
-                timeout     = 3
+                interface   = self.interface
             )
-            self.sock.connect((self.host, self.port))
+            socket_connect(self.sock, (self.host, self.port), self.timeout, self.stop_event)
             if not self.udp:
                 Logger.debug("keep-alive: Connected to host %s" % (
                     addr_to_uri((self.host, self.port), udp=self.udp)
@@ -360,12 +980,16 @@ class KeepAlive(object):
             "Connection: keep-alive\r\n"
             "\r\n" % self.host
         ).encode())
+        ts = time.time()
+        self.rtt = None
         buff = b""
         try:
             while True:
-                buff = self.sock.recv(4096)
+                buff = socket_recv(self.sock, 4096, self.timeout, self.stop_event)
                 if not buff:
                     raise OSError("Keep-alive server closed connection")
+                if self.rtt is None:
+                    self.rtt = time.time() - ts
         except socket.timeout as ex:
             if not buff:
                 raise ex
@@ -378,12 +1002,16 @@ class KeepAlive(object):
                 "!HHHHHH", random.getrandbits(16), 0x0100, 0x0001, 0x0000, 0x0000, 0x0000
             ) + b"\x09keepalive\x06natter\x00" + struct.pack("!HH", 0x0001, 0x0001)
         )
+        ts = time.time()
+        self.rtt = None
         buff = b""
         try:
             while True:
-                buff = self.sock.recv(1500)
+                buff = socket_recv(self.sock, 1500, self.timeout, self.stop_event)
                 if not buff:
                     raise OSError("Keep-alive server closed connection")
+                if self.rtt is None:
+                    self.rtt = time.time() - ts
         except socket.timeout as ex:
             if not buff:
                 raise ex
@@ -405,7 +1033,7 @@ class ForwardNone(object):
 class ForwardTestServer(object):
     def __init__(self):
         self.sock = None
-        self.buff_size = 8192
+        self.buff = bytearray(8192)
         self.timeout = 3
 
     def __del__(self):
@@ -446,7 +1074,7 @@ class ForwardTestServer(object):
                 return
             try:
                 conn.settimeout(self.timeout)
-                conn.recv(self.buff_size)
+                conn.recv_into(self.buff)
                 content = "<html><body><h1>It works!</h1><hr/>Natter</body></html>"
                 content_len = len(content.encode())
                 data = (
@@ -468,7 +1096,7 @@ class ForwardTestServer(object):
     def _test_server_run_udp(self):
         while self.sock and self.sock.fileno() != -1:
             try:
-                msg, addr = self.sock.recvfrom(self.buff_size)
+                _, addr = self.sock.recvfrom_into(self.buff)
                 Logger.debug("fwd-test: got client %s" % (addr,))
                 self.sock.sendto(b"It works! - Natter\r\n", addr)
             except (OSError, socket.error):
@@ -860,9 +1488,9 @@ class ForwardGost(object):
             raise
 
     def stop_forward(self):
-        Logger.debug("fwd-gost: Stopping gost")
-        if self.proc and self.proc.poll() is not None:
+        if not self.proc or self.proc.poll() is not None:
             return
+        Logger.debug("fwd-gost: Stopping gost")
         self.proc.terminate()
         self.proc.wait()
         self.proc = None
@@ -920,22 +1548,129 @@ class ForwardSocat(object):
             raise
 
     def stop_forward(self):
-        Logger.debug("fwd-socat: Stopping socat")
-        if self.proc and self.proc.poll() is not None:
+        if not self.proc or self.proc.poll() is not None:
             return
+        Logger.debug("fwd-socat: Stopping socat")
         self.proc.terminate()
         self.proc.wait()
         self.proc = None
 
 
+class ForwardStats(object):
+    # Traffic counters of a socket forwarder. A connection (or UDP session)
+    # record is only written by the thread relaying it; totals are summed up
+    # when queried, so counting costs no locking on the hot path.
+    # "in" is client -> target, "out" is target -> client.
+    class Conn(object):
+        def __init__(self, addr):
+            self.addr = addr
+            self.start = time.time()
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.packets_in = 0
+            self.packets_out = 0
+
+        def add(self, inbound, nbytes, npackets=1):
+            if inbound:
+                self.bytes_in += nbytes
+                self.packets_in += npackets
+            else:
+                self.bytes_out += nbytes
+                self.packets_out += npackets
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = set()
+        self.closed = {"bytes_in": 0, "bytes_out": 0, "packets_in": 0, "packets_out": 0}
+        self.conn_total = 0
+        self.conn_errors = 0
+        self.duration_total = 0.0
+        self.duration_max = 0.0
+
+    def open(self, addr):
+        conn = ForwardStats.Conn(addr)
+        with self.lock:
+            self.active.add(conn)
+            self.conn_total += 1
+        return conn
+
+    def close(self, conn, error=False):
+        with self.lock:
+            if conn not in self.active:
+                return
+            self.active.remove(conn)
+            for k in self.closed:
+                self.closed[k] += getattr(conn, k)
+            duration = time.time() - conn.start
+            self.duration_total += duration
+            self.duration_max = max(self.duration_max, duration)
+            if error:
+                self.conn_errors += 1
+
+    def get(self, connections=False):
+        now = time.time()
+        with self.lock:
+            stats = dict(self.closed)
+            for conn in self.active:
+                for k in self.closed:
+                    stats[k] += getattr(conn, k)
+            conn_closed = self.conn_total - len(self.active)
+            stats.update({
+                "conn_active":      len(self.active),
+                "conn_total":       self.conn_total,
+                "conn_errors":      self.conn_errors,
+                "duration_avg":     self.duration_total / conn_closed if conn_closed else 0.0,
+                "duration_max":     self.duration_max
+            })
+            if connections:
+                stats["connections"] = [{
+                    "addr":         addr_to_str(conn.addr),
+                    "duration":     now - conn.start,
+                    "bytes_in":     conn.bytes_in,
+                    "bytes_out":    conn.bytes_out,
+                    "packets_in":   conn.packets_in,
+                    "packets_out":  conn.packets_out
+                } for conn in self.active]
+        return stats
+
+    def summary(self):
+        stats = self.get()
+        return (
+            "%d active, %d total, %d errors, in %d bytes/%d packets, "
+            "out %d bytes/%d packets, avg duration %.1fs" % (
+                stats["conn_active"], stats["conn_total"], stats["conn_errors"],
+                stats["bytes_in"], stats["packets_in"],
+                stats["bytes_out"], stats["packets_out"], stats["duration_avg"]
+            )
+        )
+
+
 class ForwardSocket(object):
+    class TCPPair(object):
+        # both directions of one relayed TCP connection, the sockets are
+        # closed once both directions have ended
+        def __init__(self, sock_inbound, sock_outbound, conn):
+            self.socks = (sock_inbound, sock_outbound)
+            self.conn = conn
+            self.lock = threading.Lock()
+            self.open = 2
+            self.closed = False
+
     def __init__(self):
         self.sock = None
         self.sock_type = None
         self.outbound_addr = None
-        self.buff_size = 8192
+        self.tcp_buff_size = 65536
+        self.udp_buff_size = 8192
         self.udp_timeout = 60
+        self.connect_timeout = 3
+        self.backlog = socket.SOMAXCONN
         self.max_threads = 128
+        self.stats = ForwardStats()
+        self.stats_interval = 60
+        # seconds to watch the relay thread for an early failure on start
+        self.start_wait = 1
+        self.thread = None
 
     def __del__(self):
         self.stop_forward()
@@ -958,100 +1693,182 @@ class ForwardSocket(object):
                 addr_to_uri((toip, toport), udp=udp)
             ))
             if udp:
-                th = start_daemon_thread(self._socket_udp_recvfrom)
+                self.thread = start_daemon_thread(self._socket_udp_recvfrom)
             else:
-                th = start_daemon_thread(self._socket_tcp_listen)
-            time.sleep(1)
-            if not th.is_alive():
+                self.thread = start_daemon_thread(self._socket_tcp_listen)
+            time.sleep(self.start_wait)
+            if not self.thread.is_alive():
                 raise OSError("Socket thread exited too quickly")
         except Exception:
             self.sock.close()
             self.sock = None
             self.sock_type = None
             raise
+        start_daemon_thread(self._socket_stats_report, args=(self.sock,))
+
+    def _socket_stats_report(self, sock):
+        while True:
+            time.sleep(self.stats_interval)
+            if self.sock is not sock:
+                return
+            Logger.debug("fwd-socket: stats: %s" % self.stats.summary())
+
+    def get_stats(self, connections=False):
+        return self.stats.get(connections)
 
     def _socket_tcp_listen(self):
-        self.sock.listen(5)
+        # keep a reference: stop_forward() resets self.sock from another thread
+        sock = self.sock
+        sock.listen(self.backlog)
         while True:
             try:
-                sock_inbound, _ = self.sock.accept()
+                sock_inbound, addr = sock.accept()
             except (OSError, socket.error) as ex:
                 if not closed_socket_ex(ex):
                     Logger.error("fwd-socket: socket listening thread is exiting: %s" % ex)
                 return
-            sock_outbound = socket.socket(socket.AF_INET, self.sock_type)
+            conn = self.stats.open(addr)
+            # outbound connection is set up by the forwarding thread, so that
+            # a slow target never blocks accepting the next client
             try:
-                sock_outbound.settimeout(3)
-                sock_outbound.connect(self.outbound_addr)
-                sock_outbound.settimeout(None)
                 if threading.active_count() >= self.max_threads:
                     raise OSError("Too many threads")
-                start_daemon_thread(self._socket_tcp_forward, args=(sock_inbound, sock_outbound))
-                start_daemon_thread(self._socket_tcp_forward, args=(sock_outbound, sock_inbound))
+                start_daemon_thread(self._socket_tcp_connect, args=(sock_inbound, conn))
             except (OSError, socket.error) as ex:
                 Logger.error("fwd-socket: cannot forward port: %s" % ex)
                 sock_inbound.close()
-                sock_outbound.close()
+                self.stats.close(conn, error=True)
                 continue
 
-    def _socket_tcp_forward(self, sock_to_recv, sock_to_send):
+    def _socket_tcp_connect(self, sock_inbound, conn):
+        sock_outbound = socket.socket(socket.AF_INET, self.sock_type)
+        try:
+            sock_outbound.settimeout(self.connect_timeout)
+            sock_outbound.connect(self.outbound_addr)
+            sock_outbound.settimeout(None)
+            pair = ForwardSocket.TCPPair(sock_inbound, sock_outbound, conn)
+            start_daemon_thread(
+                self._socket_tcp_forward, args=(sock_outbound, sock_inbound, pair, False)
+            )
+        except (OSError, socket.error) as ex:
+            Logger.error("fwd-socket: cannot forward port: %s" % ex)
+            sock_inbound.close()
+            sock_outbound.close()
+            self.stats.close(conn, error=True)
+            return
+        self._socket_tcp_forward(sock_inbound, sock_outbound, pair, True)
+
+    def _socket_tcp_forward(self, sock_to_recv, sock_to_send, pair, inbound):
+        buff = bytearray(self.tcp_buff_size)
+        view = memoryview(buff)
         try:
             while sock_to_recv.fileno() != -1:
-                buff = sock_to_recv.recv(self.buff_size)
-                if buff and sock_to_send.fileno() != -1:
-                    sock_to_send.sendall(buff)
+                n = sock_to_recv.recv_into(buff)
+                if n and sock_to_send.fileno() != -1:
+                    sock_to_send.sendall(view[:n])
+                    pair.conn.add(inbound, n)
                 else:
-                    sock_to_recv.close()
-                    sock_to_send.close()
+                    self._socket_tcp_eof(pair, sock_to_send)
                     return
         except (OSError, socket.error) as ex:
-            if not closed_socket_ex(ex):
+            error = not closed_socket_ex(ex)
+            if isinstance(ex, (ConnectionResetError, BrokenPipeError)):
+                # a peer resetting the connection is common, it is counted
+                # as an error but not worth an error message
+                Logger.debug("fwd-socket: connection reset: %s" % ex)
+            elif error:
                 Logger.error("fwd-socket: socket forwarding thread is exiting: %s" % ex)
-            sock_to_recv.close()
-            sock_to_send.close()
+            self._socket_tcp_close(pair, error)
             return
 
+    def _socket_tcp_eof(self, pair, sock_to_send):
+        # pass the half-close on, the other direction keeps running until
+        # it sees EOF as well
+        with pair.lock:
+            if pair.closed:
+                return
+            pair.open -= 1
+            last = pair.open == 0
+            if not last:
+                try:
+                    sock_to_send.shutdown(socket.SHUT_WR)
+                except (OSError, socket.error):
+                    pass
+        if last:
+            self._socket_tcp_close(pair)
+
+    def _socket_tcp_close(self, pair, error=False):
+        # close() does not wake up the peer thread blocked in recv() on the
+        # other socket, and the connection stays open until it returns;
+        # shutdown() does.
+        with pair.lock:
+            if pair.closed:
+                return
+            pair.closed = True
+        for sock in pair.socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            sock.close()
+        self.stats.close(pair.conn, error)
+
     def _socket_udp_recvfrom(self):
+        sock = self.sock
         outbound_socks = {}
+        buff = bytearray(self.udp_buff_size)
+        view = memoryview(buff)
         while True:
             try:
-                buff, addr = self.sock.recvfrom(self.buff_size)
-                s = outbound_socks.get(addr)
+                n, addr = sock.recvfrom_into(buff)
+                session = outbound_socks.get(addr)
             except (OSError, socket.error) as ex:
                 if not closed_socket_ex(ex):
                     Logger.error("fwd-socket: socket recvfrom thread is exiting: %s" % ex)
                 return
             try:
-                if not s:
-                    s = outbound_socks[addr] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                if not session:
+                    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    session = outbound_socks[addr] = s, self.stats.open(addr)
                     s.settimeout(self.udp_timeout)
                     s.connect(self.outbound_addr)
                     if threading.active_count() >= self.max_threads:
                         raise OSError("Too many threads")
-                    start_daemon_thread(self._socket_udp_send, args=(self.sock, s, addr))
-                if buff:
-                    s.send(buff)
+                    start_daemon_thread(self._socket_udp_send, args=(sock, s, addr, session[1]))
+                s, conn = session
+                if n:
+                    s.send(view[:n])
+                    conn.add(True, n)
                 else:
                     s.close()
                     del outbound_socks[addr]
+                    self.stats.close(conn)
             except (OSError, socket.error):
                 if addr in outbound_socks:
-                    outbound_socks[addr].close()
-                    del outbound_socks[addr]
+                    s, conn = outbound_socks.pop(addr)
+                    s.close()
+                    self.stats.close(conn)
                 continue
 
-    def _socket_udp_send(self, server_sock, outbound_sock, client_addr):
+    def _socket_udp_send(self, server_sock, outbound_sock, client_addr, conn):
+        buff = bytearray(self.udp_buff_size)
+        view = memoryview(buff)
         try:
             while outbound_sock.fileno() != -1:
-                buff = outbound_sock.recv(self.buff_size)
-                if buff:
-                    server_sock.sendto(buff, client_addr)
+                n = outbound_sock.recv_into(buff)
+                if n:
+                    server_sock.sendto(view[:n], client_addr)
+                    conn.add(False, n)
                 else:
                     outbound_sock.close()
         except (OSError, socket.error) as ex:
             if not closed_socket_ex(ex):
                 Logger.error("fwd-socket: socket send thread is exiting: %s" % ex)
             outbound_sock.close()
+            # idle timeout is the normal end of a UDP session
+            self.stats.close(conn, error=not (
+                closed_socket_ex(ex) or isinstance(ex, socket.timeout)
+            ))
             return
 
     def stop_forward(self):
@@ -1062,6 +1879,789 @@ class ForwardSocket(object):
             self.sock_type = None
 
 
+class ForwardSocketSelect(ForwardSocket):
+    # Single-threaded relay: all TCP connections or UDP sessions are
+    # multiplexed on one selector (epoll/kqueue/select) with non-blocking
+    # sockets.
+    class Channel(object):
+        def __init__(self, sock, conn, inbound, connecting=False):
+            self.sock = sock
+            self.conn = conn
+            self.inbound = inbound
+            self.peer = None
+            self.buff = b""     # pending data to be sent to this socket
+            self.eof = False    # no more data can be read from this socket
+            self.connecting = connecting
+            self.since = time.time()
+            self.events = 0
+
+    class Session(object):
+        def __init__(self, sock, client_addr, conn):
+            self.sock = sock
+            self.client_addr = client_addr
+            self.conn = conn
+            self.last_active = time.time()
+
+    def __init__(self):
+        super().__init__()
+        # datagrams relayed per readiness event, so that one busy direction
+        # cannot starve the others
+        self.udp_burst = 64
+
+    def _socket_tcp_listen(self):
+        lsock = self.sock
+        lsock.listen(self.backlog)
+        lsock.setblocking(False)
+        sel = selectors.DefaultSelector()
+        sel.register(lsock, selectors.EVENT_READ)
+        # one read buffer is shared by all connections, only data that cannot
+        # be sent right away is copied out of it
+        view = memoryview(bytearray(self.tcp_buff_size))
+        # inbound channels of all open connections; a channel waiting for
+        # the peer's EOF has no events and is not in the selector
+        pairs = set()
+        last_sweep = time.time()
+        try:
+            while lsock.fileno() != -1:
+                for key, mask in sel.select(timeout=1):
+                    if key.fileobj is lsock:
+                        self._select_tcp_accept(sel, pairs, lsock)
+                    else:
+                        self._select_tcp_event(sel, pairs, key.data, mask, view)
+                now = time.time()
+                if now - last_sweep >= 1:
+                    last_sweep = now
+                    self._select_tcp_sweep(sel, pairs, now)
+        except (OSError, socket.error) as ex:
+            if lsock.fileno() != -1 and not closed_socket_ex(ex):
+                Logger.error("fwd-socket: socket selector thread is exiting: %s" % ex)
+        finally:
+            for chan in list(pairs):
+                self._select_close(sel, pairs, chan)
+            sel.close()
+
+    def _select_tcp_accept(self, sel, pairs, lsock):
+        while True:
+            try:
+                sock_inbound, addr = lsock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            conn = self.stats.open(addr)
+            sock_inbound.setblocking(False)
+            sock_outbound = socket.socket(socket.AF_INET, self.sock_type)
+            sock_outbound.setblocking(False)
+            err = sock_outbound.connect_ex(self.outbound_addr)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                Logger.error("fwd-socket: cannot forward port: %s" % os.strerror(err))
+                sock_inbound.close()
+                sock_outbound.close()
+                self.stats.close(conn, error=True)
+                continue
+            chan_in = ForwardSocketSelect.Channel(sock_inbound, conn, True)
+            chan_out = ForwardSocketSelect.Channel(sock_outbound, conn, False, connecting=True)
+            chan_in.peer, chan_out.peer = chan_out, chan_in
+            pairs.add(chan_in)
+            self._select_update(sel, chan_in)
+            self._select_update(sel, chan_out)
+
+    def _select_tcp_sweep(self, sel, pairs, now):
+        # give up outbound connections that are pending for too long
+        for chan in list(pairs):
+            if chan.peer.connecting and now - chan.peer.since > self.connect_timeout:
+                Logger.error("fwd-socket: cannot forward port: connect timed out")
+                self._select_close(sel, pairs, chan, error=True)
+
+    def _select_tcp_event(self, sel, pairs, chan, mask, view):
+        peer = chan.peer
+        try:
+            if chan.connecting:
+                err = chan.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    raise OSError(err, os.strerror(err))
+                chan.connecting = False
+            elif mask & selectors.EVENT_WRITE and chan.buff:
+                n = chan.sock.send(chan.buff)
+                chan.buff = chan.buff[n:]
+            if mask & selectors.EVENT_READ:
+                nbytes = chan.sock.recv_into(view)
+                if nbytes:
+                    chan.conn.add(chan.inbound, nbytes)
+                    try:
+                        n = peer.sock.send(view[:nbytes])
+                    except (BlockingIOError, InterruptedError):
+                        n = 0
+                    if n < nbytes:
+                        peer.buff = memoryview(view[n:nbytes].tobytes())
+                else:
+                    # half-close: nothing is pending for the peer at this point,
+                    # since we never read while the peer has buffered data
+                    chan.eof = True
+                    peer.sock.shutdown(socket.SHUT_WR)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except (OSError, socket.error) as ex:
+            error = not closed_socket_ex(ex)
+            if isinstance(ex, (ConnectionResetError, BrokenPipeError)):
+                Logger.debug("fwd-socket: connection reset: %s" % ex)
+            elif error:
+                Logger.error("fwd-socket: cannot forward port: %s" % ex)
+            self._select_close(sel, pairs, chan, error)
+            return
+        if chan.eof and peer.eof:
+            self._select_close(sel, pairs, chan)
+            return
+        self._select_update(sel, chan)
+        self._select_update(sel, peer)
+
+    def _select_update(self, sel, chan):
+        events = 0
+        if not (chan.eof or chan.connecting or chan.peer.connecting or chan.peer.buff):
+            events |= selectors.EVENT_READ
+        if chan.connecting or chan.buff:
+            events |= selectors.EVENT_WRITE
+        if events == chan.events:
+            return
+        if not chan.events:
+            sel.register(chan.sock, events, chan)
+        elif not events:
+            sel.unregister(chan.sock)
+        else:
+            sel.modify(chan.sock, events, chan)
+        chan.events = events
+
+    def _select_close(self, sel, pairs, chan, error=False):
+        pairs.discard(chan if chan.inbound else chan.peer)
+        for c in (chan, chan.peer):
+            if c.events:
+                sel.unregister(c.sock)
+                c.events = 0
+            c.sock.close()
+        self.stats.close(chan.conn, error)
+
+    def _socket_udp_recvfrom(self):
+        lsock = self.sock
+        lsock.setblocking(False)
+        sel = selectors.DefaultSelector()
+        sel.register(lsock, selectors.EVENT_READ)
+        # one receive buffer is shared by all sessions
+        buff = bytearray(self.udp_buff_size)
+        view = memoryview(buff)
+        sessions = {}
+        last_sweep = time.time()
+        try:
+            while lsock.fileno() != -1:
+                events = sel.select(timeout=1)
+                # one clock read per round is precise enough for idle timeouts
+                now = time.time()
+                for key, _ in events:
+                    if key.fileobj is lsock:
+                        self._select_udp_inbound(sel, lsock, sessions, buff, view, now)
+                    else:
+                        self._select_udp_outbound(sel, lsock, sessions, key.data, buff, view, now)
+                if now - last_sweep >= 1:
+                    last_sweep = now
+                    for session in list(sessions.values()):
+                        if now - session.last_active > self.udp_timeout:
+                            self._select_udp_close(sel, sessions, session)
+        except (OSError, socket.error) as ex:
+            if lsock.fileno() != -1 and not closed_socket_ex(ex):
+                Logger.error("fwd-socket: socket selector thread is exiting: %s" % ex)
+        finally:
+            for session in list(sessions.values()):
+                session.sock.close()
+                self.stats.close(session.conn)
+            sel.close()
+
+    def _select_udp_inbound(self, sel, lsock, sessions, buff, view, now):
+        for _ in range(self.udp_burst):
+            try:
+                n, addr = lsock.recvfrom_into(buff)
+            except (BlockingIOError, InterruptedError):
+                return
+            session = sessions.get(addr)
+            if not n:
+                # an empty datagram ends the session
+                if session:
+                    self._select_udp_close(sel, sessions, session)
+                continue
+            if not session:
+                session = self._select_udp_open(sel, sessions, addr)
+                if not session:
+                    continue
+            try:
+                session.sock.send(view[:n])
+                session.last_active = now
+                session.conn.add(True, n)
+            except (BlockingIOError, InterruptedError):
+                # outbound buffer is full, drop the datagram
+                continue
+            except (OSError, socket.error):
+                self._select_udp_close(sel, sessions, session)
+
+    def _select_udp_open(self, sel, sessions, addr):
+        # the session is only stored once its socket is connected
+        s = None
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setblocking(False)
+            s.connect(self.outbound_addr)
+        except (OSError, socket.error) as ex:
+            Logger.error("fwd-socket: cannot forward port: %s" % ex)
+            if s:
+                s.close()
+            return None
+        session = sessions[addr] = ForwardSocketSelect.Session(s, addr, self.stats.open(addr))
+        sel.register(s, selectors.EVENT_READ, session)
+        return session
+
+    def _select_udp_outbound(self, sel, lsock, sessions, session, buff, view, now):
+        for _ in range(self.udp_burst):
+            try:
+                n = session.sock.recv_into(buff)
+            except (BlockingIOError, InterruptedError):
+                return
+            except (OSError, socket.error) as ex:
+                error = not closed_socket_ex(ex)
+                if error:
+                    Logger.debug("fwd-socket: closing UDP session %s: %s" % (
+                        addr_to_str(session.client_addr), ex
+                    ))
+                self._select_udp_close(sel, sessions, session, error)
+                return
+            session.last_active = now
+            session.conn.add(False, n)
+            try:
+                lsock.sendto(view[:n], session.client_addr)
+            except (BlockingIOError, InterruptedError):
+                # client side buffer is full, drop the datagram
+                continue
+            except (OSError, socket.error) as ex:
+                Logger.debug("fwd-socket: cannot send to UDP client %s: %s" % (
+                    addr_to_str(session.client_addr), ex
+                ))
+
+    def _select_udp_close(self, sel, sessions, session, error=False):
+        if sessions.get(session.client_addr) is session:
+            del sessions[session.client_addr]
+            try:
+                sel.unregister(session.sock)
+            except (KeyError, ValueError):
+                pass
+        session.sock.close()
+        self.stats.close(session.conn, error)
+
+
+class ForwardSocketSplice(ForwardSocket):
+    # Zero-copy relay on Linux: data goes socket -> pipe -> socket via
+    # splice(2) and never enters userspace. Falls back to the copy loop
+    # when splice is not available.
+    F_SETPIPE_SZ = 1031
+    F_GETPIPE_SZ = 1032
+
+    def __init__(self):
+        super().__init__()
+        # the default pipe holds 64 KiB, which makes splice move no more
+        # per call than the copy loop; the kernel caps the size at
+        # /proc/sys/fs/pipe-max-size for unprivileged users
+        self.pipe_size = 1048576
+
+    def _open_pipe(self):
+        import fcntl
+        pipe_r, pipe_w = os.pipe()
+        try:
+            fcntl.fcntl(pipe_w, ForwardSocketSplice.F_SETPIPE_SZ, self.pipe_size)
+        except OSError as ex:
+            Logger.debug("fwd-socket: cannot resize pipe to %d bytes: %s" % (self.pipe_size, ex))
+        return pipe_r, pipe_w, fcntl.fcntl(pipe_w, ForwardSocketSplice.F_GETPIPE_SZ)
+
+    def _socket_tcp_forward(self, sock_to_recv, sock_to_send, pair, inbound):
+        if not hasattr(os, "splice"):
+            return super()._socket_tcp_forward(sock_to_recv, sock_to_send, pair, inbound)
+        pipe_r, pipe_w, chunk_size = self._open_pipe()
+        error = False
+        try:
+            while sock_to_recv.fileno() != -1:
+                try:
+                    n = os.splice(sock_to_recv.fileno(), pipe_w, chunk_size,
+                                  flags=os.SPLICE_F_MOVE)
+                except OSError as ex:
+                    if ex.errno != errno.EINVAL:
+                        raise
+                    # splice is not supported for this socket, copy instead
+                    Logger.debug("fwd-socket: splice is not supported, fall back to copying")
+                    return super()._socket_tcp_forward(sock_to_recv, sock_to_send, pair, inbound)
+                if not n or sock_to_send.fileno() == -1:
+                    break
+                pair.conn.add(inbound, n)
+                while n > 0:
+                    n -= os.splice(pipe_r, sock_to_send.fileno(), n,
+                                   flags=os.SPLICE_F_MOVE)
+        except (OSError, socket.error) as ex:
+            error = not closed_socket_ex(ex)
+            if isinstance(ex, (ConnectionResetError, BrokenPipeError)):
+                # a peer resetting the connection is common, it is counted
+                # as an error but not worth an error message
+                Logger.debug("fwd-socket: connection reset: %s" % ex)
+            elif error:
+                Logger.error("fwd-socket: socket forwarding thread is exiting: %s" % ex)
+        finally:
+            os.close(pipe_r)
+            os.close(pipe_w)
+        if error:
+            self._socket_tcp_close(pair, error)
+        else:
+            self._socket_tcp_eof(pair, sock_to_send)
+
+
+class ForwardSocketMP(object):
+    # Multi-process relay: every worker process binds the same port with
+    # SO_REUSEPORT and runs its own socket-select loop, so the kernel spreads
+    # connections and UDP flows across CPUs. Workers are started with the
+    # "spawn" method: a fresh interpreter that inherits no threads, locks or
+    # file descriptors (keep-alive socket, event stream, ...) of this process.
+    # Each worker copies its traffic counters into a shared array about once
+    # a second, get_stats() adds them up.
+    STATS_FIELDS = (
+        "bytes_in", "bytes_out", "packets_in", "packets_out",
+        "conn_active", "conn_total", "conn_errors", "duration_total", "duration_max"
+    )
+
+    def __init__(self):
+        self.num_workers = os.cpu_count() or 1
+        self.backlog = socket.SOMAXCONN
+        self.start_timeout = 10
+        self.workers = []
+        self.forward_args = None
+        self.supervisor = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        # counters of workers that have exited
+        self.retired = dict((k, 0) for k in ForwardSocketMP.STATS_FIELDS)
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise OSError("socket-mp requires SO_REUSEPORT")
+        import multiprocessing
+        self.mp = multiprocessing.get_context("spawn")
+
+    def __del__(self):
+        self.stop_forward()
+
+    def start_forward(self, ip, port, toip, toport, udp=False):
+        if (ip, port) == (toip, toport):
+            raise ValueError("Cannot forward to the same address %s" %
+                             addr_to_str((ip, port)))
+        # a previous supervisor must be gone before workers are started again
+        self.stop_forward()
+        Logger.debug("fwd-socket-mp: Starting %d workers %s forward to %s" % (
+            self.num_workers,
+            addr_to_uri((ip, port), udp=udp),
+            addr_to_uri((toip, toport), udp=udp)
+        ))
+        self.forward_args = (ip, port, toip, toport, udp)
+        self.stopping = threading.Event()
+        try:
+            starting = []
+            for _ in range(self.num_workers):
+                starting.append(self._spawn_worker())
+                with self.lock:
+                    self.workers.append(starting[-1][0])
+            deadline = time.time() + self.start_timeout
+            for proc, ready in starting:
+                while not ready.wait(0.1):
+                    if not proc.is_alive():
+                        raise OSError("Socket worker exited too quickly")
+                    if time.time() > deadline:
+                        raise OSError("Socket worker did not start in time")
+        except Exception:
+            self.stop_forward()
+            raise
+        self.supervisor = start_daemon_thread(self._supervise, args=(self.stopping,))
+
+    def _spawn_worker(self):
+        ready = self.mp.Event()
+        stats = self.mp.Array("d", len(ForwardSocketMP.STATS_FIELDS))
+        proc = self.mp.Process(
+            target=ForwardSocketMP._worker,
+            args=(self.forward_args, self.backlog, Logger.level, os.getpid(), ready, stats),
+            daemon=True
+        )
+        # the event must outlive the start of the child, which attaches to it
+        proc.ready = ready
+        proc.stats = stats
+        proc.start()
+        return proc, ready
+
+    @staticmethod
+    def _worker(forward_args, backlog, log_level, parent_pid, ready, stats):
+        # runs in the worker process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        Logger.set_level(log_level)
+        try:
+            forwarder = ForwardSocketSelect()
+            forwarder.backlog = backlog
+            # the parent watches the worker process instead
+            forwarder.start_wait = 0
+            forwarder.start_forward(*forward_args)
+            ready.set()
+            # exit if the parent or the relay thread is gone
+            while os.getppid() == parent_pid:
+                if not forwarder.thread.is_alive():
+                    raise OSError("Socket thread exited")
+                ForwardSocketMP._publish_stats(forwarder, stats)
+                time.sleep(1)
+        except Exception as ex:
+            Logger.error("fwd-socket-mp: worker %d is exiting: %s" % (os.getpid(), ex))
+            sys.exit(1)
+
+    @staticmethod
+    def _publish_stats(forwarder, stats):
+        values = forwarder.get_stats()
+        values["duration_total"] = forwarder.stats.duration_total
+        with stats.get_lock():
+            stats[:] = [values[k] for k in ForwardSocketMP.STATS_FIELDS]
+
+    def _retire(self, proc, died=False):
+        # keep the counters of an exited worker, its open connections are
+        # gone, and count as errors if the worker died
+        with proc.stats.get_lock():
+            values = dict(zip(ForwardSocketMP.STATS_FIELDS, proc.stats[:]))
+        if died:
+            values["conn_errors"] += values["conn_active"]
+        values["conn_active"] = 0
+        for k, v in values.items():
+            if k == "duration_max":
+                self.retired[k] = max(self.retired[k], v)
+            else:
+                self.retired[k] += v
+
+    def get_stats(self, connections=False):
+        # per-connection details stay in the worker processes
+        with self.lock:
+            totals = dict(self.retired)
+            arrays = [proc.stats for proc in self.workers]
+        for stats in arrays:
+            with stats.get_lock():
+                values = stats[:]
+            for k, v in zip(ForwardSocketMP.STATS_FIELDS, values):
+                if k == "duration_max":
+                    totals[k] = max(totals[k], v)
+                else:
+                    totals[k] += v
+        conn_closed = totals["conn_total"] - totals["conn_active"]
+        stats = dict((k, int(totals[k])) for k in ForwardSocketMP.STATS_FIELDS[:7])
+        stats.update({
+            "duration_avg":     totals["duration_total"] / conn_closed if conn_closed else 0.0,
+            "duration_max":     totals["duration_max"]
+        })
+        return stats
+
+    def _supervise(self, stopping):
+        while not stopping.wait(1):
+            with self.lock:
+                for i, proc in enumerate(self.workers):
+                    if stopping.is_set():
+                        return
+                    if not proc.is_alive():
+                        Logger.warning("fwd-socket-mp: worker %d died, restarting" % proc.pid)
+                        proc.join()
+                        self._retire(proc, died=True)
+                        self.workers[i] = self._spawn_worker()[0]
+
+    def stop_forward(self):
+        self.stopping.set()
+        supervisor, self.supervisor = self.supervisor, None
+        if supervisor and supervisor is not threading.current_thread():
+            supervisor.join()
+        with self.lock:
+            workers = self.workers
+        if not workers:
+            return
+        Logger.debug("fwd-socket-mp: Stopping %d workers" % len(workers))
+        for proc in workers:
+            if proc.is_alive():
+                proc.terminate()
+        for proc in workers:
+            proc.join()
+        with self.lock:
+            for proc in workers:
+                self._retire(proc)
+            self.workers = []
+
+
+class ForwardAsyncio(object):
+    # asyncio based relay: one coroutine per TCP connection and one datagram
+    # endpoint per UDP session, all running on a single event loop thread.
+    # uvloop is used when it is installed.
+    class UDPListener(object):
+        def __init__(self, forwarder):
+            self.forwarder = forwarder
+
+        def connection_made(self, transport):
+            pass
+
+        def datagram_received(self, data, addr):
+            self.forwarder._udp_inbound(data, addr)
+
+        def error_received(self, exc):
+            Logger.debug("fwd-asyncio: UDP listener error: %s" % exc)
+
+        def connection_lost(self, exc):
+            pass
+
+    class UDPSession(object):
+        def __init__(self, forwarder, client_addr, conn):
+            self.forwarder = forwarder
+            self.client_addr = client_addr
+            self.conn = conn
+            self.transport = None
+            self.pending = []
+            self.last_active = time.time()
+
+        def send(self, data):
+            self.last_active = time.time()
+            self.conn.add(True, len(data))
+            if self.transport:
+                self.transport.sendto(data)
+            else:
+                self.pending.append(data)
+
+        def connection_made(self, transport):
+            self.transport = transport
+            for data in self.pending:
+                transport.sendto(data)
+            self.pending = []
+
+        def datagram_received(self, data, addr):
+            listener = self.forwarder.udp_transport
+            if not listener or listener.is_closing():
+                return
+            self.last_active = time.time()
+            self.conn.add(False, len(data))
+            listener.sendto(data, self.client_addr)
+
+        def error_received(self, exc):
+            Logger.debug("fwd-asyncio: closing UDP session %s: %s" % (
+                addr_to_str(self.client_addr), exc
+            ))
+            self.transport.close()
+
+        def connection_lost(self, exc):
+            self.forwarder._udp_close(self)
+
+    def __init__(self):
+        try:
+            import asyncio
+        except ImportError:
+            raise OSError("asyncio not available") from None
+        self.asyncio = asyncio
+        self.loop = None
+        self.thread = None
+        self.sock = None
+        self.server = None
+        self.udp_transport = None
+        self.outbound_addr = None
+        self.closing = False
+        self.tasks = set()
+        self.sessions = {}
+        self.tcp_buff_size = 65536
+        self.udp_timeout = 60
+        self.connect_timeout = 3
+        self.backlog = socket.SOMAXCONN
+        self.stats = ForwardStats()
+
+    def __del__(self):
+        self.stop_forward()
+
+    def _new_event_loop(self):
+        try:
+            import uvloop
+        except ImportError:
+            return self.asyncio.new_event_loop()
+        Logger.debug("fwd-asyncio: Using uvloop")
+        return uvloop.new_event_loop()
+
+    def start_forward(self, ip, port, toip, toport, udp=False):
+        if (ip, port) == (toip, toport):
+            raise ValueError("Cannot forward to the same address %s" %
+                             addr_to_str((ip, port)))
+        sock_type = socket.SOCK_DGRAM if udp else socket.SOCK_STREAM
+        self.sock = socket.socket(socket.AF_INET, sock_type)
+        try:
+            socket_set_opt(
+                self.sock,
+                reuse       = True,
+                bind_addr   = ("", port)
+            )
+            self.outbound_addr = toip, toport
+            Logger.debug("fwd-asyncio: Starting asyncio %s forward to %s" % (
+                addr_to_uri((ip, port), udp=udp),
+                addr_to_uri((toip, toport), udp=udp)
+            ))
+            self.closing = False
+            self.loop = self._new_event_loop()
+            self.thread = start_daemon_thread(self._run_loop, args=(udp,))
+            time.sleep(1)
+            if not self.thread.is_alive():
+                raise OSError("Event loop thread exited too quickly")
+        except Exception:
+            self.sock.close()
+            self.sock = None
+            self.loop = None
+            raise
+
+    def get_stats(self, connections=False):
+        return self.stats.get(connections)
+
+    def _run_loop(self, udp):
+        loop = self.loop
+        self.asyncio.set_event_loop(loop)
+        try:
+            if udp:
+                self.udp_transport, _ = loop.run_until_complete(
+                    loop.create_datagram_endpoint(
+                        lambda: ForwardAsyncio.UDPListener(self), sock=self.sock
+                    )
+                )
+                self._track(self._udp_sweep())
+            else:
+                self.server = loop.run_until_complete(
+                    self.asyncio.start_server(
+                        self._tcp_accept, sock=self.sock, backlog=self.backlog
+                    )
+                )
+            loop.run_forever()
+        except (OSError, socket.error) as ex:
+            Logger.error("fwd-asyncio: event loop thread is exiting: %s" % ex)
+        finally:
+            loop.close()
+
+    def _track(self, coro):
+        if self.closing:
+            coro.close()
+            return None
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def _tcp_accept(self, reader, writer):
+        if not self._track(self._tcp_handle(reader, writer)):
+            writer.close()
+
+    async def _tcp_handle(self, reader, writer):
+        asyncio = self.asyncio
+        conn = self.stats.open(writer.get_extra_info("peername"))
+        error = False
+        out_writer = None
+        try:
+            out_reader, out_writer = await asyncio.wait_for(
+                asyncio.open_connection(*self.outbound_addr), self.connect_timeout
+            )
+            await asyncio.gather(
+                self._tcp_pipe(reader, out_writer, conn, True),
+                self._tcp_pipe(out_reader, writer, conn, False)
+            )
+        except (ConnectionResetError, BrokenPipeError):
+            # the peer reset the connection, that is a normal close
+            pass
+        except (OSError, asyncio.TimeoutError) as ex:
+            error = not closed_socket_ex(ex)
+            if error:
+                Logger.error("fwd-asyncio: cannot forward port: %s" % (str(ex) or "timed out"))
+        finally:
+            writer.close()
+            if out_writer:
+                out_writer.close()
+            self.stats.close(conn, error)
+
+    async def _tcp_pipe(self, reader, writer, conn, inbound):
+        while True:
+            data = await reader.read(self.tcp_buff_size)
+            if not data:
+                break
+            writer.write(data)
+            conn.add(inbound, len(data))
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+
+    def _udp_inbound(self, data, addr):
+        if self.closing:
+            return
+        session = self.sessions.get(addr)
+        if not session:
+            session = self.sessions[addr] = ForwardAsyncio.UDPSession(
+                self, addr, self.stats.open(addr)
+            )
+            task = self._track(self.loop.create_datagram_endpoint(
+                lambda: session, remote_addr=self.outbound_addr
+            ))
+            task.add_done_callback(lambda t: self._udp_connected(t, session))
+        session.send(data)
+
+    def _udp_connected(self, task, session):
+        if task.cancelled():
+            self._udp_close(session)
+        elif task.exception():
+            Logger.error("fwd-asyncio: cannot forward port: %s" % task.exception())
+            self._udp_close(session, error=True)
+
+    def _udp_close(self, session, error=False):
+        if self.sessions.get(session.client_addr) is session:
+            del self.sessions[session.client_addr]
+        self.stats.close(session.conn, error)
+
+    async def _udp_sweep(self):
+        while True:
+            await self.asyncio.sleep(1)
+            now = time.time()
+            for session in list(self.sessions.values()):
+                if session.transport and now - session.last_active > self.udp_timeout:
+                    session.transport.close()
+
+    async def _shutdown(self):
+        # runs on the loop, transports are closed here but only cleared once
+        # the loop has stopped, callbacks may still be queued until then
+        self.closing = True
+        if self.server:
+            self.server.close()
+        if self.udp_transport:
+            self.udp_transport.close()
+        for session in list(self.sessions.values()):
+            if session.transport:
+                session.transport.close()
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await self.asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop_forward(self):
+        loop = self.loop
+        if not loop or loop.is_closed():
+            return
+        Logger.debug("fwd-asyncio: Stopping asyncio forwarder")
+        try:
+            future = self.asyncio.run_coroutine_threadsafe(self._shutdown(), loop)
+            future.result(timeout=5)
+        except Exception as ex:
+            Logger.debug("fwd-asyncio: event loop did not stop cleanly: %s" % ex)
+        try:
+            loop.call_soon_threadsafe(loop.stop)
+        except RuntimeError:
+            # the loop has already been closed
+            pass
+        self.thread.join(5)
+        if self.thread.is_alive():
+            Logger.warning("fwd-asyncio: event loop thread did not stop in time")
+        self.loop = None
+        self.server = None
+        self.udp_transport = None
+        self.sessions = {}
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
 class UPnPService(object):
     def __init__(self, device, bind_ip = None, interface = None):
         self.device             = device
@@ -1402,6 +3002,45 @@ def socket_set_opt(sock, reuse=False, bind_addr=None, interface=None, timeout=-1
     return sock
 
 
+def socket_wait(sock, timeout, stop_event=None, write=False):
+    # Wait until the socket is readable (or writable), in short slices so
+    # that setting stop_event interrupts the wait. Returns False on timeout.
+    deadline = time.time() + timeout
+    with selectors.DefaultSelector() as sel:
+        sel.register(sock, selectors.EVENT_WRITE if write else selectors.EVENT_READ)
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                raise NatterExitException("Natter is stopped")
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if stop_event is not None:
+                remaining = min(remaining, 0.2)
+            if sel.select(remaining):
+                return True
+
+
+def socket_connect(sock, addr, timeout, stop_event=None):
+    # connect() with a timeout that stop_event can interrupt, the socket is
+    # left with `timeout` as its timeout
+    sock.setblocking(False)
+    err = sock.connect_ex(addr)
+    if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY,
+               getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK)):
+        if not socket_wait(sock, timeout, stop_event, write=True):
+            raise socket.timeout("timed out")
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    sock.settimeout(timeout)
+    if err:
+        raise OSError(err, os.strerror(err))
+
+
+def socket_recv(sock, size, timeout, stop_event=None):
+    if not socket_wait(sock, timeout, stop_event):
+        raise socket.timeout("timed out")
+    return sock.recv(size)
+
+
 def start_daemon_thread(target, args=()):
     th = threading.Thread(target=target, args=args)
     th.daemon = True
@@ -1572,7 +3211,7 @@ def set_reuse_port(port):
         return
 
 
-def natter_main(show_title = True):
+def natter_main(show_title = True, argv = None, on_mapping = None, stop_event = None):
     argp = argparse.ArgumentParser(
         description="Expose your port behind full-cone NAT to the Internet.", add_help=False
     )
@@ -1607,6 +3246,14 @@ def natter_main(show_title = True):
         "-s", metavar="<address>", action="append",
         help="hostname or address to STUN server"
     )
+    group.add_argument(
+        "--stun-race", type=int, metavar="<count>", default=1,
+        help="query up to this many STUN servers at once and use the first answer"
+    )
+    group.add_argument(
+        "--stun-cache", type=str, metavar="<path>", default=None,
+        help="keep latency and failures of STUN servers in this file across restarts"
+    )
     group.add_argument(
         "-h", type=str, metavar="<address>", default=None,
         help="hostname or address to keep-alive server"
@@ -1615,6 +3262,15 @@ def natter_main(show_title = True):
         "-e", type=str, metavar="<path>", default=None,
         help="script path for notifying mapped address"
     )
+    group.add_argument(
+        "-o", type=str, metavar="<target>", default=None,
+        help="write JSON-lines events to a file descriptor, '-' for stdout, "
+             "or 'unix:<path>' for a Unix socket"
+    )
+    group.add_argument(
+        "--metrics", type=str, metavar="<[address:]port>", default=None,
+        help="serve Prometheus metrics over HTTP at /metrics, address defaults to 127.0.0.1"
+    )
     group = argp.add_argument_group("bind options")
     group.add_argument(
         "-i", type=str, metavar="<interface>", default="0.0.0.0",
@@ -1628,7 +3284,8 @@ def natter_main(show_title = True):
     group.add_argument(
         "-m", type=str, metavar="<method>", default=None,
         help="forward method, common values are 'iptables', 'nftables', "
-             "'socat', 'gost' and 'socket'"
+             "'socat', 'gost', 'socket', 'socket-select', 'socket-splice', "
+             "'socket-mp' and 'asyncio'"
     )
     group.add_argument(
         "-t", type=str, metavar="<address>", default="0.0.0.0",
@@ -1641,15 +3298,31 @@ def natter_main(show_title = True):
     group.add_argument(
         "-r", action="store_true", help="keep retrying until the port of forward target is open"
     )
+    group.add_argument(
+        "--backlog", type=int, metavar="<length>", default=None,
+        help="listen backlog of the socket and asyncio methods, defaults to the system maximum"
+    )
+    group.add_argument(
+        "--workers", type=int, metavar="<count>", default=None,
+        help="number of worker processes of the socket-mp method, defaults to the CPU count"
+    )
+    group.add_argument(
+        "--standby", action="store_true",
+        help="keep a standby mapping on a spare port and switch to it when the mapped address changes"
+    )
 
-    args = argp.parse_args()
+    args = argp.parse_args(argv)
     verbose = args.v
     udp_mode = args.u
     upnp_enabled = args.U
     interval = args.k
     stun_list = args.s
+    stun_race = args.stun_race
+    stun_cache = args.stun_cache
     keepalive_srv = args.h
     notify_sh = args.e
+    event_target = args.o
+    metrics_listen = args.metrics
     bind_ip = args.i
     bind_interface = None
     bind_port = args.b
@@ -1658,10 +3331,13 @@ def natter_main(show_title = True):
     to_port = args.p
     keep_retry = args.r
     exit_when_changed = args.q
+    standby_enabled = args.standby
+    num_workers = args.workers
+    backlog = args.backlog
 
     if verbose:
         Logger.set_level(Logger.DEBUG)
-    else:
+    elif argv is None:
         sys.tracebacklimit = 0
 
     if args.check:
@@ -1669,12 +3345,25 @@ def natter_main(show_title = True):
         sys.exit(0)
 
     validate_positive(interval)
+    validate_positive(stun_race)
+    if num_workers is not None:
+        validate_positive(num_workers)
+    if backlog is not None:
+        validate_positive(backlog)
     if stun_list:
         for stun_srv in stun_list:
             validate_addr_str(stun_srv)
     validate_addr_str(keepalive_srv)
     if notify_sh:
         validate_filepath(notify_sh)
+    if event_target and event_target != "-" and not event_target.startswith("unix:"):
+        validate_positive(event_target)
+    if metrics_listen:
+        if ":" not in metrics_listen:
+            metrics_listen = "127.0.0.1:" + metrics_listen
+        validate_addr_str(metrics_listen)
+        metrics_ip, metrics_port = metrics_listen.rsplit(":", 1)
+        metrics_listen = metrics_ip, int(metrics_port)
     if not validate_ip(bind_ip, err=False):
         bind_interface = bind_ip
         bind_ip = "0.0.0.0"
@@ -1766,27 +3455,57 @@ def natter_main(show_title = True):
         ForwardImpl = ForwardGost
     elif method == "socket":
         ForwardImpl = ForwardSocket
+    elif method == "socket-select":
+        ForwardImpl = ForwardSocketSelect
+    elif method == "socket-splice":
+        ForwardImpl = ForwardSocketSplice
+    elif method == "socket-mp":
+        ForwardImpl = ForwardSocketMP
+    elif method == "asyncio":
+        ForwardImpl = ForwardAsyncio
     else:
         raise ValueError("Unknown method name: %s" % method)
+    if num_workers is not None and ForwardImpl is not ForwardSocketMP:
+        raise ValueError("--workers only applies to the socket-mp method")
+    if backlog is not None and not issubclass(ForwardImpl, (ForwardSocket, ForwardSocketMP, ForwardAsyncio)):
+        raise ValueError("--backlog only applies to the socket and asyncio methods")
+
+    def new_forwarder():
+        fwd = ForwardImpl()
+        if num_workers is not None:
+            fwd.num_workers = num_workers
+        if backlog is not None:
+            fwd.backlog = backlog
+        return fwd
+
     #
     #  Natter
     #
     if show_title:
         Logger.info("Natter v%s" % __version__)
-        if len(sys.argv) == 1:
+        if argv is None and len(sys.argv) == 1:
             Logger.info("Tips: Use `--help` to see help messages")
 
     check_docker_network()
 
-    forwarder = ForwardImpl()
+    events = EventStream(event_target)
+    # services run as threads of one process share the listen address, the
+    # label keeps them apart and stays the same across restarts
+    metrics = Metrics.open(metrics_listen).labeled(service="%s->%s" % (
+        addr_to_uri((args.i, args.b), udp=udp_mode), addr_to_str((to_ip, to_port))
+    ))
+    stun_health = StunHealth.open(stun_cache)
+    forwarder = new_forwarder()
     port_test = PortTest()
 
-    stun = StunClient(stun_srv_list, bind_ip, bind_port, udp=udp_mode, interface=bind_interface)
+    stun = StunClient(stun_srv_list, bind_ip, bind_port, udp=udp_mode, interface=bind_interface,
+                      metrics=metrics, race=stun_race, health=stun_health, stop_event=stop_event)
     natter_addr, outer_addr = stun.get_mapping()
     # set actual ip and port for keep-alive socket to bind, instead of zero
     bind_ip, bind_port = natter_addr
 
-    keep_alive = KeepAlive(keepalive_host, keepalive_port, bind_ip, bind_port, udp=udp_mode, interface=bind_interface)
+    keep_alive = KeepAlive(keepalive_host, keepalive_port, bind_ip, bind_port, udp=udp_mode,
+                           interface=bind_interface, stop_event=stop_event)
     keep_alive.keep_alive()
 
     # get the mapped address again after the keep-alive connection is established
@@ -1799,18 +3518,212 @@ def natter_main(show_title = True):
     if socket.inet_aton(to_ip) in [socket.inet_aton("127.0.0.1"), socket.inet_aton("0.0.0.0")]:
         to_ip = natter_addr[0]
 
-    # if not specified, the target port is set to be the same as the outer port
-    if not to_port:
-        to_port = outer_addr[1]
+    def get_target_addr(natter_addr, outer_addr):
+        # some exceptions: ForwardNone and ForwardTestServer are not real forward methods,
+        # so let target ip and port equal to natter's
+        if ForwardImpl in (ForwardNone, ForwardTestServer):
+            return natter_addr
+        # if not specified, the target port is set to be the same as the outer port
+        return to_ip, to_port or outer_addr[1]
+
+    def check_stop():
+        # a stopped thread must not start forwarding or report a mapping
+        if stop_event is not None and stop_event.is_set():
+            raise NatterExitException("Natter is stopped")
+
+    def start_forward(fwd):
+        check_stop()
+        fwd.start_forward(natter_addr[0], natter_addr[1], to_addr[0], to_addr[1], udp=udp_mode)
+        NatterExit.register(fwd.stop_forward)
+        forward_started()
+
+    def forward_started():
+        status["forwarding"] = True
+        events.emit("forward_started", method=method, protocol=protocol,
+                    natter=list(natter_addr), target=list(to_addr))
+
+    def stop_forwarder(fwd):
+        fwd.stop_forward()
+        NatterExit.unregister(fwd.stop_forward)
+
+    def stop_forward(reason):
+        stop_forwarder(forwarder)
+        status["forwarding"] = False
+        keep_alive.disconnect()
+        if standby_enabled:
+            stop_standby()
+            NatterExit.unregister(stop_standby)
+        events.emit("forward_stopped", method=method, protocol=protocol, reason=reason)
+        events.close()
+
+    def open_standby():
+        # runs on the standby thread: pre-establish a second mapping on a
+        # spare port and start forwarding on it, so that promoting it only
+        # swaps forwarders
+        sb_stun = StunClient(list(stun_srv_list), natter_addr[0], 0, udp=udp_mode, interface=bind_interface,
+                             metrics=metrics, race=stun_race, health=stun_health, stop_event=standby["stop"])
+        sb_keep_alive = None
+        try:
+            sb_natter_addr, _ = sb_stun.get_mapping(once=True)
+            sb_keep_alive = KeepAlive(
+                keepalive_host, keepalive_port, sb_natter_addr[0], sb_natter_addr[1],
+                udp=udp_mode, interface=bind_interface, stop_event=standby["stop"]
+            )
+            sb_keep_alive.keep_alive()
+            sb_natter_addr, sb_outer_addr = sb_stun.get_mapping(once=True)
+            sb_to_addr = get_target_addr(sb_natter_addr, sb_outer_addr)
+            sb_forwarder = new_forwarder()
+            sb_forwarder.start_forward(sb_natter_addr[0], sb_natter_addr[1], sb_to_addr[0], sb_to_addr[1],
+                                       udp=udp_mode)
+            NatterExit.register(sb_forwarder.stop_forward, owner=main_thread)
+        except (StunClient.ServerUnavailable, NatterExitException, OSError, ValueError, socket.error) as ex:
+            if not standby["stop"].is_set():
+                Logger.warning("standby: cannot establish standby mapping: %s" % ex)
+            if sb_keep_alive:
+                sb_keep_alive.disconnect()
+            return None
+        Logger.info("standby: %s <--Natter--> %s" % (
+            addr_to_uri(sb_natter_addr, udp=udp_mode), addr_to_uri(sb_outer_addr, udp=udp_mode)
+        ))
+        events.emit("standby", protocol=protocol, natter=list(sb_natter_addr), outer=list(sb_outer_addr))
+        # setting "release" interrupts a keep-alive in progress, when the
+        # standby is promoted or closed
+        sb_keep_alive.stop_event = threading.Event()
+        return {
+            "stun": sb_stun, "keep_alive": sb_keep_alive, "forwarder": sb_forwarder,
+            "natter_addr": sb_natter_addr, "outer_addr": sb_outer_addr, "to_addr": sb_to_addr,
+            "lock": threading.Lock(), "release": sb_keep_alive.stop_event
+        }
+
+    def close_standby(sb):
+        sb["release"].set()
+        with sb["lock"]:
+            stop_forwarder(sb["forwarder"])
+            sb["keep_alive"].disconnect()
+
+    def run_standby():
+        # keeps one standby mapping alive on its own thread, so that neither
+        # opening nor probing it delays the primary keep-alive
+        stop = standby["stop"]
+        while not stop.is_set():
+            sb = standby["mapping"]
+            if sb is None:
+                sb = open_standby()
+                if sb is None:
+                    # try again at about the next forced recheck
+                    stop.wait(interval * 20)
+                    continue
+                with standby["lock"]:
+                    stored = not stop.is_set()
+                    if stored:
+                        standby["mapping"] = sb
+                if not stored:
+                    close_standby(sb)
+                    return
+                continue
+            if stop.wait(interval):
+                return
+            dropped = False
+            with sb["lock"]:
+                # the main loop may have taken it for promotion meanwhile
+                if standby["mapping"] is not sb:
+                    continue
+                try:
+                    sb["keep_alive"].keep_alive()
+                except NatterExitException:
+                    # released, checked again above
+                    continue
+                except (OSError, socket.error) as ex:
+                    Logger.warning("standby: keep-alive failed, standby mapping dropped: %s" % ex)
+                    dropped = True
+            if dropped:
+                with standby["lock"]:
+                    dropped = standby["mapping"] is sb
+                    if dropped:
+                        standby["mapping"] = None
+                if dropped:
+                    close_standby(sb)
+
+    def stop_standby():
+        standby["stop"].set()
+        with standby["lock"]:
+            sb, standby["mapping"] = standby["mapping"], None
+        if sb:
+            close_standby(sb)
+        thread = standby["thread"]
+        if thread and thread is not threading.current_thread():
+            thread.join(5)
+
+    def announce_mapping():
+        status["mapping_since"] = time.time()
+        # Display route information
+        Logger.info()
+        route_str = ""
+        if ForwardImpl not in (ForwardNone, ForwardTestServer):
+            route_str += "%s <--%s--> " % (addr_to_uri(to_addr, udp=udp_mode), method)
+        route_str += "%s <--Natter--> %s" % (
+            addr_to_uri(natter_addr, udp=udp_mode), addr_to_uri(outer_addr, udp=udp_mode)
+        )
+        Logger.info(route_str)
+        Logger.info()
 
-    # some exceptions: ForwardNone and ForwardTestServer are not real forward methods,
-    # so let target ip and port equal to natter's
-    if ForwardImpl in (ForwardNone, ForwardTestServer):
-        to_ip, to_port = natter_addr
+        # Test mode notice
+        if ForwardImpl == ForwardTestServer:
+            Logger.info("Test mode in on.")
+            Logger.info("Please check [ %s://%s ]" % ("udp" if udp_mode else "http", addr_to_str(outer_addr)))
+            Logger.info()
+
+        events.emit("mapping", protocol=protocol, inner=list(to_addr if method else natter_addr),
+                    natter=list(natter_addr), outer=list(outer_addr))
+
+        # Call notification script
+        if notify_sh:
+            inner_ip, inner_port = to_addr if method else natter_addr
+            outer_ip, outer_port = outer_addr
+            Logger.info("Calling script: %s" % notify_sh)
+            subprocess.call([
+                os.path.abspath(notify_sh), protocol, str(inner_ip), str(inner_port), str(outer_ip), str(outer_port)
+            ], shell=False)
+
+        # Call notification callback
+        if on_mapping:
+            check_stop()
+            on_mapping(to_addr if method else natter_addr, outer_addr, protocol)
+
+    def collect_metrics():
+        # values read from the current state on every scrape
+        ret = [
+            ("natter_info", {"version": __version__, "protocol": protocol}, 1),
+            ("natter_forward_up", {"method": method}, 1 if status["forwarding"] else 0),
+            ("natter_standby_up", {}, 1 if standby["mapping"] else 0),
+        ]
+        if not status["forwarding"]:
+            return ret
+        if status["mapping_since"]:
+            ret.append(("natter_mapping_info", {
+                "protocol": protocol, "natter": addr_to_str(natter_addr), "outer": addr_to_str(outer_addr)
+            }, 1))
+            ret.append(("natter_mapping_age_seconds", {}, round(time.time() - status["mapping_since"], 3)))
+        if hasattr(forwarder, "get_stats"):
+            stats = forwarder.get_stats()
+            ret += [
+                ("natter_forward_connections_active", {}, stats["conn_active"]),
+                ("natter_forward_connections_total", {}, stats["conn_total"]),
+                ("natter_forward_connection_errors_total", {}, stats["conn_errors"]),
+                ("natter_forward_bytes_total", {"direction": "in"}, stats["bytes_in"]),
+                ("natter_forward_bytes_total", {"direction": "out"}, stats["bytes_out"]),
+                ("natter_forward_packets_total", {"direction": "in"}, stats["packets_in"]),
+                ("natter_forward_packets_total", {"direction": "out"}, stats["packets_out"]),
+            ]
+        return ret
 
-    to_addr = (to_ip, to_port)
-    forwarder.start_forward(natter_addr[0], natter_addr[1], to_addr[0], to_addr[1], udp=udp_mode)
-    NatterExit.set_atexit(forwarder.stop_forward)
+    to_addr = get_target_addr(natter_addr, outer_addr)
+    protocol = "udp" if udp_mode else "tcp"
+    main_thread = threading.get_ident()
+    standby = {"mapping": None, "thread": None, "lock": threading.Lock(), "stop": threading.Event()}
+    status = {"forwarding": False, "mapping_since": None}
+    metrics.collect("natter", collect_metrics)
+    start_forward(forwarder)
 
     # UPnP
     upnp = None
@@ -1835,32 +3748,15 @@ def natter_main(show_title = True):
         else:
             upnp_ready = True
 
-    # Display route information
-    Logger.info()
-    route_str = ""
-    if ForwardImpl not in (ForwardNone, ForwardTestServer):
-        route_str += "%s <--%s--> " % (addr_to_uri(to_addr, udp=udp_mode), method)
-    route_str += "%s <--Natter--> %s" % (
-        addr_to_uri(natter_addr, udp=udp_mode), addr_to_uri(outer_addr, udp=udp_mode)
-    )
-    Logger.info(route_str)
-    Logger.info()
-
-    # Test mode notice
-    if ForwardImpl == ForwardTestServer:
-        Logger.info("Test mode in on.")
-        Logger.info("Please check [ %s://%s ]" % ("udp" if udp_mode else "http", addr_to_str(outer_addr)))
-        Logger.info()
+    announce_mapping()
 
-    # Call notification script
-    if notify_sh:
-        protocol = "udp" if udp_mode else "tcp"
-        inner_ip, inner_port = to_addr if method else natter_addr
-        outer_ip, outer_port = outer_addr
-        Logger.info("Calling script: %s" % notify_sh)
-        subprocess.call([
-            os.path.abspath(notify_sh), protocol, str(inner_ip), str(inner_port), str(outer_ip), str(outer_port)
-        ], shell=False)
+    def wait_or_stop(seconds):
+        # sleep, or stop forwarding and exit when the stop event is set
+        if stop_event is None:
+            time.sleep(seconds)
+        elif stop_event.wait(seconds):
+            stop_forward("stopped")
+            raise NatterExitException("Natter is stopped")
 
     # Display check results, TCP only
     if not udp_mode:
@@ -1878,13 +3774,16 @@ def natter_main(show_title = True):
         # retry
         if keep_retry and ret1 == -1:
             Logger.info("Retry after %d seconds..." % interval)
-            time.sleep(interval)
-            forwarder.stop_forward()
-            keep_alive.disconnect()
+            wait_or_stop(interval)
+            stop_forward("target port is closed")
+            metrics.inc("natter_retries_total", reason="target_closed")
             raise NatterRetryException("Target port is closed")
     #
     #  Main loop
     #
+    if standby_enabled:
+        NatterExit.register(stop_standby)
+        standby["thread"] = start_daemon_thread(run_standby)
     need_recheck = False
     cnt = 0
     while True:
@@ -1899,25 +3798,87 @@ def natter_main(show_title = True):
             if udp_mode or port_test.test_lan(outer_addr, source_ip=natter_addr[0], interface=bind_interface) == -1:
                 # then check through STUN
                 _, outer_addr_curr = stun.get_mapping()
+                events.emit("recheck", protocol=protocol, outer=list(outer_addr_curr),
+                            changed=outer_addr_curr != outer_addr)
+                metrics.inc("natter_rechecks_total",
+                            result="changed" if outer_addr_curr != outer_addr else "unchanged")
                 if outer_addr_curr != outer_addr:
-                    forwarder.stop_forward()
-                    keep_alive.disconnect()
-                    # exit or retry
-                    if exit_when_changed:
-                        Logger.info("Natter is exiting because mapped address has changed")
-                        raise NatterExitException("Mapped address has changed")
-                    raise NatterRetryException("Mapped address has changed")
+                    metrics.inc("natter_mapping_changes_total")
+                    events.emit("mapping_changed", protocol=protocol,
+                                old=list(outer_addr), new=list(outer_addr_curr))
+                    promoted = False
+                    sb = None
+                    if standby_enabled and not exit_when_changed:
+                        with standby["lock"]:
+                            sb, standby["mapping"] = standby["mapping"], None
+                    if sb:
+                        # switch to the standby mapping instead of starting over,
+                        # its forwarder is already running
+                        try:
+                            sb_natter_addr, sb_outer_addr = sb["stun"].get_mapping(once=True)
+                        except StunClient.ServerUnavailable as ex:
+                            Logger.warning("standby: cannot check standby mapping: %s" % ex)
+                            close_standby(sb)
+                        else:
+                            Logger.info("Mapped address has changed, switching to standby mapping")
+                            events.emit("forward_stopped", method=method, protocol=protocol,
+                                        reason="switching to standby mapping")
+                            old_forwarder, old_keep_alive = forwarder, keep_alive
+                            stun, keep_alive, forwarder = sb["stun"], sb["keep_alive"], sb["forwarder"]
+                            natter_addr, outer_addr = sb_natter_addr, sb_outer_addr
+                            bind_ip, bind_port = natter_addr
+                            to_addr = get_target_addr(natter_addr, outer_addr)
+                            if to_addr != sb["to_addr"]:
+                                # the standby port is mapped to another outer port
+                                # by now, and the target port follows it
+                                stop_forwarder(forwarder)
+                                forwarder = new_forwarder()
+                                start_forward(forwarder)
+                            else:
+                                check_stop()
+                                forward_started()
+                            stop_forwarder(old_forwarder)
+                            old_keep_alive.disconnect()
+                            if upnp_ready:
+                                try:
+                                    upnp.forward("", bind_port, bind_ip, bind_port, udp=udp_mode, duration=interval*3)
+                                except (OSError, socket.error, ValueError) as ex:
+                                    Logger.error("upnp: failed to forward port: %s" % ex)
+                            announce_mapping()
+                            # interrupt a keep-alive the standby thread may still
+                            # be sending, from now on it is the primary one
+                            sb["release"].set()
+                            with sb["lock"]:
+                                stun.stop_event = keep_alive.stop_event = stop_event
+                            promoted = True
+                            metrics.inc("natter_standby_promotions_total")
+                    if not promoted:
+                        stop_forward("mapped address has changed")
+                        # exit or retry
+                        if exit_when_changed:
+                            Logger.info("Natter is exiting because mapped address has changed")
+                            raise NatterExitException("Mapped address has changed")
+                        metrics.inc("natter_retries_total", reason="mapping_changed")
+                        raise NatterRetryException("Mapped address has changed")
         # end of recheck
         ts = time.time()
         try:
             keep_alive.keep_alive()
+            events.emit("keepalive", protocol=protocol, ok=True,
+                        rtt_ms=round(keep_alive.rtt * 1000, 1) if keep_alive.rtt is not None else None)
+            if keep_alive.rtt is not None:
+                metrics.observe("natter_keepalive_rtt_seconds", keep_alive.rtt, protocol=protocol)
         except (OSError, socket.error) as ex:
+            events.emit("keepalive", protocol=protocol, ok=False, error=str(ex))
+            metrics.inc("natter_keepalive_failures_total", protocol=protocol)
             if hasattr(errno, "EADDRNOTAVAIL") and \
                     ex.errno == errno.EADDRNOTAVAIL:
+                stop_forward("local IP address has changed")
                 if exit_when_changed:
                     Logger.info("Natter is exiting because local IP address "
                                 "has changed")
                     raise NatterExitException("Local IP address has changed")
+                metrics.inc("natter_retries_total", reason="local_ip_changed")
                 raise NatterRetryException("Local IP address has changed")
             if udp_mode:
                 Logger.debug("keep-alive: UDP response not received: %s" % ex)
@@ -1930,24 +3891,75 @@ def natter_main(show_title = True):
                 upnp.renew()
             except (OSError, socket.error) as ex:
                 Logger.error("upnp: failed to renew upnp: %s" % ex)
+                metrics.inc("natter_upnp_renew_failures_total")
         sleep_sec = interval - (time.time() - ts)
-        if sleep_sec > 0:
-            time.sleep(sleep_sec)
+        wait_or_stop(max(sleep_sec, 0))
 
 
-def main():
-    signal.signal(signal.SIGTERM, lambda s,f: sys.exit(143))
-    fix_codecs()
+def natter_run(argv = None, on_mapping = None, stop_event = None):
     show_title = True
-    while True:
+    while stop_event is None or not stop_event.is_set():
         try:
-            natter_main(show_title)
+            natter_main(show_title, argv, on_mapping, stop_event)
         except NatterRetryException:
             pass
-        except (NatterExitException, KeyboardInterrupt):
-            sys.exit()
+        except NatterExitException:
+            return
+        finally:
+            # stop forwarders left running when natter_main failed
+            NatterExit.run(current_thread=True)
         show_title = False
 
 
+class NatterThread(object):
+    # Run Natter in a background thread of the current process.
+    # `on_mapping(inner_addr, outer_addr, protocol)` is called from this thread
+    # every time a mapping is established.
+    def __init__(self, argv, on_mapping=None):
+        self.argv = list(argv)
+        self.on_mapping = on_mapping
+        self.stop_event = threading.Event()
+        self.error = None
+        self.thread = None
+
+    def start(self):
+        fix_codecs()
+        self.thread = start_daemon_thread(self._run)
+
+    def _run(self):
+        try:
+            natter_run(self.argv, self.on_mapping, self.stop_event)
+        except (Exception, SystemExit) as ex:
+            # argparse reports invalid arguments with SystemExit
+            self.error = ex
+            Logger.error("natter: stopped unexpectedly: %r" % ex)
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def join(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+
+    def stop(self, timeout=None):
+        # returns False if the thread is still running after `timeout` seconds
+        self.stop_event.set()
+        self.join(timeout)
+        if self.is_alive():
+            Logger.warning("natter: thread did not stop within %s seconds" % timeout)
+            return False
+        return True
+
+
+def main():
+    signal.signal(signal.SIGTERM, lambda s,f: sys.exit(143))
+    fix_codecs()
+    try:
+        natter_run()
+    except KeyboardInterrupt:
+        pass
+    sys.exit()
+
+
 if __name__ == "__main__":
     main()
@@ -11,10 +11,15 @@ import re
 import sys
 import time
 import json
+import importlib.util
+import random
+import threading
 import subprocess
 import requests
+import urllib3
 import signal
 import yaml
+from requests.adapters import HTTPAdapter
 
 # ==================== 配置加载 ====================
 def load_config():
@@ -27,7 +32,15 @@ def load_config():
             'cloudflare': {
                 'api_token': 'your_cloudflare_api_token_here',
                 'zone_id': 'your_zone_id_here',
-                'domain': 'example.com'
+                'domain': 'example.com',
+                'timeout': 10,
+                'batch': True,
+                'state_file': 'natter_cloudflare_state.json',
+                'verify_sample': 0,
+                'retries': 3,
+                'rate_limit': 1200,
+                'retry_interval': 60,
+                'api_base': 'https://api.cloudflare.com/client/v4'
             },
             'srv': {
                 'name': '_minecraft._tcp.example.com',
@@ -37,7 +50,11 @@ def load_config():
             'natter': {
                 'script': 'natter.py',
                 'port': 11451,
-                'args': []
+                'args': [],
+                'embed': False,
+                'events': False,
+                'standby': False,
+                'stun_cache': ''
             },
             'logging': {
                 'show_srv_logs': False
@@ -59,40 +76,293 @@ config = load_config()
 CF_API_TOKEN = config['cloudflare']['api_token']
 CF_ZONE_ID = config['cloudflare']['zone_id']
 CF_DOMAIN = config['cloudflare']['domain']
-SRV_NAME = config['srv']['name']
-SRV_PRIORITY = config['srv']['priority']
-SRV_WEIGHT = config['srv']['weight']
+CF_API_TIMEOUT = config['cloudflare'].get('timeout', 10)
+CF_BATCH_UPDATE = config['cloudflare'].get('batch', True)
+CF_STATE_FILE = config['cloudflare'].get('state_file', 'natter_cloudflare_state.json')
+CF_VERIFY_SAMPLE = config['cloudflare'].get('verify_sample', 0)
+CF_RETRIES = config['cloudflare'].get('retries', 3)
+CF_RATE_LIMIT = config['cloudflare'].get('rate_limit', 1200)
+CF_RETRY_INTERVAL = config['cloudflare'].get('retry_interval', 60)
+CF_API_BASE = config['cloudflare'].get('api_base', 'https://api.cloudflare.com/client/v4')
+SRV_NAME = config.get('srv', {}).get('name')
+SRV_PRIORITY = config.get('srv', {}).get('priority', 0)
+SRV_WEIGHT = config.get('srv', {}).get('weight', 5)
 NATTER_SCRIPT = config['natter']['script']
-NATTER_PORT = config['natter']['port']
+NATTER_PORT = config['natter'].get('port')
 NATTER_ARGS = config['natter'].get('args', [])
+NATTER_EMBED = config['natter'].get('embed', False)
+NATTER_EVENTS = config['natter'].get('events', False)
+NATTER_STANDBY = config['natter'].get('standby', False)
+NATTER_STUN_CACHE = config['natter'].get('stun_cache')
+# 服务列表：每个服务运行一个 Natter，发布一条 SRV 记录
+# 未配置 services 时，使用 srv 和 natter 中的单个服务
+SERVICES = config.get('services') or [{'srv': SRV_NAME, 'port': NATTER_PORT}]
 SHOW_SRV_LOGS = config.get('logging', {}).get('show_srv_logs', False)
 # ===============================================
 
 
-class NatterCloudFlare:
-    def __init__(self):
+class CloudFlareAbort(Exception):
+    """有更新的数据需要提交，放弃正在重试的请求"""
+    pass
+
+
+class CloudFlareAPI:
+    """CloudFlare API 客户端：所有请求复用同一个长连接会话"""
+
+    BASE_URL = "https://api.cloudflare.com/client/v4"
+    # 需要重试的状态码：限流和服务端错误
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    # 非幂等请求（POST）只在被限流时重试，此时请求没有被处理
+    RETRY_STATUS_POST = (429,)
+    # CloudFlare 按 Token 统计请求数的周期（秒）
+    RATE_PERIOD = 300
+    BACKOFF_BASE = 1
+    BACKOFF_MAX = 60
+
+    def __init__(self, api_token, zone_id, timeout=10, retries=3, rate_limit=1200, base_url=None):
+        self.zone_id = zone_id
+        # 可以指向本地的模拟接口（测试和性能测试用）
+        self.base_url = (base_url or self.BASE_URL).rstrip("/")
+        # (连接超时, 读取超时)
+        self.timeout = (min(timeout, 5), timeout)
+        self.retries = retries
+        # 请求额度（令牌桶）：每 RATE_PERIOD 秒最多 rate_limit 个请求，0 表示不限制
+        self.rate_limit = rate_limit
+        self.tokens = float(rate_limit)
+        self.refilled = time.monotonic()
+        self.blocked_until = 0  # 收到 429 后，在此时间之前不发送请求
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        # 只访问一个主机，保持少量常驻连接即可
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, pool_block=False)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_token}",
+            "Content-Type": "application/json",
+            "Connection": "keep-alive"
+        })
+
+    def dns_records_url(self, path=None):
+        """获取 DNS 记录接口地址，path 为记录 ID 或 "batch" """
+        url = f"{self.base_url}/zones/{self.zone_id}/dns_records"
+        if path:
+            url += f"/{path}"
+        return url
+
+    def acquire(self):
+        """从请求额度中取出一个请求，额度不足时返回需要等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0, self.blocked_until - now)
+            if self.rate_limit:
+                self.tokens = min(self.rate_limit,
+                                  self.tokens + (now - self.refilled) * self.rate_limit / self.RATE_PERIOD)
+                self.refilled = now
+                if self.tokens < 1:
+                    wait = max(wait, (1 - self.tokens) * self.RATE_PERIOD / self.rate_limit)
+                if not wait:
+                    self.tokens -= 1
+            return wait
+
+    def sleep(self, seconds, abort=None):
+        """等待指定时间，期间 abort() 返回 True（有更新的数据等待提交）时放弃"""
+        deadline = time.monotonic() + seconds
+        while True:
+            if abort and abort():
+                raise CloudFlareAbort("有更新的映射等待发布，放弃重试")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.5))
+
+    def backoff(self, attempt, response=None):
+        """计算重试等待时间：优先使用 Retry-After，否则指数退避加随机抖动"""
+        if response is not None:
+            try:
+                return max(0, float(response.headers.get("Retry-After")))
+            except (TypeError, ValueError):
+                pass
+        delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def not_sent(error):
+        """请求是否确定没有发到服务端（连接没有建立）"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(error.args[0], "reason", None) if error.args else None
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    def request(self, method, path=None, abort=None, **kwargs):
+        """发送 DNS 记录相关请求，限流、服务端错误和网络错误时自动重试，abort() 返回 True 时放弃"""
+        kwargs.setdefault("timeout", self.timeout)
+        url = self.dns_records_url(path)
+        # POST（创建、批量更新）不是幂等的，只在被限流或请求确定没有发出时重试，
+        # 以免服务端已处理但响应丢失时重复创建记录
+        idempotent = method != "POST"
+        retry_status = self.RETRY_STATUS if idempotent else self.RETRY_STATUS_POST
+        attempt = 0
+        
+        while True:
+            wait = self.acquire()
+            while wait:
+                self.sleep(wait, abort)
+                wait = self.acquire()
+            
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.retries or not (idempotent or self.not_sent(e)):
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                if response.status_code not in retry_status or attempt >= self.retries:
+                    return response
+                delay = self.backoff(attempt, response)
+                if response.status_code == 429:
+                    # 同一 Token 的额度已用完，所有请求都暂停
+                    with self.lock:
+                        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+                    delay = 0
+            
+            attempt += 1
+            self.sleep(delay, abort)
+
+    def close(self):
+        """关闭连接池"""
+        self.session.close()
+
+
+class NatterService:
+    """单个服务：一个 Natter 映射，以及发布它的 A 记录和 SRV 记录"""
+
+    def __init__(self, srv_name, port, args=None, priority=0, weight=5, name=None, a_record=None):
+        self.name = name or srv_name
+        self.srv_name = srv_name
+        self.port = port
+        self.args = args or []
+        self.priority = priority
+        self.weight = weight
         self.natter_process = None
+        self.natter_thread = None  # 内嵌模式下运行 Natter 的线程
+        self.last_mapping = None  # 读取线程最近一次看到的映射
         self.current_ip = None
         self.current_port = None
-        self.srv_record_id = None
-        self.a_record_id = None
-        self.a_record_name = None  # A 记录的主机名
+        self.a_record = a_record  # 配置中指定的 A 记录主机名
+        self.a_record_name = a_record or self.generate_a_record_name()
+
+    def generate_a_record_name(self, shared=False):
+        """生成 A 记录的主机名，shared 表示同一域名下还有其他服务"""
+        # 从 SRV 名称提取域名部分
+        # 例如: _minecraft._tcp.mc.example.com -> mc.example.com
+        parts = self.srv_name.split('.', 2)
+        if len(parts) >= 3:
+            domain = parts[2]  # mc.example.com
+            if shared:
+                # 每个服务一条 A 记录: natter-minecraft-tcp.mc.example.com
+                return f"natter-{parts[0].lstrip('_')}-{parts[1].lstrip('_')}.{domain}".lower()
+            # 生成 A 记录名称: natter-server.mc.example.com
+            return f"natter-server.{domain}"
+        else:
+            # 降级方案
+            return f"natter-server.{CF_DOMAIN}"
+
+    def record_keys(self):
+        """服务使用的记录在缓存中的键"""
+        return {("A", self.a_record_name.lower()), ("SRV", self.srv_name.lower())}
+
+    def build_a_record_data(self):
+        """生成 A 记录的请求数据"""
+        return {
+            "type": "A",
+            "name": self.a_record_name,
+            "content": self.current_ip,
+            "ttl": 120,
+            "proxied": False
+        }
+
+    def build_srv_record_data(self):
+        """生成 SRV 记录的请求数据"""
+        # 提取服务名和域名
+        # 例如: _minecraft._tcp.example.com
+        parts = self.srv_name.split('.', 2)
+        if len(parts) >= 3:
+            service = parts[0]  # _minecraft
+            proto = parts[1]    # _tcp
+            domain = parts[2]   # example.com
+        else:
+            service = "_minecraft"
+            proto = "_tcp"
+            domain = CF_DOMAIN
+        
+        # SRV 记录的 data 格式 - target 必须是主机名
+        srv_data = {
+            "type": "SRV",
+            "name": self.srv_name,
+            "data": {
+                "service": service,
+                "proto": proto,
+                "name": domain,
+                "priority": self.priority,
+                "weight": self.weight,
+                "port": self.current_port,
+                "target": self.a_record_name  # 使用 A 记录的主机名
+            },
+            "ttl": 120  # 2分钟 TTL，便于快速更新
+        }
+        
+        return srv_data
+
+    def build_records(self):
+        """生成当前映射需要发布的记录（A 记录在前）"""
+        if not self.current_ip or not self.current_port:
+            return []
+        return [self.build_a_record_data(), self.build_srv_record_data()]
+
+
+class NatterCloudFlare:
+    def __init__(self):
+        self.services = [
+            NatterService(entry['srv'], entry['port'], entry.get('args', NATTER_ARGS),
+                          entry.get('priority', SRV_PRIORITY), entry.get('weight', SRV_WEIGHT),
+                          entry.get('name'), entry.get('a_record'))
+            for entry in SERVICES
+        ]
+        # 同一域名下有多个服务时，每个服务使用自己的 A 记录，映射的 IP 不同时互不覆盖
+        defaults = [service.a_record_name for service in self.services if not service.a_record]
+        for service in self.services:
+            if not service.a_record and defaults.count(service.a_record_name) > 1:
+                service.a_record_name = service.generate_a_record_name(shared=True)
+        # 待发布的映射：每个服务只保留最新的一个，由更新线程统一处理
+        self.pending_mappings = {}
+        self.pending_cond = threading.Condition()
+        self.update_thread = None
+        self.natter_module = None
+        # CloudFlare 上已确认的记录（影子副本），内容相同时不再重复写入
+        # (类型, 名称) -> {"id": 记录ID, "state": 记录内容, "confirmed_at": 确认时间}
+        self.records = {}
+        self.state_file = CF_STATE_FILE
+        self.saved_state = None
         self.running = True
         self.show_srv_logs = SHOW_SRV_LOGS
-        
+        self.api = CloudFlareAPI(CF_API_TOKEN, CF_ZONE_ID, CF_API_TIMEOUT, CF_RETRIES, CF_RATE_LIMIT,
+                                 CF_API_BASE)
+        self.load_state()
+
     def log(self, message, level="INFO"):
         """输出日志"""
         timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
         print(f"[{timestamp}] [{level}] {message}")
         sys.stdout.flush()
 
-    def validate_srv_name(self):
+    def validate_srv_name(self, srv_name):
         """验证 SRV 记录名称格式"""
-        if not SRV_NAME.startswith('_'):
-            self.log(f"警告: SRV 名称应以 '_' 开头: {SRV_NAME}", "WARN")
+        if not srv_name.startswith('_'):
+            self.log(f"警告: SRV 名称应以 '_' 开头: {srv_name}", "WARN")
             return False
         
-        parts = SRV_NAME.split('.')
+        parts = srv_name.split('.')
         if len(parts) < 3:
             self.log(f"错误: SRV 名称格式不正确，应为 '_service._proto.domain'", "ERROR")
             self.log(f"示例: _minecraft._tcp.example.com", "ERROR")
@@ -101,7 +371,18 @@ class NatterCloudFlare:
         if not parts[1].startswith('_'):
             self.log(f"警告: 协议部分应以 '_' 开头，例如 _tcp 或 _udp", "WARN")
         
-        self.log(f"SRV 记录格式验证通过: {SRV_NAME}")
+        self.log(f"SRV 记录格式验证通过: {srv_name}")
+        return True
+
+    def validate_services(self):
+        """检查各服务的记录名称是否冲突，同一条记录只能由一个服务发布"""
+        owners = {}
+        for service in self.services:
+            for key in sorted(service.record_keys()):
+                if key in owners:
+                    self.log(f"错误: 服务 {owners[key]} 和 {service.name} 使用了同一条 {key[0]} 记录: {key[1]}", "ERROR")
+                    return False
+                owners[key] = service.name
         return True
 
 
@@ -109,7 +390,11 @@ class NatterCloudFlare:
     def parse_natter_output(self, line):
         """解析 Natter 输出，提取公网 IP 和端口"""
         # 匹配格式：tcp://内网IP:端口 <--method--> tcp://内网IP:端口 <--Natter--> tcp://公网IP:端口
-        pattern = r'<--Natter-->\s+tcp://(\d+\.\d+\.\d+\.\d+):(\d+)'
+        # UDP 模式下为 udp://
+        # 备用映射（standby: ...）格式相同，但不是当前使用的映射
+        if "standby:" in line:
+            return None, None
+        pattern = r'<--Natter-->\s+(?:tcp|udp)://(\d+\.\d+\.\d+\.\d+):(\d+)'
         match = re.search(pattern, line)
         if match:
             ip = match.group(1)
@@ -117,13 +402,27 @@ class NatterCloudFlare:
             return ip, port
         return None, None
 
-    def start_natter(self):
-        """启动 Natter 进程"""
-        cmd = [sys.executable, NATTER_SCRIPT, "-p", str(NATTER_PORT)] + NATTER_ARGS
-        self.log(f"启动 Natter: {' '.join(cmd)}")
+    def natter_args(self, service):
+        """生成服务的 Natter 参数"""
+        args = ["-p", str(service.port)] + service.args
+        if NATTER_STANDBY:
+            # 保持一个备用映射，映射变化时直接切换，Natter 不需要重启
+            args.append("--standby")
+        if NATTER_STUN_CACHE:
+            # 记住各 STUN 服务器的延迟和失败次数，重启后优先使用可用的服务器
+            args += ["--stun-cache", NATTER_STUN_CACHE]
+        return args
+
+    def start_natter(self, service):
+        """启动服务的 Natter 进程"""
+        cmd = [sys.executable, NATTER_SCRIPT] + self.natter_args(service)
+        if NATTER_EVENTS:
+            # 事件以 JSON 行输出到标准输出，与日志一起读取
+            cmd += ["-o", "-"]
+        self.log(f"[{service.name}] 启动 Natter: {' '.join(cmd)}")
         
         try:
-            self.natter_process = subprocess.Popen(
+            service.natter_process = subprocess.Popen(
                 cmd,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
@@ -132,318 +431,468 @@ class NatterCloudFlare:
             )
             return True
         except Exception as e:
-            self.log(f"启动 Natter 失败: {e}", "ERROR")
+            self.log(f"[{service.name}] 启动 Natter 失败: {e}", "ERROR")
             return False
 
-    def monitor_natter_output(self):
-        """监控 Natter 输出"""
-        self.log("开始监控 Natter 输出...")
+    def load_natter(self):
+        """以模块方式加载 natter.py（内嵌模式）"""
+        if self.natter_module is None:
+            spec = importlib.util.spec_from_file_location("natter", NATTER_SCRIPT)
+            module = importlib.util.module_from_spec(spec)
+            # socket-mp 的工作进程以 spawn 方式启动，需要能按模块名重新导入 natter
+            natter_dir = os.path.dirname(os.path.abspath(NATTER_SCRIPT))
+            if natter_dir not in sys.path:
+                sys.path.append(natter_dir)
+            sys.modules["natter"] = module
+            spec.loader.exec_module(module)
+            self.natter_module = module
+        return self.natter_module
+
+    def start_natter_thread(self, service):
+        """在当前进程的线程中启动服务的 Natter（内嵌模式）"""
+        args = self.natter_args(service)
+        self.log(f"[{service.name}] 启动内嵌 Natter: {' '.join(args)}")
+        
+        try:
+            natter = self.load_natter()
+
+            def on_mapping(inner, outer, proto):
+                # 已停止或被替换的线程不再上报映射
+                if service.natter_thread is thread:
+                    self.on_natter_mapping(service, outer)
+
+            thread = natter.NatterThread(args, on_mapping=on_mapping)
+            service.natter_thread = thread
+            thread.start()
+            return True
+        except Exception as e:
+            self.log(f"[{service.name}] 启动 Natter 失败: {e}", "ERROR")
+            return False
+
+    def on_natter_mapping(self, service, outer_addr):
+        """Natter 获得映射时调用（内嵌模式下在 Natter 线程中调用，不能阻塞）"""
+        ip, port = outer_addr
+        if (ip, port) != service.last_mapping:
+            self.log(f"[{service.name}] 检测到新的映射: {ip}:{port}")
+            service.last_mapping = (ip, port)
+            # 交给更新线程处理，读取线程不等待网络请求
+            self.submit_mapping(service, ip, port)
+
+    def handle_natter_event(self, service, line):
+        """处理 Natter 输出的 JSON 事件"""
+        try:
+            event = json.loads(line)
+        except ValueError:
+            self.log(f"[{service.name}] 无法解析 Natter 事件: {line}", "WARN")
+            return
         
-        for line in iter(self.natter_process.stdout.readline, ''):
+        name = event.get("event")
+        if name == "mapping":
+            self.on_natter_mapping(service, tuple(event["outer"]))
+        elif name == "mapping_changed":
+            old, new = event["old"], event["new"]
+            self.log(f"[{service.name}] 映射已变化: {old[0]}:{old[1]} -> {new[0]}:{new[1]}，等待 Natter 重新建立映射")
+        elif name == "keepalive" and not event.get("ok"):
+            self.log(f"[{service.name}] Natter 保活失败: {event.get('error')}", "WARN")
+
+    def monitor_natter_output(self, service):
+        """监控服务的 Natter 输出"""
+        self.log(f"[{service.name}] 开始监控 Natter 输出...")
+        prefix = f"[{service.name}] " if len(self.services) > 1 else ""
+        
+        for line in iter(service.natter_process.stdout.readline, ''):
             if not line:
                 break
             
             line = line.strip()
-            if line:
-                print(line)  # 输出原始日志
+            if NATTER_EVENTS and line.startswith("{"):
+                self.handle_natter_event(service, line)
+            elif line:
+                print(prefix + line)  # 输出原始日志
                 sys.stdout.flush()
                 
+                # 启用事件输出时，映射从事件中获得
+                if NATTER_EVENTS:
+                    continue
+                
                 # 尝试解析 IP 和端口
                 ip, port = self.parse_natter_output(line)
                 if ip and port:
-                    if ip != self.current_ip or port != self.current_port:
-                        self.log(f"检测到新的映射: {ip}:{port}")
-                        self.current_ip = ip
-                        self.current_port = port
-                        self.update_cloudflare_srv()
+                    self.on_natter_mapping(service, (ip, port))
         
         # 检查进程是否异常退出
-        if self.natter_process:
-            return_code = self.natter_process.poll()
+        if service.natter_process:
+            return_code = service.natter_process.poll()
             if return_code is not None:
-                self.log(f"Natter 进程退出，返回码: {return_code}", "WARN")
+                self.log(f"[{service.name}] Natter 进程退出，返回码: {return_code}", "WARN")
 
-    def get_cloudflare_headers(self):
-        """获取 CloudFlare API 请求头"""
-        return {
-            "Authorization": f"Bearer {CF_API_TOKEN}",
-            "Content-Type": "application/json"
-        }
+    def submit_mapping(self, service, ip, port):
+        """提交服务的新映射，该服务尚未处理的旧映射直接被覆盖"""
+        with self.pending_cond:
+            pending = self.pending_mappings.get(service.name)
+            if pending is not None:
+                self.log(f"[{service.name}] 合并未处理的映射: {pending[0]}:{pending[1]} -> {ip}:{port}")
+            self.pending_mappings[service.name] = (ip, port)
+            self.pending_cond.notify()
 
-    def find_srv_record(self):
-        """查找现有的 SRV 记录"""
-        url = f"https://api.cloudflare.com/client/v4/zones/{CF_ZONE_ID}/dns_records"
-        params = {
-            "type": "SRV",
-            "name": SRV_NAME
+    def start_update_worker(self):
+        """启动 DNS 更新线程"""
+        if self.update_thread and self.update_thread.is_alive():
+            return
+        self.update_thread = threading.Thread(target=self.update_worker, daemon=True)
+        self.update_thread.start()
+
+    def update_worker(self):
+        """DNS 更新线程：取出所有服务的最新映射，合并成一次更新发布"""
+        services = {service.name: service for service in self.services}
+        
+        while self.running:
+            with self.pending_cond:
+                while not self.pending_mappings and self.running:
+                    self.pending_cond.wait()
+                if not self.running:
+                    return
+                pending, self.pending_mappings = self.pending_mappings, {}
+            
+            for name, (ip, port) in pending.items():
+                services[name].current_ip, services[name].current_port = ip, port
+            
+            try:
+                failed = self.update_cloudflare_srv()
+            except CloudFlareAbort as e:
+                self.log(str(e))
+                continue
+            except Exception as e:
+                self.log(f"更新 DNS 记录时出错: {e}", "ERROR")
+                failed = [service for service in self.services if service.build_records()]
+            
+            if failed:
+                # 更新失败，没有新的映射时稍后重新发布这些服务的当前映射
+                names = ", ".join(service.name for service in failed)
+                self.log(f"DNS 记录未能更新（{names}），{CF_RETRY_INTERVAL}秒后重试", "WARN")
+                with self.pending_cond:
+                    if not self.pending_mappings and self.running:
+                        self.pending_cond.wait(CF_RETRY_INTERVAL)
+                    for service in failed:
+                        self.pending_mappings.setdefault(
+                            service.name, (service.current_ip, service.current_port))
+
+    def abort_for(self, records):
+        """重试期间这些记录所属的服务出现了新的映射，就放弃旧的写入"""
+        keys = {self.record_key(record) for record in records}
+        names = [service.name for service in self.services if service.record_keys() & keys]
+        return lambda: any(name in self.pending_mappings for name in names)
+
+    def stop_update_worker(self):
+        """通知 DNS 更新线程退出"""
+        with self.pending_cond:
+            self.running = False
+            self.pending_cond.notify_all()
+
+    @staticmethod
+    def record_key(record):
+        """记录在缓存中的键：(类型, 名称)"""
+        return record["type"], record["name"].rstrip(".").lower()
+
+    @staticmethod
+    def record_state(record):
+        """提取记录中影响解析结果的字段，用于判断是否需要更新"""
+        if record.get("type") == "SRV":
+            data = record.get("data") or {}
+            return ("SRV", data.get("priority"), data.get("weight"), data.get("port"),
+                    str(data.get("target", "")).rstrip(".").lower(), record.get("ttl"))
+        return (record.get("type"), record.get("content"), record.get("ttl"), record.get("proxied"))
+
+    def record_id(self, record):
+        """获取记录在 CloudFlare 上的 ID，未知时返回 None"""
+        cached = self.records.get(self.record_key(record))
+        return cached["id"] if cached else None
+
+    def record_outdated(self, record):
+        """判断记录内容是否与已确认的内容不同"""
+        cached = self.records.get(self.record_key(record))
+        return cached is None or self.record_state(record) != cached["state"]
+
+    def confirm_record(self, record):
+        """记录 CloudFlare 确认过的记录 ID 和内容"""
+        if record.get("type") not in ("A", "SRV"):
+            return
+        self.records[self.record_key(record)] = {
+            "id": record["id"],
+            "state": self.record_state(record),
+            "confirmed_at": int(time.time())
         }
+
+    def invalidate_record(self, record):
+        """清除缓存的记录 ID 和内容（记录在 CloudFlare 上已不存在）"""
+        self.records.pop(self.record_key(record), None)
+
+    def load_state(self):
+        """从状态文件恢复记录 ID 和已发布内容，重启后无需重新查询"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
         
         try:
-            response = requests.get(url, headers=self.get_cloudflare_headers(), params=params)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data["success"] and data["result"]:
-                self.srv_record_id = data["result"][0]["id"]
-                self.log(f"找到现有 SRV 记录: {self.srv_record_id}")
-                return True
-            else:
-                self.log("未找到现有 SRV 记录，将创建新记录")
-                return False
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
         except Exception as e:
-            self.log(f"查询 SRV 记录失败: {e}", "ERROR")
-            return False
-
-    def generate_a_record_name(self):
-        """生成 A 记录的主机名"""
-        # 从 SRV 名称提取域名部分
-        # 例如: _minecraft._tcp.mc.example.com -> mc.example.com
-        parts = SRV_NAME.split('.', 2)
-        if len(parts) >= 3:
-            domain = parts[2]  # mc.example.com
-            # 生成 A 记录名称: natter-server.mc.example.com
-            self.a_record_name = f"natter-server.{domain}"
-        else:
-            # 降级方案
-            self.a_record_name = f"natter-server.{CF_DOMAIN}"
+            self.log(f"读取状态文件失败，将重新查询记录: {e}", "WARN")
+            return
+        
+        # 配置变化后缓存的记录不再适用
+        if state.get("zone_id") != CF_ZONE_ID:
+            self.log("状态文件与当前 Zone 不匹配，忽略")
+            return
+        
+        # 只恢复当前服务会用到的记录
+        wanted = set()
+        for service in self.services:
+            wanted |= service.record_keys()
+        for entry in state.get("records", []):
+            if not entry.get("id") or not entry.get("name"):
+                continue
+            key = self.record_key(entry)
+            if key in wanted:
+                self.records[key] = {
+                    "id": entry["id"],
+                    "state": tuple(entry["state"]) if entry.get("state") else None,
+                    "confirmed_at": entry.get("confirmed_at")
+                }
         
-        return self.a_record_name
+        self.saved_state = self.build_state()
+        self.log(f"已从状态文件恢复 {len(self.records)} 条记录")
 
-    def find_a_record(self):
-        """查找现有的 A 记录"""
-        if not self.a_record_name:
-            self.generate_a_record_name()
+    def build_state(self):
+        """生成要写入状态文件的内容"""
+        records = [
+            {
+                "type": record_type,
+                "name": name,
+                "id": cached["id"],
+                "state": list(cached["state"]) if cached["state"] else None,
+                "confirmed_at": cached["confirmed_at"]
+            }
+            for (record_type, name), cached in sorted(self.records.items())
+        ]
         
-        url = f"https://api.cloudflare.com/client/v4/zones/{CF_ZONE_ID}/dns_records"
-        params = {
-            "type": "A",
-            "name": self.a_record_name
+        # 每个服务最近一次发布的 IP 和端口
+        services = {}
+        for service in self.services:
+            a_record = self.records.get(("A", service.a_record_name.lower()))
+            srv_record = self.records.get(("SRV", service.srv_name.lower()))
+            services[service.name] = {
+                "ip": a_record["state"][1] if a_record and a_record["state"] else None,
+                "port": srv_record["state"][3] if srv_record and srv_record["state"] else None
+            }
+        
+        return {
+            "zone_id": CF_ZONE_ID,
+            "records": records,
+            "services": services
         }
+
+    def save_state(self):
+        """原子地写入状态文件（先写临时文件再替换），内容未变化时不写"""
+        if not self.state_file:
+            return
         
+        state = self.build_state()
+        if state == self.saved_state:
+            return
+        
+        tmp_file = f"{self.state_file}.tmp"
         try:
-            response = requests.get(url, headers=self.get_cloudflare_headers(), params=params)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data["success"] and data["result"]:
-                self.a_record_id = data["result"][0]["id"]
-                self.log(f"找到现有 A 记录: {self.a_record_name} -> {self.a_record_id}")
-                return True
-            else:
-                self.log(f"未找到现有 A 记录: {self.a_record_name}")
-                return False
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(dict(state, saved_at=int(time.time())), f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.state_file)
+            self.sync_dir(self.state_file)
+            self.saved_state = state
         except Exception as e:
-            self.log(f"查询 A 记录失败: {e}", "ERROR")
-            return False
+            self.log(f"写入状态文件失败: {e}", "WARN")
 
-    def create_or_update_a_record(self):
-        """创建或更新 A 记录"""
-        if not self.a_record_name:
-            self.generate_a_record_name()
-        
-        if self.a_record_id:
-            # 更新现有 A 记录
-            return self.update_a_record()
-        else:
-            # 创建新 A 记录
-            return self.create_a_record()
+    @staticmethod
+    def sync_dir(path):
+        """将目录写入磁盘，使替换文件的操作在断电后也能保留（Windows 上不支持，跳过）"""
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
-    def create_a_record(self):
-        """创建 A 记录"""
-        url = f"https://api.cloudflare.com/client/v4/zones/{CF_ZONE_ID}/dns_records"
-        
-        a_data = {
-            "type": "A",
-            "name": self.a_record_name,
-            "content": self.current_ip,
-            "ttl": 120,
-            "proxied": False
+    def describe_record(self, record):
+        """记录的简短描述，用于日志"""
+        if record["type"] == "SRV":
+            return f"{record['name']} -> {record['data']['target']}:{record['data']['port']}"
+        return f"{record['name']} -> {record['content']}"
+
+    def format_errors(self, data):
+        """格式化 CloudFlare 返回的错误信息"""
+        errors = data.get('errors', [])
+        return '; '.join([f"{e.get('code', 'N/A')}: {e.get('message', 'Unknown')}" for e in errors])
+
+    def find_record(self, record, abort=None):
+        """查找现有的 A 或 SRV 记录"""
+        params = {
+            "type": record["type"],
+            "name": record["name"]
         }
         
-        self.log(f"创建 A 记录: {self.a_record_name} -> {self.current_ip}")
-        
         try:
-            response = requests.post(url, headers=self.get_cloudflare_headers(), json=a_data)
+            response = self.api.request("GET", abort=abort, params=params)
             response.raise_for_status()
             data = response.json()
             
-            if data.get("success"):
-                self.a_record_id = data["result"]["id"]
-                self.log(f"创建 A 记录成功: {self.a_record_name} -> {self.current_ip}")
+            if data["success"] and data["result"]:
+                self.confirm_record(data["result"][0])
+                self.log(f"找到现有 {record['type']} 记录: {record['name']} -> {data['result'][0]['id']}")
                 return True
             else:
-                errors = data.get('errors', [])
-                error_msg = '; '.join([f"{e.get('code', 'N/A')}: {e.get('message', 'Unknown')}" for e in errors])
-                self.log(f"创建 A 记录失败: {error_msg}", "ERROR")
+                self.log(f"未找到现有 {record['type']} 记录: {record['name']}，将创建新记录")
                 return False
+        except CloudFlareAbort:
+            raise
         except Exception as e:
-            self.log(f"创建 A 记录时出错: {e}", "ERROR")
+            self.log(f"查询 {record['type']} 记录失败: {e}", "ERROR")
             return False
 
-    def update_a_record(self):
-        """更新 A 记录"""
-        url = f"https://api.cloudflare.com/client/v4/zones/{CF_ZONE_ID}/dns_records/{self.a_record_id}"
-        
-        a_data = {
-            "type": "A",
-            "name": self.a_record_name,
-            "content": self.current_ip,
-            "ttl": 120,
-            "proxied": False
-        }
-        
-        self.log(f"更新 A 记录: {self.a_record_name} -> {self.current_ip}")
+    def create_record(self, record, abort=None):
+        """创建新的 A 或 SRV 记录"""
+        self.log(f"创建 {record['type']} 记录: {self.describe_record(record)}")
+        if self.show_srv_logs and record["type"] == "SRV":
+            self.log(f"创建 SRV 记录请求数据: {json.dumps(record, indent=2)}", "DEBUG")
         
         try:
-            response = requests.put(url, headers=self.get_cloudflare_headers(), json=a_data)
+            response = self.api.request("POST", abort=abort, json=record)
+            
             response.raise_for_status()
             data = response.json()
             
             if data.get("success"):
-                self.log(f"更新 A 记录成功: {self.a_record_name} -> {self.current_ip}")
+                self.confirm_record(data["result"])
+                self.log(f"创建 {record['type']} 记录成功: {self.describe_record(record)}")
                 return True
             else:
-                errors = data.get('errors', [])
-                error_msg = '; '.join([f"{e.get('code', 'N/A')}: {e.get('message', 'Unknown')}" for e in errors])
-                self.log(f"更新 A 记录失败: {error_msg}", "ERROR")
+                self.log(f"创建 {record['type']} 记录失败: {self.format_errors(data)}", "ERROR")
                 return False
+        except CloudFlareAbort:
+            raise
+        except requests.exceptions.HTTPError as e:
+            self.log(f"HTTP错误 {e.response.status_code}: {e.response.text}", "ERROR")
+            return False
         except Exception as e:
-            self.log(f"更新 A 记录时出错: {e}", "ERROR")
+            self.log(f"创建 {record['type']} 记录时出错: {e}", "ERROR")
             return False
 
-    def create_srv_record(self):
-        """创建新的 SRV 记录"""
-        url = f"https://api.cloudflare.com/client/v4/zones/{CF_ZONE_ID}/dns_records"
-        
-        # 提取服务名和域名
-        # 例如: _minecraft._tcp.example.com
-        parts = SRV_NAME.split('.', 2)
-        if len(parts) >= 3:
-            service = parts[0]  # _minecraft
-            proto = parts[1]    # _tcp
-            domain = parts[2]   # example.com
-        else:
-            service = "_minecraft"
-            proto = "_tcp"
-            domain = CF_DOMAIN
-        
-        # 确保 A 记录存在
-        if not self.a_record_name:
-            self.generate_a_record_name()
-        
-        # SRV 记录的 data 格式 - target 必须是主机名
-        srv_data = {
-            "type": "SRV",
-            "name": SRV_NAME,
-            "data": {
-                "service": service,
-                "proto": proto,
-                "name": domain,
-                "priority": SRV_PRIORITY,
-                "weight": SRV_WEIGHT,
-                "port": self.current_port,
-                "target": self.a_record_name  # 使用 A 记录的主机名
-            },
-            "ttl": 120  # 2分钟 TTL，便于快速更新
-        }
-        
-        if self.show_srv_logs:
-            self.log(f"创建 SRV 记录请求数据: {json.dumps(srv_data, indent=2)}", "DEBUG")
+    def update_record(self, record, retry=True, abort=None):
+        """更新现有的 A 或 SRV 记录"""
+        self.log(f"更新 {record['type']} 记录: {self.describe_record(record)}")
+        if self.show_srv_logs and record["type"] == "SRV":
+            self.log(f"更新 SRV 记录请求数据: {json.dumps(record, indent=2)}", "DEBUG")
         
         try:
-            response = requests.post(url, headers=self.get_cloudflare_headers(), json=srv_data)
+            response = self.api.request("PUT", self.record_id(record), abort=abort, json=record)
             
             response.raise_for_status()
             data = response.json()
             
             if data.get("success"):
-                self.srv_record_id = data["result"]["id"]
-                self.log(f"创建 SRV 记录成功: {SRV_NAME} -> {self.a_record_name}:{self.current_port}")
+                self.confirm_record(data["result"])
+                self.log(f"更新 {record['type']} 记录成功: {self.describe_record(record)}")
                 return True
             else:
-                errors = data.get('errors', [])
-                error_msg = '; '.join([f"{e.get('code', 'N/A')}: {e.get('message', 'Unknown')}" for e in errors])
-                self.log(f"创建 SRV 记录失败: {error_msg}", "ERROR")
+                self.log(f"更新 {record['type']} 记录失败: {self.format_errors(data)}", "ERROR")
                 return False
+        except CloudFlareAbort:
+            raise
         except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 404 and retry:
+                # 缓存的记录 ID 已失效（记录被删除），重新查询
+                self.log(f"{record['type']} 记录不存在，重新查询", "WARN")
+                self.invalidate_record(record)
+                if self.find_record(record, abort):
+                    return self.update_record(record, retry=False, abort=abort)
+                return self.create_record(record, abort)
             self.log(f"HTTP错误 {e.response.status_code}: {e.response.text}", "ERROR")
             return False
         except Exception as e:
-            self.log(f"创建 SRV 记录时出错: {e}", "ERROR")
+            self.log(f"更新 {record['type']} 记录时出错: {e}", "ERROR")
             return False
 
-    def update_srv_record(self):
-        """更新现有的 SRV 记录"""
-        url = f"https://api.cloudflare.com/client/v4/zones/{CF_ZONE_ID}/dns_records/{self.srv_record_id}"
-        
-        # 提取服务名和域名
-        parts = SRV_NAME.split('.', 2)
-        if len(parts) >= 3:
-            service = parts[0]  # _minecraft
-            proto = parts[1]    # _tcp
-            domain = parts[2]   # example.com
+    def create_or_update_record(self, record, abort=None):
+        """创建或更新记录"""
+        if self.record_id(record):
+            return self.update_record(record, abort=abort)
         else:
-            service = "_minecraft"
-            proto = "_tcp"
-            domain = CF_DOMAIN
-        
-        # 确保 A 记录存在
-        if not self.a_record_name:
-            self.generate_a_record_name()
-        
-        # SRV 记录的 data 格式 - target 必须是主机名
-        srv_data = {
-            "type": "SRV",
-            "name": SRV_NAME,
-            "data": {
-                "service": service,
-                "proto": proto,
-                "name": domain,
-                "priority": SRV_PRIORITY,
-                "weight": SRV_WEIGHT,
-                "port": self.current_port,
-                "target": self.a_record_name  # 使用 A 记录的主机名
-            },
-            "ttl": 120
-        }
+            return self.create_record(record, abort)
+
+    def batch_update_records(self, records, abort=None):
+        """通过批量接口在一次请求中提交所有需要更新的记录"""
+        batch = {"posts": [], "puts": []}
+        for record in records:
+            record_id = self.record_id(record)
+            if record_id:
+                batch["puts"].append(dict(record, id=record_id))
+            else:
+                batch["posts"].append(record)
         
         if self.show_srv_logs:
-            self.log(f"更新 SRV 记录请求数据: {json.dumps(srv_data, indent=2)}", "DEBUG")
+            self.log(f"批量更新请求数据: {json.dumps(batch, indent=2)}", "DEBUG")
         
         try:
-            response = requests.put(url, headers=self.get_cloudflare_headers(), json=srv_data)
+            response = self.api.request("POST", "batch", abort=abort, json=batch)
             
             response.raise_for_status()
             data = response.json()
             
             if data.get("success"):
-                self.log(f"更新 SRV 记录成功: {SRV_NAME} -> {self.a_record_name}:{self.current_port}")
-                # 显示CloudFlare返回的实际内容
-                if "result" in data and "content" in data["result"]:
-                    self.log(f"CloudFlare 记录内容: {data['result']['content']}")
+                result = data.get("result") or {}
+                for record in result.get("posts", []) + result.get("puts", []):
+                    self.confirm_record(record)
+                for record in records:
+                    self.log(f"批量更新成功: {self.describe_record(record)}")
                 return True
             else:
-                errors = data.get('errors', [])
-                error_msg = '; '.join([f"{e.get('code', 'N/A')}: {e.get('message', 'Unknown')}" for e in errors])
-                self.log(f"更新 SRV 记录失败: {error_msg}", "ERROR")
+                self.log(f"批量更新失败: {self.format_errors(data)}", "WARN")
                 return False
+        except CloudFlareAbort:
+            raise
         except requests.exceptions.HTTPError as e:
-            self.log(f"HTTP错误 {e.response.status_code}: {e.response.text}", "ERROR")
+            self.log(f"批量更新 HTTP错误 {e.response.status_code}: {e.response.text}", "WARN")
             return False
         except Exception as e:
-            self.log(f"更新 SRV 记录时出错: {e}", "ERROR")
+            self.log(f"批量更新时出错: {e}", "WARN")
             return False
 
-    def verify_srv_record(self):
-        """验证 SRV 记录是否正确更新"""
-        if not self.srv_record_id:
+    def check_srv_record(self, service):
+        """根据写入请求返回的记录内容确认服务的 SRV 记录是否正确"""
+        cached = self.records.get(("SRV", service.srv_name.lower()))
+        if not cached or not cached["state"]:
             return
         
-        self.log("正在验证 SRV 记录...")
-        url = f"https://api.cloudflare.com/client/v4/zones/{CF_ZONE_ID}/dns_records/{self.srv_record_id}"
+        record_port = cached["state"][3]
+        if str(record_port) == str(service.current_port):
+            self.log(f"✓ SRV 记录已更新: {service.srv_name} -> {cached['state'][4]}:{record_port}")
+        else:
+            self.log(f"✗ 端口不匹配！CloudFlare返回: {record_port}, 应该是: {service.current_port}", "WARN")
+
+    def schedule_verify(self, service):
+        """按采样比例在后台重新查询 SRV 记录，不阻塞下一次更新"""
+        record_id = self.record_id(service.build_srv_record_data())
+        if not record_id or random.random() >= CF_VERIFY_SAMPLE:
+            return
         
+        abort = self.abort_for([service.build_srv_record_data()])
+        threading.Thread(target=self.verify_srv_record,
+                         args=(record_id, service.current_port, abort), daemon=True).start()
+
+    def verify_srv_record(self, record_id, expected_port, abort=None):
+        """查询 SRV 记录，验证 CloudFlare 上的内容是否与期望一致"""
         try:
-            response = requests.get(url, headers=self.get_cloudflare_headers())
+            response = self.api.request("GET", record_id, abort=abort)
             response.raise_for_status()
             data = response.json()
             
@@ -451,84 +900,152 @@ class NatterCloudFlare:
                 result = data["result"]
                 record_port = result.get("data", {}).get("port", "未知")
                 record_target = result.get("data", {}).get("target", "未知")
-                record_content = result.get("content", "未知")
                 
-                self.log("=" * 60)
-                self.log("SRV 记录验证结果:")
-                self.log(f"  记录名称: {result.get('name', '未知')}")
-                self.log(f"  记录ID: {result.get('id', '未知')}")
-                self.log(f"  目标主机: {record_target}")
-                self.log(f"  端口: {record_port}")
-                self.log(f"  完整内容: {record_content}")
-                self.log(f"  期望端口: {self.current_port}")
-                
-                if str(record_port) == str(self.current_port):
-                    self.log("✓ 端口匹配，更新成功！")
+                if str(record_port) == str(expected_port):
+                    self.log(f"验证 SRV 记录: {result.get('name', '未知')} -> {record_target}:{record_port}，端口匹配")
                 else:
-                    self.log(f"✗ 端口不匹配！CloudFlare显示: {record_port}, 应该是: {self.current_port}", "WARN")
-                
-                self.log("=" * 60)
-                
+                    self.log(f"验证 SRV 记录: 端口不匹配！CloudFlare显示: {record_port}, 应该是: {expected_port}", "WARN")
+        
+        except CloudFlareAbort:
+            # 服务已有新的映射，这次验证的结果没有意义
+            self.log("服务有新的映射等待发布，跳过 SRV 记录验证")
         except Exception as e:
             self.log(f"验证 SRV 记录时出错: {e}", "ERROR")
 
     def update_cloudflare_srv(self):
-        """更新 CloudFlare SRV 记录（自动判断创建或更新）"""
-        if not self.current_ip or not self.current_port:
+        """发布所有服务的当前映射（自动判断创建或更新），返回未能更新的服务"""
+        # 合并所有服务需要的记录，每条记录只属于一个服务（启动时已检查）
+        desired = {}
+        for service in self.services:
+            for record in service.build_records():
+                desired[self.record_key(record)] = record
+        
+        if not desired:
             self.log("IP 或端口未设置，跳过更新", "WARN")
-            return
+            return []
         
-        self.log(f"准备更新 CloudFlare SRV 记录: {self.current_ip}:{self.current_port}")
+        # 步骤1: 查询未知的记录，同时得到 CloudFlare 上的当前内容
+        for key, record in desired.items():
+            if key not in self.records:
+                self.find_record(record, self.abort_for([record]))
         
-        # 步骤1: 确保 A 记录存在
-        if self.a_record_id is None:
-            self.find_a_record()
+        # 步骤2: 与已确认的内容比较，只提交发生变化的记录
+        outdated = [record for record in desired.values() if self.record_outdated(record)]
+        if not outdated:
+            self.log("DNS 记录内容未变化，跳过更新")
+            self.save_state()
+            return []
         
-        # 创建或更新 A 记录
-        if not self.create_or_update_a_record():
-            self.log("A 记录创建/更新失败，跳过 SRV 记录更新", "ERROR")
-            return
+        self.log(f"准备更新 CloudFlare 记录: {len(outdated)} 条")
+        try:
+            self.apply_updates(outdated)
+        finally:
+            self.save_state()
         
-        # 步骤2: 如果还没有查询过 SRV 记录 ID，先查询
-        if self.srv_record_id is None:
-            if self.find_srv_record():
-                # 找到了，更新
-                self.update_srv_record()
-            else:
-                # 没找到，创建
-                self.create_srv_record()
-        else:
-            # 已经有记录 ID，直接更新
-            self.update_srv_record()
+        # 步骤3: 根据返回内容确认更新结果，按需在后台复查
+        failed = []
+        for service in self.services:
+            records = service.build_records()
+            if any(self.record_outdated(record) for record in records):
+                failed.append(service)
+            elif any(record["type"] == "SRV" and record in outdated for record in records):
+                self.check_srv_record(service)
+                self.schedule_verify(service)
+        return failed
+
+    def apply_updates(self, records):
+        """提交需要更新的记录"""
+        if CF_BATCH_UPDATE:
+            # 所有记录在同一个请求中提交，同时生效
+            if self.batch_update_records(records, self.abort_for(records)):
+                return
+            # 缓存的记录 ID 失效时，逐条更新会在 404 后重新查询
+            self.log("批量更新失败，改为逐条更新", "WARN")
+            # 批量请求可能已经在服务端生效（只是没有收到响应），
+            # 先重新查询要创建的记录，避免重复创建
+            for record in records:
+                if not self.record_id(record):
+                    self.find_record(record, self.abort_for([record]))
+            records = [record for record in records if self.record_outdated(record)]
         
-        # 步骤3: 验证更新结果
-        self.verify_srv_record()
+        # 先更新 A 记录，失败时跳过指向它的 SRV 记录
+        failed_targets = set()
+        for record in sorted(records, key=lambda r: r["type"] != "A"):
+            if record["type"] == "SRV" and record["data"]["target"] in failed_targets:
+                self.log(f"A 记录创建/更新失败，跳过 SRV 记录更新: {record['name']}", "ERROR")
+                continue
+            if not self.create_or_update_record(record, self.abort_for([record])) and record["type"] == "A":
+                failed_targets.add(record["name"])
 
-    def stop_natter(self):
-        """停止 Natter 进程"""
-        if self.natter_process:
-            self.log("正在停止 Natter...")
-            self.natter_process.terminate()
-            try:
-                self.natter_process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                self.log("强制终止 Natter 进程")
-                self.natter_process.kill()
-            self.natter_process = None
-            self.current_ip = None
-            self.current_port = None
+    def stop_natter(self, service=None):
+        """停止 Natter 进程（未指定服务时停止所有服务）"""
+        for service in [service] if service else self.services:
+            if service.natter_thread:
+                self.log(f"[{service.name}] 正在停止 Natter...")
+                if not service.natter_thread.stop(timeout=5):
+                    self.log(f"[{service.name}] Natter 线程未能在 5 秒内停止，已放弃等待", "WARN")
+                service.natter_thread = None
+                service.last_mapping = None
+            if service.natter_process:
+                self.log(f"[{service.name}] 正在停止 Natter...")
+                service.natter_process.terminate()
+                try:
+                    service.natter_process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self.log(f"[{service.name}] 强制终止 Natter 进程")
+                    service.natter_process.kill()
+                service.natter_process = None
+                # 重启后重新上报映射（内容未变化时更新线程不会写入）
+                service.last_mapping = None
 
 
 
     def signal_handler(self, signum, frame):
         """处理退出信号"""
         self.log("收到退出信号，正在清理...")
-        self.running = False
+        self.stop_update_worker()
         self.stop_natter()
+        self.api.close()
         sys.exit(0)
 
 
 
+    def run_service(self, service):
+        """服务的运行循环 - Natter 会自动处理 IP 变化和重启"""
+        # 重启等待时间：从 1 秒开始，连续快速退出时逐渐加倍，最长 60 秒
+        restart_delay = 1
+        while self.running:
+            # 启动 Natter
+            started_at = time.monotonic()
+            started = self.start_natter_thread(service) if NATTER_EMBED else self.start_natter(service)
+            if not started:
+                self.log(f"[{service.name}] Natter 启动失败，{restart_delay}秒后重试...", "ERROR")
+                time.sleep(restart_delay)
+                restart_delay = min(restart_delay * 2, 60)
+                continue
+            
+            if NATTER_EMBED:
+                # 映射通过回调上报，等待 Natter 线程结束
+                natter_thread = service.natter_thread
+                natter_thread.join()
+                if natter_thread.error:
+                    self.log(f"[{service.name}] Natter 异常退出: {natter_thread.error}", "WARN")
+            else:
+                # 监控输出
+                try:
+                    self.monitor_natter_output(service)
+                except Exception as e:
+                    self.log(f"[{service.name}] 监控过程出错: {e}", "ERROR")
+            
+            # 如果进程退出且仍在运行状态，说明 Natter 自动重启了
+            if self.running:
+                # 运行了一段时间后退出（通常是映射变化），尽快重启
+                if time.monotonic() - started_at >= 60:
+                    restart_delay = 1
+                self.log(f"[{service.name}] Natter 重新启动中（可能检测到 IP 变化），{restart_delay}秒后启动...", "INFO")
+                time.sleep(restart_delay)
+                restart_delay = min(restart_delay * 2, 60)
+
     def run(self):
         """主运行函数"""
         # 注册信号处理
@@ -538,33 +1055,28 @@ class NatterCloudFlare:
         self.log("=" * 50)
         self.log("Natter CloudFlare SRV Updater 启动")
         self.log("=" * 50)
-        self.log(f"目标域名: {SRV_NAME}")
-        self.log(f"映射端口: {NATTER_PORT}")
+        for service in self.services:
+            self.log(f"目标域名: {service.srv_name}，映射端口: {service.port}")
         self.log("注意: IP 变化检测由 Natter 自动处理")
         
         # 验证 SRV 名称格式
-        if not self.validate_srv_name():
-            self.log("配置验证失败，请检查 SRV 记录名称格式", "ERROR")
+        for service in self.services:
+            if not self.validate_srv_name(service.srv_name):
+                self.log("配置验证失败，请检查 SRV 记录名称格式", "ERROR")
+                return
+        if not self.validate_services():
+            self.log("配置验证失败，请为每个服务使用不同的 SRV 记录名称和 A 记录（a_record）", "ERROR")
             return
         
-        # 主循环 - Natter 会自动处理 IP 变化和重启
+        # DNS 更新在独立线程中进行，不阻塞 Natter 输出的读取；所有服务共用
+        self.start_update_worker()
+        
+        # 每个服务一个线程运行 Natter 并读取输出
+        for service in self.services:
+            threading.Thread(target=self.run_service, args=(service,), daemon=True).start()
+        
         while self.running:
-            # 启动 Natter
-            if not self.start_natter():
-                self.log("Natter 启动失败，60秒后重试...", "ERROR")
-                time.sleep(60)
-                continue
-            
-            # 监控输出
-            try:
-                self.monitor_natter_output()
-            except Exception as e:
-                self.log(f"监控过程出错: {e}", "ERROR")
-            
-            # 如果进程退出且仍在运行状态，说明 Natter 自动重启了
-            if self.running:
-                self.log("Natter 重新启动中（可能检测到 IP 变化）...", "INFO")
-                time.sleep(5)
+            time.sleep(1)
         
         self.stop_natter()
 
@@ -582,6 +1094,14 @@ def main():
         print("     - srv.name: SRV 记录名称（如 _minecraft._tcp.example.com）")
         return 1
     
+    # 检查服务配置
+    for entry in SERVICES:
+        if not entry.get('srv') or not entry.get('port'):
+            print("错误: 每个服务都需要配置 SRV 记录名称和映射端口")
+            print("  - 单个服务: srv.name 和 natter.port")
+            print("  - 多个服务: services 列表中每一项的 srv 和 port")
+            return 1
+    
     # 检查 PyYAML 是否安装
     try:
         import yaml
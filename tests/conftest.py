@@ -0,0 +1,207 @@
+import os
+import sys
+import time
+import socket
+import struct
+import importlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+
+@pytest.fixture(scope="session")
+def servers():
+    # loopback echo, discard and source servers of the forward benchmark
+    from bench_forward import Servers
+    servers = Servers()
+    yield servers
+    servers.close()
+
+
+class FakeStun(object):
+    # loopback STUN servers over TCP and UDP that map every client to
+    # OUTER_IP and its source port plus one (or `offset`), and an HTTP
+    # server to keep TCP mappings alive, which hangs up on the source
+    # ports in `drop`
+    OUTER_IP = "203.0.113.5"
+
+    class KeepAlive(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self):
+            if self.client_address[1] in self.server.drop:
+                self.close_connection = True
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        do_GET = do_HEAD
+
+        def log_message(self, format, *args):
+            pass
+
+    def __init__(self):
+        self.socks = []
+        self.offset = 1
+        self.requests = 0
+        tcp = self._bind(socket.SOCK_STREAM)
+        tcp.listen(socket.SOMAXCONN)
+        threading.Thread(target=self._serve_tcp, args=(tcp,), daemon=True).start()
+        udp = self._bind(socket.SOCK_DGRAM)
+        threading.Thread(target=self._serve_udp, args=(udp,), daemon=True).start()
+        self.http = ThreadingHTTPServer(("127.0.0.1", 0), FakeStun.KeepAlive)
+        self.http.daemon_threads = True
+        self.http.drop = self.drop = set()
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        self.tcp = tcp.getsockname()
+        self.udp = udp.getsockname()
+
+    def _bind(self, sock_type):
+        sock = socket.socket(socket.AF_INET, sock_type)
+        sock.bind(("127.0.0.1", 0))
+        self.socks.append(sock)
+        return sock
+
+    def response(self, request, addr):
+        self.requests += 1
+        attr = struct.pack("!HHBBH4s", 1, 8, 0, 1, (addr[1] + self.offset) & 0xffff,
+                           socket.inet_aton(FakeStun.OUTER_IP))
+        return struct.pack("!HHL12s", 0x0101, len(attr), 0x2112a442, request[8:20]) + attr
+
+    def _serve_tcp(self, sock):
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except OSError:
+                return
+            try:
+                conn.sendall(self.response(conn.recv(1500), addr))
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+    def _serve_udp(self, sock):
+        while True:
+            try:
+                request, addr = sock.recvfrom(1500)
+                sock.sendto(self.response(request, addr), addr)
+            except OSError:
+                return
+
+    def close(self):
+        self.http.shutdown()
+        self.http.server_close()
+        for sock in self.socks:
+            sock.close()
+
+
+@pytest.fixture
+def stun():
+    stun = FakeStun()
+    yield stun
+    stun.close()
+
+
+def natter_args(stun, *args):
+    # Natter arguments that use only the fake STUN and keep-alive servers
+    return [
+        "-s", "%s:%d" % stun.tcp, "-h", "%s:%d" % stun.http.server_address[:2],
+        "-k", "1", "-m", "none"
+    ] + list(args)
+
+
+@pytest.fixture(scope="session")
+def cf_module(tmp_path_factory):
+    # import with the built-in defaults rather than a config.yaml that
+    # happens to be in the current directory
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("config"))
+    try:
+        return importlib.import_module("natter_cloudflare")
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def cf(cf_module, monkeypatch):
+    # module globals are the updater's configuration, restored after each test
+    monkeypatch.setattr(cf_module, "CF_API_TOKEN", "test")
+    monkeypatch.setattr(cf_module, "CF_STATE_FILE", None)
+    monkeypatch.setattr(cf_module, "CF_VERIFY_SAMPLE", 0)
+    monkeypatch.setattr(cf_module, "CF_BATCH_UPDATE", True)
+    monkeypatch.setattr(cf_module, "SERVICES", [{"srv": "_minecraft._tcp.example.com", "port": 25565}])
+    return cf_module
+
+
+@pytest.fixture
+def fake():
+    from fake_cloudflare import FakeCloudFlare
+    fake = FakeCloudFlare(retry_after=0).start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def updater(cf, fake, monkeypatch):
+    monkeypatch.setattr(cf, "CF_ZONE_ID", fake.zone_id)
+    monkeypatch.setattr(cf, "CF_API_BASE", fake.url)
+    updater = cf.NatterCloudFlare()
+    yield updater
+    updater.api.close()
+
+
+@pytest.fixture
+def forward():
+    # forward(cls, target, udp=False) starts a forwarder on a free loopback
+    # port and returns (forwarder, addr); all are stopped after the test
+    from bench_forward import free_port
+    started = []
+
+    def start(cls, target, udp=False, **attrs):
+        forwarder = cls()
+        for name, value in attrs.items():
+            setattr(forwarder, name, value)
+        addr = ("127.0.0.1", free_port(udp))
+        forwarder.start_forward(addr[0], addr[1], target[0], target[1], udp=udp)
+        started.append(forwarder)
+        return forwarder, addr
+
+    yield start
+    for forwarder in started:
+        forwarder.stop_forward()
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def recv_all(sock):
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return b"".join(chunks)
+        chunks.append(data)
+
+
+def tcp_request(addr, data, timeout=5):
+    # send data, half-close and read the reply until the forwarder closes
+    sock = socket.create_connection(addr, timeout=timeout)
+    try:
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        return recv_all(sock)
+    finally:
+        sock.close()
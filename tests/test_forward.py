@@ -0,0 +1,325 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import natter
+from conftest import recv_all, tcp_request, wait_until
+
+
+def reply_after_eof(conn):
+    # answers only once the client has half-closed its side
+    data = recv_all(conn)
+    conn.sendall(data[::-1])
+
+
+def hold_after_eof(release):
+    def handler(conn):
+        recv_all(conn)
+        release.wait(10)
+    return handler
+
+
+def reset_after_first_byte(conn):
+    conn.recv(1)
+    # closing with a zero linger time sends RST
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+
+
+def echo_round_trips(addr, clients=8, size=256 * 1024):
+    payloads = [bytes([i]) * size for i in range(clients)]
+    replies = [None] * clients
+
+    def client(i):
+        replies[i] = tcp_request(addr, payloads[i])
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join(10)
+    assert replies == payloads
+
+
+# ---------- socket-select TCP ----------
+
+def test_select_tcp_round_trip(servers, forward):
+    forwarder, addr = forward(natter.ForwardSocketSelect, servers.tcp_echo)
+    echo_round_trips(addr)
+    assert wait_until(lambda: forwarder.get_stats()["conn_active"] == 0)
+    stats = forwarder.get_stats()
+    assert stats["conn_total"] == 8
+    assert stats["conn_errors"] == 0
+    assert stats["bytes_in"] == stats["bytes_out"] == 8 * 256 * 1024
+
+
+def test_select_tcp_half_close(servers, forward):
+    target = servers._tcp_server(reply_after_eof)
+    _, addr = forward(natter.ForwardSocketSelect, target)
+    assert tcp_request(addr, b"hello, natter") == b"rettan ,olleh"
+
+
+def test_select_stop_closes_half_closed_connections(servers, forward):
+    release = threading.Event()
+    target = servers._tcp_server(hold_after_eof(release))
+    forwarder, addr = forward(natter.ForwardSocketSelect, target)
+    try:
+        sock = socket.create_connection(addr, timeout=5)
+        sock.sendall(b"x")
+        sock.shutdown(socket.SHUT_WR)
+        # the client channel has reached EOF and left the selector, the
+        # target keeps its side open
+        assert wait_until(lambda: forwarder.get_stats()["bytes_in"] == 1)
+        assert forwarder.get_stats()["conn_active"] == 1
+        forwarder.stop_forward()
+        assert wait_until(lambda: forwarder.get_stats()["conn_active"] == 0)
+        assert recv_all(sock) == b""
+        sock.close()
+    finally:
+        release.set()
+
+
+def udp_round_trips(addr, clients=4, count=50):
+    socks = []
+    for i in range(clients):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        sock.connect(addr)
+        socks.append(sock)
+    try:
+        for n in range(count):
+            for i, sock in enumerate(socks):
+                sock.send(b"%d:%d" % (i, n))
+            for i, sock in enumerate(socks):
+                assert sock.recv(65536) == b"%d:%d" % (i, n)
+    finally:
+        for sock in socks:
+            sock.close()
+
+
+def test_select_udp_round_trip(servers, forward):
+    forwarder, addr = forward(natter.ForwardSocketSelect, servers.udp_echo, udp=True)
+    udp_round_trips(addr)
+    stats = forwarder.get_stats()
+    # one session per client address
+    assert stats["conn_active"] == stats["conn_total"] == 4
+    assert stats["packets_in"] == stats["packets_out"] == 4 * 50
+
+
+def test_select_udp_idle_session_is_closed(servers, forward):
+    forwarder, addr = forward(natter.ForwardSocketSelect, servers.udp_echo, udp=True,
+                              udp_timeout=0.2)
+    udp_round_trips(addr, clients=1, count=1)
+    assert forwarder.get_stats()["conn_active"] == 1
+    assert wait_until(lambda: forwarder.get_stats()["conn_active"] == 0)
+    assert forwarder.get_stats()["conn_errors"] == 0
+
+
+# ---------- threaded socket ----------
+
+def test_socket_tcp_counts_traffic(servers, forward):
+    forwarder, addr = forward(natter.ForwardSocket, servers.tcp_echo)
+    echo_round_trips(addr, clients=4)
+    assert wait_until(lambda: forwarder.get_stats()["conn_active"] == 0)
+    stats = forwarder.get_stats()
+    assert stats["conn_total"] == 4
+    assert stats["conn_errors"] == 0
+    assert stats["bytes_in"] == stats["bytes_out"] == 4 * 256 * 1024
+    assert stats["packets_in"] > 0 and stats["packets_out"] > 0
+    assert stats["duration_max"] >= stats["duration_avg"] > 0
+
+
+def test_socket_tcp_half_close(servers, forward):
+    target = servers._tcp_server(reply_after_eof)
+    _, addr = forward(natter.ForwardSocket, target)
+    assert tcp_request(addr, b"hello, natter") == b"rettan ,olleh"
+
+
+def test_socket_udp_round_trip(servers, forward):
+    forwarder, addr = forward(natter.ForwardSocket, servers.udp_echo, udp=True)
+    udp_round_trips(addr)
+    stats = forwarder.get_stats()
+    assert stats["conn_active"] == stats["conn_total"] == 4
+    assert wait_until(lambda: forwarder.get_stats()["packets_out"] == 4 * 50)
+    assert stats["packets_in"] == 4 * 50
+
+
+def test_socket_udp_buffers_keep_datagrams_apart(servers, forward):
+    # the receive buffers are reused, a short datagram must not carry
+    # bytes left over from a longer one
+    forwarder, addr = forward(natter.ForwardSocket, servers.udp_echo, udp=True)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(5)
+    sock.connect(addr)
+    try:
+        for data in (b"a" * forwarder.udp_buff_size, b"b", b"c" * 1000, b"d"):
+            sock.send(data)
+            assert sock.recv(65536) == data
+    finally:
+        sock.close()
+
+
+def test_socket_slow_target_does_not_block_accept(forward):
+    # a target whose accept queue is full drops further SYNs, so connecting
+    # to it hangs until connect_timeout
+    target = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    target.bind(("127.0.0.1", 0))
+    target.listen(0)
+    queued = []
+    try:
+        for _ in range(2):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.connect_ex(target.getsockname())
+            queued.append(sock)
+        forwarder, addr = forward(natter.ForwardSocket, target.getsockname(), connect_timeout=2)
+        clients = [socket.create_connection(addr, timeout=5) for _ in range(3)]
+        # all three are accepted before the first connect times out
+        assert wait_until(lambda: forwarder.get_stats()["conn_total"] == 3, timeout=1)
+        assert wait_until(lambda: forwarder.get_stats()["conn_errors"] == 3)
+        for sock in clients:
+            assert recv_all(sock) == b""
+            sock.close()
+    finally:
+        for sock in queued:
+            sock.close()
+        target.close()
+
+
+@pytest.mark.parametrize("cls", [natter.ForwardSocket, natter.ForwardSocketSelect])
+def test_reset_is_counted_without_error_log(servers, forward, monkeypatch, cls):
+    errors = []
+    monkeypatch.setattr(natter.Logger, "error", staticmethod(errors.append))
+    target = servers._tcp_server(reset_after_first_byte)
+    forwarder, addr = forward(cls, target)
+    sock = socket.create_connection(addr, timeout=5)
+    sock.sendall(b"x")
+    try:
+        recv_all(sock)
+    except ConnectionResetError:
+        pass
+    sock.close()
+    assert wait_until(lambda: forwarder.get_stats()["conn_active"] == 0)
+    assert forwarder.get_stats()["conn_errors"] == 1
+    assert errors == []
+
+
+# ---------- socket-mp ----------
+
+def test_mp_stats_add_up_across_workers(servers, forward):
+    started = time.time()
+    forwarder, addr = forward(natter.ForwardSocketMP, servers.tcp_echo, num_workers=2)
+    # workers do not wait a second each for their relay thread
+    assert time.time() - started < 5
+    echo_round_trips(addr, clients=8, size=64 * 1024)
+    assert wait_until(lambda: forwarder.get_stats()["conn_total"] == 8)
+    assert wait_until(lambda: forwarder.get_stats()["conn_active"] == 0)
+    stats = forwarder.get_stats()
+    assert stats["bytes_in"] == stats["bytes_out"] == 8 * 64 * 1024
+    assert stats["conn_errors"] == 0
+    forwarder.stop_forward()
+    # counters of stopped workers are kept
+    assert forwarder.get_stats()["conn_total"] == 8
+
+
+def test_mp_restarts_dead_worker(servers, forward):
+    forwarder, addr = forward(natter.ForwardSocketMP, servers.tcp_echo, num_workers=1)
+    echo_round_trips(addr, clients=2, size=1024)
+    assert wait_until(lambda: forwarder.get_stats()["conn_total"] == 2)
+    pid = forwarder.workers[0].pid
+    forwarder.workers[0].kill()
+    assert wait_until(lambda: forwarder.workers[0].pid != pid and forwarder.workers[0].ready.is_set())
+    echo_round_trips(addr, clients=2, size=1024)
+    assert wait_until(lambda: forwarder.get_stats()["conn_total"] == 4)
+
+
+def test_workers_option_needs_socket_mp():
+    with pytest.raises(ValueError):
+        natter.natter_main(False, ["-m", "socket", "--workers", "2", "-t", "127.0.0.1", "-p", "80"])
+    with pytest.raises(ValueError):
+        natter.natter_main(False, ["-m", "socket-mp", "--workers", "0", "-t", "127.0.0.1", "-p", "80"])
+
+
+def test_backlog_option_needs_socket_or_asyncio():
+    with pytest.raises(ValueError):
+        natter.natter_main(False, ["-m", "socat", "--backlog", "64", "-t", "127.0.0.1", "-p", "80"])
+    with pytest.raises(ValueError):
+        natter.natter_main(False, ["-m", "socket", "--backlog", "-1", "-t", "127.0.0.1", "-p", "80"])
+
+
+# ---------- socket-splice ----------
+
+needs_splice = pytest.mark.skipif(not hasattr(natter.os, "splice"), reason="splice(2) is not available")
+
+
+@needs_splice
+def test_splice_pipe_is_resized():
+    forwarder = natter.ForwardSocketSplice()
+    forwarder.pipe_size = 262144
+    pipe_r, pipe_w, chunk_size = forwarder._open_pipe()
+    natter.os.close(pipe_r)
+    natter.os.close(pipe_w)
+    assert chunk_size == 262144
+
+
+@needs_splice
+def test_splice_tcp_round_trip(servers, forward):
+    forwarder, addr = forward(natter.ForwardSocketSplice, servers.tcp_echo)
+    echo_round_trips(addr, clients=4)
+    assert wait_until(lambda: forwarder.get_stats()["conn_active"] == 0)
+    stats = forwarder.get_stats()
+    assert stats["conn_errors"] == 0
+    assert stats["bytes_in"] == stats["bytes_out"] == 4 * 256 * 1024
+
+
+@needs_splice
+def test_splice_tcp_half_close(servers, forward):
+    target = servers._tcp_server(reply_after_eof)
+    _, addr = forward(natter.ForwardSocketSplice, target)
+    assert tcp_request(addr, b"hello, natter") == b"rettan ,olleh"
+
+
+# ---------- asyncio ----------
+
+def test_asyncio_tcp_round_trip(servers, forward):
+    forwarder, addr = forward(natter.ForwardAsyncio, servers.tcp_echo)
+    echo_round_trips(addr)
+    assert wait_until(lambda: forwarder.get_stats()["conn_active"] == 0)
+    stats = forwarder.get_stats()
+    assert stats["conn_total"] == 8
+    assert stats["conn_errors"] == 0
+    assert stats["bytes_in"] == stats["bytes_out"] == 8 * 256 * 1024
+
+
+def test_asyncio_tcp_half_close(servers, forward):
+    target = servers._tcp_server(reply_after_eof)
+    _, addr = forward(natter.ForwardAsyncio, target)
+    assert tcp_request(addr, b"hello, natter") == b"rettan ,olleh"
+
+
+def test_asyncio_tcp_unreachable_target(forward):
+    from bench_forward import free_port
+    forwarder, addr = forward(natter.ForwardAsyncio, ("127.0.0.1", free_port()))
+    sock = socket.create_connection(addr, timeout=5)
+    # the client is dropped once connecting to the target has failed
+    assert recv_all(sock) == b""
+    sock.close()
+    assert wait_until(lambda: forwarder.get_stats()["conn_errors"] == 1)
+
+
+def test_asyncio_udp_round_trip(servers, forward):
+    forwarder, addr = forward(natter.ForwardAsyncio, servers.udp_echo, udp=True)
+    udp_round_trips(addr)
+    stats = forwarder.get_stats()
+    assert stats["conn_active"] == stats["conn_total"] == 4
+    assert stats["packets_in"] == stats["packets_out"] == 4 * 50
+
+
+def test_asyncio_udp_idle_session_is_closed(servers, forward):
+    forwarder, addr = forward(natter.ForwardAsyncio, servers.udp_echo, udp=True,
+                              udp_timeout=0.2)
+    udp_round_trips(addr, clients=1, count=1)
+    assert wait_until(lambda: forwarder.get_stats()["conn_active"] == 0)
+    assert forwarder.get_stats()["conn_errors"] == 0
@@ -0,0 +1,417 @@
+import os
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import natter
+from conftest import FakeStun, natter_args, wait_until
+
+
+# ---------- NatterThread ----------
+
+def test_natter_thread_reports_mapping(stun):
+    mappings = []
+    reported = threading.Event()
+
+    def on_mapping(inner, outer, protocol):
+        mappings.append((inner, outer, protocol))
+        reported.set()
+
+    thread = natter.NatterThread(natter_args(stun), on_mapping=on_mapping)
+    thread.start()
+    try:
+        assert reported.wait(15)
+    finally:
+        assert thread.stop(timeout=5)
+    inner, outer, protocol = mappings[0]
+    assert protocol == "tcp"
+    assert outer == (FakeStun.OUTER_IP, inner[1] + 1)
+    assert thread.error is None
+
+
+def test_natter_thread_reports_invalid_arguments():
+    thread = natter.NatterThread(["--no-such-option"])
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert isinstance(thread.error, SystemExit)
+
+
+# ---------- EventStream ----------
+
+def read_events(fd):
+    with os.fdopen(fd) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_event_stream_writes_json_lines_to_fd():
+    r, w = os.pipe()
+    events = natter.EventStream(str(w))
+    # the stream writes to its own copy of the descriptor
+    os.close(w)
+    events.emit("mapping", protocol="tcp", outer=["203.0.113.5", 40001])
+    events.emit("keepalive", ok=True)
+    events.close()
+    lines = read_events(r)
+    assert [line["event"] for line in lines] == ["mapping", "keepalive"]
+    assert lines[0]["outer"] == ["203.0.113.5", 40001]
+    assert lines[0]["time"] <= lines[1]["time"]
+
+
+def test_event_stream_writes_to_unix_socket(tmp_path):
+    path = str(tmp_path / "events.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    try:
+        events = natter.EventStream("unix:" + path)
+        conn, _ = server.accept()
+        events.emit("mapping_changed", old=["203.0.113.5", 1], new=["203.0.113.5", 2])
+        events.close()
+        lines = read_events(os.dup(conn.fileno()))
+        conn.close()
+    finally:
+        server.close()
+    assert lines[0]["event"] == "mapping_changed"
+    assert lines[0]["new"] == ["203.0.113.5", 2]
+
+
+def test_event_stream_stops_on_broken_pipe(monkeypatch):
+    errors = []
+    monkeypatch.setattr(natter.Logger, "error", staticmethod(errors.append))
+    r, w = os.pipe()
+    events = natter.EventStream(str(w))
+    os.close(w)
+    os.close(r)
+    events.emit("mapping")
+    events.emit("mapping")
+    assert len(errors) == 1
+    assert events.fp is None
+
+
+def test_natter_emits_mapping_event(stun):
+    r, w = os.pipe()
+    reported = threading.Event()
+    thread = natter.NatterThread(natter_args(stun, "-o", str(w)),
+                                 on_mapping=lambda *args: reported.set())
+    thread.start()
+    try:
+        assert reported.wait(15)
+    finally:
+        assert thread.stop(timeout=5)
+        os.close(w)
+    lines = read_events(r)
+    mapping = [line for line in lines if line["event"] == "mapping"][0]
+    assert mapping["protocol"] == "tcp"
+    assert mapping["outer"] == [FakeStun.OUTER_IP, mapping["natter"][1] + 1]
+
+
+# ---------- standby mapping ----------
+
+class EventReader(object):
+    # collects the events Natter writes to a pipe
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        self.events = []
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        with os.fdopen(self.r) as f:
+            for line in f:
+                self.events.append(json.loads(line))
+
+    def find(self, event):
+        return [e for e in self.events if e["event"] == event]
+
+    def close(self):
+        os.close(self.w)
+        self.thread.join(5)
+
+
+def test_standby_is_promoted_when_mapping_changes(stun):
+    events = EventReader()
+    mappings = []
+    thread = natter.NatterThread(natter_args(stun, "--standby", "-o", str(events.w)),
+                                 on_mapping=lambda *args: mappings.append(args))
+    thread.start()
+    try:
+        assert wait_until(lambda: events.find("standby"), timeout=15)
+        standby = events.find("standby")[0]
+        primary = mappings[0][0]
+        # the NAT maps every port elsewhere now, and the primary mapping
+        # loses its keep-alive connection, which triggers a recheck
+        stun.offset = 2
+        stun.drop.add(primary[1])
+        assert wait_until(lambda: len(mappings) == 2, timeout=15)
+        inner, outer, protocol = mappings[1]
+        assert inner[1] == standby["natter"][1]
+        assert outer == (FakeStun.OUTER_IP, inner[1] + 2)
+        # switched in place, Natter did not start over
+        assert [e["reason"] for e in events.find("forward_stopped")] == ["switching to standby mapping"]
+        assert [e["changed"] for e in events.find("recheck")] == [True]
+    finally:
+        assert thread.stop(timeout=5)
+        events.close()
+    assert thread.error is None
+
+
+# ---------- Metrics ----------
+
+@pytest.fixture
+def metrics():
+    metrics = natter.Metrics(("127.0.0.1", 0))
+    yield metrics
+    metrics.close()
+
+
+def scrape(addr, path="/metrics"):
+    with urllib.request.urlopen("http://%s:%d%s" % (addr[0], addr[1], path), timeout=5) as response:
+        return response.headers["Content-Type"], response.read().decode()
+
+
+def test_metrics_render_counters_and_gauges(metrics):
+    metrics.inc("natter_retries_total", reason="mapping_changed")
+    metrics.inc("natter_retries_total", 2, reason="mapping_changed")
+    metrics.set("natter_standby_up", 1, service='a "quoted"\\path')
+    lines = metrics.render().splitlines()
+    assert lines == [
+        "# HELP natter_retries_total Restarts of Natter, by reason.",
+        "# TYPE natter_retries_total counter",
+        'natter_retries_total{reason="mapping_changed"} 3',
+        "# HELP natter_standby_up 1 while a standby mapping is kept.",
+        "# TYPE natter_standby_up gauge",
+        'natter_standby_up{service="a \\"quoted\\"\\\\path"} 1',
+    ]
+
+
+def test_metrics_render_histogram(metrics):
+    for value in (0.003, 0.02, 0.02, 7):
+        metrics.observe("natter_keepalive_rtt_seconds", value, protocol="tcp")
+    lines = metrics.render().splitlines()
+    buckets = dict(
+        (line.split('le="')[1].split('"')[0], int(line.split()[-1]))
+        for line in lines if line.startswith("natter_keepalive_rtt_seconds_bucket")
+    )
+    assert buckets["0.005"] == 1
+    assert buckets["0.01"] == 1
+    assert buckets["0.025"] == 3
+    assert buckets["5.0"] == 3
+    assert buckets["10.0"] == buckets["+Inf"] == 4
+    assert 'natter_keepalive_rtt_seconds_count{protocol="tcp"} 4' in lines
+    assert 'natter_keepalive_rtt_seconds_sum{protocol="tcp"} 7.043' in lines
+
+
+def test_metrics_collectors_and_labels(metrics):
+    labeled = metrics.labeled(service="game")
+    labeled.collect("forward", lambda: [("natter_forward_up", {"method": "socket"}, 1)])
+    # a later collector with the same key replaces the first one
+    labeled.collect("forward", lambda: [("natter_forward_up", {"method": "asyncio"}, 0)])
+    metrics.collect("broken", lambda: 1 / 0)
+    labeled.inc("natter_stun_unavailable_total")
+    lines = metrics.render().splitlines()
+    assert 'natter_forward_up{method="asyncio",service="game"} 0' in lines
+    assert not [line for line in lines if 'method="socket"' in line]
+    assert 'natter_stun_unavailable_total{service="game"} 1' in lines
+
+
+def test_metrics_without_listen_address_record_nothing():
+    metrics = natter.Metrics()
+    metrics.inc("natter_retries_total", reason="x")
+    metrics.observe("natter_keepalive_rtt_seconds", 0.1)
+    assert metrics.render() == "\n"
+
+
+def test_metrics_are_served_over_http(metrics):
+    metrics.inc("natter_rechecks_total", result="unchanged")
+    content_type, body = scrape(metrics.server.server_address)
+    assert content_type.startswith("text/plain; version=0.0.4")
+    assert 'natter_rechecks_total{result="unchanged"} 1' in body
+    with pytest.raises(urllib.error.HTTPError) as ex:
+        scrape(metrics.server.server_address, "/")
+    assert ex.value.code == 404
+
+
+def test_natter_serves_mapping_metrics(stun):
+    from bench_forward import free_port
+    port = free_port()
+    reported = threading.Event()
+    thread = natter.NatterThread(natter_args(stun, "--metrics", str(port)),
+                                 on_mapping=lambda *args: reported.set())
+    thread.start()
+    try:
+        assert reported.wait(15)
+        _, body = scrape(("127.0.0.1", port))
+    finally:
+        assert thread.stop(timeout=5)
+        natter.Metrics.open(("127.0.0.1", port)).close()
+    assert "natter_info{" in body
+    assert 'outer="%s:' % FakeStun.OUTER_IP in body
+
+
+# ---------- STUN server racing ----------
+
+@pytest.fixture
+def dead_servers():
+    # a closed TCP port, a TCP server that never answers and a UDP server
+    # that never answers
+    from bench_forward import free_port
+    silent_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    silent_tcp.bind(("127.0.0.1", 0))
+    silent_tcp.listen(8)
+    silent_udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    silent_udp.bind(("127.0.0.1", 0))
+    yield ("127.0.0.1", free_port()), silent_tcp.getsockname(), silent_udp.getsockname()
+    silent_tcp.close()
+    silent_udp.close()
+
+
+def test_race_tcp_skips_dead_servers(stun, dead_servers):
+    refused, silent, _ = dead_servers
+    client = natter.StunClient([refused, silent, stun.tcp], "127.0.0.1", 0, race=3)
+    started = time.time()
+    inner, outer = client.get_mapping()
+    # the silent server is abandoned, not waited for
+    assert time.time() - started < 1
+    assert outer == (FakeStun.OUTER_IP, inner[1] + 1)
+    # the winner is asked first next time, the refused server last
+    assert client.stun_server_list == [stun.tcp, silent, refused]
+    assert client.health.score(client._health_key(refused)) > natter.StunHealth.UNKNOWN_LATENCY
+    assert client.health.score(client._health_key(silent)) == natter.StunHealth.UNKNOWN_LATENCY
+    # later requests keep the source port of the mapping
+    assert client.get_mapping()[0] == inner
+
+
+def test_race_udp_answers_from_one_socket(stun, dead_servers):
+    _, _, silent = dead_servers
+    client = natter.StunClient([silent, stun.udp], "127.0.0.1", 0, udp=True, race=2)
+    started = time.time()
+    inner, outer = client.get_mapping()
+    # the second server is started one stagger after the first
+    assert client.stagger <= time.time() - started < 1
+    assert outer == (FakeStun.OUTER_IP, inner[1] + 1)
+    assert client.stun_server_list[0] == stun.udp
+    assert client.get_mapping()[0] == inner
+
+
+def test_race_all_servers_dead(dead_servers):
+    refused, silent, _ = dead_servers
+    client = natter.StunClient([refused, silent], "127.0.0.1", 0, race=2)
+    client.timeout = 0.3
+    started = time.time()
+    with pytest.raises(natter.StunClient.ServerUnavailable):
+        client.get_mapping(once=True)
+    assert time.time() - started < 1
+
+
+def test_race_is_interrupted_by_stop_event(dead_servers):
+    _, silent, _ = dead_servers
+    stop_event = threading.Event()
+    client = natter.StunClient([silent], "127.0.0.1", 0, race=2, stop_event=stop_event)
+    threading.Timer(0.2, stop_event.set).start()
+    started = time.time()
+    with pytest.raises(natter.NatterExitException):
+        client.get_mapping()
+    assert time.time() - started < 1
+
+
+# ---------- StunHealth ----------
+
+def test_unknown_server_scores_default_latency():
+    health = natter.StunHealth()
+    assert health.score("udp://stun.example.com:3478") == natter.StunHealth.UNKNOWN_LATENCY
+
+
+def test_faster_server_sorts_first():
+    health = natter.StunHealth()
+    health.success("slow", 0.4)
+    health.success("fast", 0.05)
+    servers = ["unknown", "slow", "fast"]
+    servers.sort(key=health.score)
+    assert servers == ["fast", "slow", "unknown"]
+
+
+def test_latency_is_averaged():
+    health = natter.StunHealth()
+    health.success("a", 0.1)
+    health.success("a", 0.2)
+    assert abs(health.score("a") - (0.1 + natter.StunHealth.ALPHA * 0.1)) < 1e-9
+
+
+def test_failure_moves_server_behind_unknown():
+    health = natter.StunHealth()
+    health.success("a", 0.05)
+    health.failure("a")
+    assert health.score("a") > health.score("unknown")
+    # a success clears the penalty
+    health.success("a", 0.05)
+    assert health.score("a") < health.score("unknown")
+
+
+def test_failure_penalty_fades():
+    health = natter.StunHealth()
+    health.success("a", 0.05)
+    health.failure("a")
+    failed_at = health.table["a"]["last_failure"]
+    fresh = health.score("a", now=failed_at)
+    half = health.score("a", now=failed_at + natter.StunHealth.PENALTY_HALF_LIFE)
+    old = health.score("a", now=failed_at + 24 * natter.StunHealth.PENALTY_HALF_LIFE)
+    assert abs(fresh - (0.05 + natter.StunHealth.FAILURE_PENALTY)) < 1e-9
+    assert abs(half - (0.05 + natter.StunHealth.FAILURE_PENALTY / 2)) < 1e-9
+    assert old < health.score("unknown")
+
+
+def test_failures_are_capped():
+    health = natter.StunHealth()
+    for _ in range(20):
+        health.failure("a")
+    now = health.table["a"]["last_failure"]
+    assert health.score("a", now) == natter.StunHealth.UNKNOWN_LATENCY + 5 * natter.StunHealth.FAILURE_PENALTY
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "stun.json")
+    health = natter.StunHealth(path)
+    health.success("fast", 0.05)
+    health.success("slow", 0.3)
+    health.failure("down")
+    health.save()
+    with open(path) as f:
+        assert set(json.load(f)["servers"]) == set(["fast", "slow", "down"])
+
+    loaded = natter.StunHealth(path)
+    servers = ["down", "slow", "fast"]
+    servers.sort(key=loaded.score)
+    assert servers == ["fast", "slow", "down"]
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_load_ignores_broken_file(tmp_path):
+    path = tmp_path / "stun.json"
+    path.write_text("{")
+    health = natter.StunHealth(str(path))
+    assert health.table == {}
+    assert health.score("a") == natter.StunHealth.UNKNOWN_LATENCY
+
+
+def test_stun_client_tries_best_server_first(monkeypatch):
+    health = natter.StunHealth()
+    servers = [("a.example.com", 3478), ("b.example.com", 3478), ("c.example.com", 3478)]
+    client = natter.StunClient(list(servers), udp=True, health=health)
+    health.success(client._health_key(servers[2]), 0.05)
+    health.failure(client._health_key(servers[0]))
+    tried = []
+
+    def fake_get_mapping():
+        tried.append(client.stun_server_list[0])
+        return ("192.168.1.10", 40000), ("203.0.113.1", 40000)
+
+    monkeypatch.setattr(client, "_get_mapping", fake_get_mapping)
+    client.get_mapping()
+    assert tried == [servers[2]]
+    assert client.stun_server_list == [servers[2], servers[1], servers[0]]
@@ -0,0 +1,449 @@
+import json
+import time
+
+import pytest
+
+from conftest import FakeStun, natter_args, wait_until
+
+SRV_NAME = "_minecraft._tcp.example.com"
+A_NAME = "natter-server.example.com"
+
+
+def publish(updater, ip, port):
+    service = updater.services[0]
+    service.current_ip, service.current_port = ip, port
+    return updater.update_cloudflare_srv()
+
+
+def writes(fake):
+    calls = fake.stats()["calls"]
+    return dict((kind, calls[kind]) for kind in ("create", "put", "batch") if kind in calls)
+
+
+def assert_published(fake, ip, port):
+    a = fake.find("A", A_NAME)
+    srv = fake.find("SRV", SRV_NAME)
+    assert a["content"] == ip
+    assert srv["data"]["port"] == port
+    assert srv["data"]["target"] == A_NAME
+    assert len(fake.records) == 2
+
+
+# ---------- batch update ----------
+
+def test_first_update_creates_records_in_one_batch(updater, fake):
+    assert publish(updater, "203.0.113.7", 40001) == []
+    assert_published(fake, "203.0.113.7", 40001)
+    assert writes(fake) == {"batch": 1}
+    # the records were looked up once before being created
+    assert fake.stats()["calls"]["list"] == 2
+
+
+def test_failed_batch_falls_back_to_single_updates(updater, fake):
+    publish(updater, "203.0.113.7", 40001)
+    fake.inject(500)
+    assert publish(updater, "203.0.113.8", 40002) == []
+    assert_published(fake, "203.0.113.8", 40002)
+    calls = fake.stats()["calls"]
+    # the failed batch is not retried, both records are put one by one
+    assert calls["batch"] == 2
+    assert calls["put"] == 2
+
+
+def test_failed_batch_does_not_duplicate_records(updater, fake):
+    # the batch is applied but its response is lost: the fallback must find
+    # the created records instead of creating them again
+    original = updater.batch_update_records
+
+    def lost_response(records, abort=None):
+        original(records, abort)
+        updater.records.clear()
+        return False
+
+    updater.batch_update_records = lost_response
+    assert publish(updater, "203.0.113.7", 40001) == []
+    assert_published(fake, "203.0.113.7", 40001)
+    assert "create" not in fake.stats()["calls"]
+
+
+def test_without_batch_records_are_written_one_by_one(updater, fake, cf, monkeypatch):
+    monkeypatch.setattr(cf, "CF_BATCH_UPDATE", False)
+    publish(updater, "203.0.113.7", 40001)
+    assert writes(fake) == {"create": 2}
+    publish(updater, "203.0.113.7", 40002)
+    assert writes(fake) == {"create": 2, "put": 1}
+    assert_published(fake, "203.0.113.7", 40002)
+
+
+# ---------- desired-state diffing ----------
+
+def test_unchanged_mapping_is_not_written(updater, fake):
+    publish(updater, "203.0.113.7", 40001)
+    before = fake.stats()["total_calls"]
+    assert publish(updater, "203.0.113.7", 40001) == []
+    assert fake.stats()["total_calls"] == before
+
+
+def test_port_change_only_writes_srv(updater, fake):
+    publish(updater, "203.0.113.7", 40001)
+    a_before = fake.find("A", A_NAME)
+    calls_before = fake.stats()["calls"]
+
+    captured = []
+    request = updater.api.request
+
+    def spy(method, path=None, abort=None, **kwargs):
+        captured.append((method, path, kwargs.get("json")))
+        return request(method, path, abort=abort, **kwargs)
+
+    updater.api.request = spy
+    assert publish(updater, "203.0.113.7", 40002) == []
+    assert_published(fake, "203.0.113.7", 40002)
+    assert fake.find("A", A_NAME) == a_before
+    assert len(captured) == 1
+    method, path, body = captured[0]
+    assert (method, path) == ("POST", "batch")
+    assert body["posts"] == []
+    assert [record["type"] for record in body["puts"]] == ["SRV"]
+    # ids come from the cache, nothing is looked up again
+    assert fake.stats()["calls"]["list"] == calls_before["list"]
+
+
+def test_existing_records_are_adopted(updater, fake, cf):
+    publish(updater, "203.0.113.7", 40001)
+    # a restarted updater without a state file finds the records and only updates
+    fresh = cf.NatterCloudFlare()
+    try:
+        assert publish(fresh, "203.0.113.7", 40001) == []
+        assert writes(fake) == {"batch": 1}
+        assert publish(fresh, "203.0.113.8", 40001) == []
+    finally:
+        fresh.api.close()
+    assert_published(fake, "203.0.113.8", 40001)
+
+
+# ---------- state file ----------
+
+def test_state_file_restores_records(updater, fake, cf, tmp_path):
+    path = str(tmp_path / "state.json")
+    updater.state_file = path
+    publish(updater, "203.0.113.7", 40001)
+    with open(path) as f:
+        state = json.load(f)
+    assert state["zone_id"] == fake.zone_id
+    assert state["services"][SRV_NAME] == {"ip": "203.0.113.7", "port": 40001}
+    assert not list(tmp_path.glob("*.tmp"))
+
+    # a restarted updater neither looks the records up nor writes them again
+    before = fake.stats()["total_calls"]
+    fresh = cf.NatterCloudFlare()
+    fresh.state_file = path
+    fresh.load_state()
+    try:
+        assert publish(fresh, "203.0.113.7", 40001) == []
+        assert fake.stats()["total_calls"] == before
+        assert publish(fresh, "203.0.113.7", 40002) == []
+    finally:
+        fresh.api.close()
+    assert fake.stats()["calls"]["list"] == 2
+    assert_published(fake, "203.0.113.7", 40002)
+
+
+def test_state_file_of_another_zone_is_ignored(updater, cf, tmp_path):
+    path = tmp_path / "state.json"
+    path.write_text(json.dumps({
+        "zone_id": "another-zone",
+        "records": [{"type": "A", "name": A_NAME, "id": "1", "state": ["A", "203.0.113.7", 120, False]}]
+    }))
+    updater.state_file = str(path)
+    updater.load_state()
+    assert updater.records == {}
+
+
+def test_broken_state_file_is_ignored(updater, tmp_path):
+    path = tmp_path / "state.json"
+    path.write_text("{")
+    updater.state_file = str(path)
+    updater.load_state()
+    assert updater.records == {}
+
+
+# ---------- update queue ----------
+
+@pytest.fixture
+def worker(updater):
+    # runs the update worker, stopped after the test
+    yield updater
+    updater.stop_update_worker()
+    if updater.update_thread:
+        updater.update_thread.join(5)
+
+
+def srv_port(port):
+    def predicate(fake):
+        srv = fake._find("SRV", SRV_NAME)
+        return srv is not None and srv["data"]["port"] == port
+    return predicate
+
+
+def test_pending_mappings_are_coalesced(worker, fake):
+    service = worker.services[0]
+    for port in (40001, 40002, 40003):
+        worker.submit_mapping(service, "203.0.113.7", port)
+    assert worker.pending_mappings == {service.name: ("203.0.113.7", 40003)}
+    worker.start_update_worker()
+    assert fake.wait_for(srv_port(40003), 5)
+    assert writes(fake) == {"batch": 1}
+
+
+def test_mapping_submitted_during_update_is_published_next(worker, fake):
+    service = worker.services[0]
+    fake.latency = 0.2
+    worker.start_update_worker()
+    worker.submit_mapping(service, "203.0.113.7", 40001)
+    # the first update is in flight, the next two are merged behind it
+    assert wait_until(lambda: fake.stats()["total_calls"] > 0)
+    worker.submit_mapping(service, "203.0.113.7", 40002)
+    worker.submit_mapping(service, "203.0.113.7", 40003)
+    assert fake.wait_for(srv_port(40003), 5)
+    assert wait_until(lambda: not worker.pending_mappings)
+    assert writes(fake) == {"batch": 2}
+
+
+def test_failed_update_is_retried(worker, fake, cf, monkeypatch):
+    monkeypatch.setattr(cf, "CF_RETRY_INTERVAL", 0.2)
+    service = worker.services[0]
+    publish(worker, "203.0.113.7", 40001)
+    worker.api.retries = 0
+    # the batch, its single write fallback and the next batch fail
+    fake.inject(500, 3)
+    worker.start_update_worker()
+    worker.submit_mapping(service, "203.0.113.8", 40002)
+    assert fake.wait_for(srv_port(40002), 5)
+    assert_published(fake, "203.0.113.8", 40002)
+    assert fake.stats()["statuses"]["500"] == 3
+
+
+# ---------- rate limits and retries ----------
+
+class FakeResponse(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def test_backoff_uses_retry_after(cf):
+    api = cf.CloudFlareAPI("token", "zone")
+    assert api.backoff(5, FakeResponse({"Retry-After": "7"})) == 7
+    assert api.backoff(0, FakeResponse({"Retry-After": "-1"})) == 0
+
+
+def test_backoff_without_retry_after(cf):
+    api = cf.CloudFlareAPI("token", "zone")
+    for attempt in range(10):
+        delay = min(api.BACKOFF_MAX, api.BACKOFF_BASE * 2 ** attempt)
+        for response in (None, FakeResponse({}), FakeResponse({"Retry-After": "soon"})):
+            assert delay / 2 <= api.backoff(attempt, response) <= delay
+
+
+def test_acquire_token_bucket(cf):
+    api = cf.CloudFlareAPI("token", "zone", rate_limit=3)
+    assert [api.acquire() for _ in range(3)] == [0, 0, 0]
+    wait = api.acquire()
+    # one request every RATE_PERIOD / rate_limit seconds
+    assert 0 < wait <= api.RATE_PERIOD / 3
+    api.refilled -= api.RATE_PERIOD / 3
+    assert api.acquire() == 0
+
+
+def test_acquire_unlimited(cf):
+    api = cf.CloudFlareAPI("token", "zone", rate_limit=0)
+    assert all(api.acquire() == 0 for _ in range(5000))
+
+
+def test_acquire_honours_blocked_until(cf):
+    api = cf.CloudFlareAPI("token", "zone", rate_limit=0)
+    api.blocked_until = time.monotonic() + 10
+    assert 9 < api.acquire() <= 10
+    api.blocked_until = time.monotonic() - 1
+    assert api.acquire() == 0
+
+
+def test_rate_limited_batch_is_retried(updater, fake):
+    fake.inject(429)
+    publish(updater, "203.0.113.7", 40001)
+    fake.inject(429)
+    assert publish(updater, "203.0.113.7", 40002) == []
+    assert_published(fake, "203.0.113.7", 40002)
+    assert fake.stats()["statuses"]["429"] == 2
+
+
+def test_newer_mapping_aborts_retries(updater, fake, cf):
+    publish(updater, "203.0.113.7", 40001)
+    fake.inject(429, 100)
+    fake.retry_after = 5
+    service = updater.services[0]
+    updater.pending_mappings[service.name] = ("203.0.113.9", 40003)
+    started = time.monotonic()
+    with pytest.raises(cf.CloudFlareAbort):
+        publish(updater, "203.0.113.8", 40002)
+    assert time.monotonic() - started < 2
+
+
+# ---------- multiple services ----------
+
+@pytest.fixture
+def make_updater(cf, fake, monkeypatch):
+    # make_updater(services) builds an updater for the given service entries
+    monkeypatch.setattr(cf, "CF_ZONE_ID", fake.zone_id)
+    monkeypatch.setattr(cf, "CF_API_BASE", fake.url)
+    created = []
+
+    def make(services):
+        monkeypatch.setattr(cf, "SERVICES", services)
+        updater = cf.NatterCloudFlare()
+        created.append(updater)
+        return updater
+
+    yield make
+    for updater in created:
+        updater.api.close()
+
+
+def test_services_in_one_domain_get_their_own_a_record(make_updater, fake):
+    updater = make_updater([
+        {"srv": "_minecraft._tcp.example.com", "port": 25565},
+        {"srv": "_minecraft._udp.example.com", "port": 19132},
+        {"srv": "_ts3._udp.voice.example.com", "port": 9987},
+    ])
+    assert [service.a_record_name for service in updater.services] == [
+        "natter-minecraft-tcp.example.com",
+        "natter-minecraft-udp.example.com",
+        "natter-server.voice.example.com",
+    ]
+    assert updater.validate_services()
+
+    mappings = [("203.0.113.7", 40001), ("203.0.113.8", 40002), ("203.0.113.9", 40003)]
+    for service, (ip, port) in zip(updater.services, mappings):
+        service.current_ip, service.current_port = ip, port
+    assert updater.update_cloudflare_srv() == []
+    # all six records are written in one batch
+    assert writes(fake) == {"batch": 1}
+    for service, (ip, port) in zip(updater.services, mappings):
+        assert fake.find("A", service.a_record_name)["content"] == ip
+        srv = fake.find("SRV", service.srv_name)
+        assert srv["data"]["target"] == service.a_record_name
+        assert srv["data"]["port"] == port
+
+
+def test_services_sharing_a_record_are_rejected(make_updater):
+    updater = make_updater([
+        {"srv": "_minecraft._tcp.example.com", "port": 25565, "a_record": "mc.example.com"},
+        {"srv": "_minecraft._udp.example.com", "port": 19132, "a_record": "MC.example.com"},
+    ])
+    assert not updater.validate_services()
+
+
+def test_services_sharing_srv_record_are_rejected(make_updater):
+    updater = make_updater([
+        {"srv": "_minecraft._tcp.example.com", "port": 25565, "name": "java"},
+        {"srv": "_minecraft._tcp.example.com", "port": 25566, "name": "modded"},
+    ])
+    assert not updater.validate_services()
+
+
+def test_one_failed_service_does_not_hold_back_others(make_updater, fake, cf, monkeypatch):
+    monkeypatch.setattr(cf, "CF_BATCH_UPDATE", False)
+    updater = make_updater([
+        {"srv": "_minecraft._tcp.example.com", "port": 25565},
+        {"srv": "_ts3._udp.voice.example.com", "port": 9987},
+    ])
+    java, voice = updater.services
+    java.current_ip, java.current_port = "203.0.113.7", 40001
+    voice.current_ip, voice.current_port = "203.0.113.8", 40002
+    assert updater.update_cloudflare_srv() == []
+    java.current_ip, java.current_port = "203.0.113.17", 40011
+    voice.current_ip, voice.current_port = "203.0.113.18", 40012
+    updater.api.retries = 0
+    # updating the first A record fails, its SRV record is skipped
+    fake.inject(500)
+    assert updater.update_cloudflare_srv() == [java]
+    assert fake.find("A", java.a_record_name)["content"] == "203.0.113.7"
+    assert fake.find("SRV", java.srv_name)["data"]["port"] == 40001
+    assert fake.find("A", voice.a_record_name)["content"] == "203.0.113.18"
+    assert fake.find("SRV", voice.srv_name)["data"]["port"] == 40012
+
+
+# ---------- embedded Natter ----------
+
+def test_embedded_natter_submits_mapping(updater, stun):
+    import natter
+    # reuse the imported module instead of loading natter.py a second time
+    updater.natter_module = natter
+    service = updater.services[0]
+    service.args = natter_args(stun)
+    assert updater.start_natter_thread(service)
+    try:
+        assert wait_until(lambda: service.name in updater.pending_mappings, timeout=15)
+        ip, port = updater.pending_mappings[service.name]
+        assert ip == FakeStun.OUTER_IP
+        assert service.last_mapping == (ip, port)
+    finally:
+        updater.stop_natter(service)
+    assert service.natter_thread is None
+
+
+# ---------- Natter output and events ----------
+
+@pytest.fixture
+def parser(cf):
+    # no API server needed to parse output
+    updater = cf.NatterCloudFlare()
+    yield updater
+    updater.api.close()
+
+
+def test_parse_tcp_mapping(parser):
+    line = ("2024-01-01 00:00:00 [I] tcp://192.168.1.10:25565 <--socket--> "
+            "tcp://192.168.1.10:40000 <--Natter--> tcp://203.0.113.7:40001")
+    assert parser.parse_natter_output(line) == ("203.0.113.7", 40001)
+
+
+def test_parse_udp_mapping(parser):
+    line = ("2024-01-01 00:00:00 [I] udp://192.168.1.10:25565 <--asyncio--> "
+            "udp://192.168.1.10:40000 <--Natter--> udp://203.0.113.7:40001")
+    assert parser.parse_natter_output(line) == ("203.0.113.7", 40001)
+
+
+def test_parse_ignores_standby_mapping(parser):
+    line = ("2024-01-01 00:00:00 [I] standby: tcp://192.168.1.10:40002 "
+            "<--Natter--> tcp://203.0.113.7:40003")
+    assert parser.parse_natter_output(line) == (None, None)
+
+
+def test_parse_ignores_other_lines(parser):
+    assert parser.parse_natter_output("2024-01-01 00:00:00 [I] Natter v2.1.0") == (None, None)
+    assert parser.parse_natter_output("") == (None, None)
+
+
+def test_mapping_event_is_submitted(parser):
+    service = parser.services[0]
+    event = {"event": "mapping", "protocol": "tcp", "inner": ["192.168.1.10", 25565],
+             "natter": ["192.168.1.10", 40000], "outer": ["203.0.113.7", 40001], "time": 1}
+    parser.handle_natter_event(service, json.dumps(event))
+    assert parser.pending_mappings == {service.name: ("203.0.113.7", 40001)}
+    # the same mapping again is not submitted twice
+    parser.pending_mappings.clear()
+    parser.handle_natter_event(service, json.dumps(event))
+    assert parser.pending_mappings == {}
+
+
+def test_other_events_are_only_logged(parser, capsys):
+    service = parser.services[0]
+    parser.handle_natter_event(service, json.dumps(
+        {"event": "mapping_changed", "old": ["203.0.113.7", 40001], "new": ["203.0.113.7", 40002]}))
+    parser.handle_natter_event(service, json.dumps({"event": "keepalive", "ok": False, "error": "timed out"}))
+    parser.handle_natter_event(service, "{not json")
+    assert parser.pending_mappings == {}
+    out = capsys.readouterr().out
+    assert "timed out" in out
+    assert "{not json" in out